@@ -1,14 +1,27 @@
-from .agent import conversation_agent, conversation_agent_lite, google_search_agent, search_agent
+from .agent import get_gemini_conversation_agent, get_litellm_conversation_agent, get_gemini_search_agent, get_litellm_search_agent
 from bot.config.models import LITELLM_MODE
 
 # Proxy agents that automatically select based on LITELLM_MODE
 def get_conversation_agent():
     """Returns the appropriate conversation agent based on LITELLM_MODE setting."""
-    return conversation_agent_lite if LITELLM_MODE else conversation_agent
+    return get_litellm_conversation_agent() if LITELLM_MODE else get_gemini_conversation_agent()
 
 def get_search_agent():
     """Returns the appropriate search agent based on LITELLM_MODE setting."""
-    return search_agent if LITELLM_MODE else google_search_agent
+    return get_litellm_search_agent() if LITELLM_MODE else get_gemini_search_agent()
+
+# The individual agents are still available under their old names, built when first accessed
+_AGENT_BUILDERS = {
+    'conversation_agent': get_gemini_conversation_agent,
+    'conversation_agent_lite': get_litellm_conversation_agent,
+    'google_search_agent': get_gemini_search_agent,
+    'search_agent': get_litellm_search_agent,
+}
+
+def __getattr__(name):
+    if name in _AGENT_BUILDERS:
+        return _AGENT_BUILDERS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Export the proxy functions and individual agents
 __all__ = [
@@ -18,4 +31,4 @@ __all__ = [
     'conversation_agent_lite',
     'google_search_agent',
     'search_agent'
-]
\ No newline at end of file
+]
@@ -6,16 +6,18 @@ from google.adk.runners import Runner
 from google.adk.sessions import DatabaseSessionService
 from google.adk.agents.callback_context import CallbackContext
 from google.adk.models import LlmRequest, llm_response
-from google.adk.models.lite_llm import LiteLlm
+from google.adk.models import Gemini
 from google.genai import types
 import logging
 from datetime import datetime
 import asyncio
+import functools
 
 from .tools.search import searxng_search
 from bot.services.database_service import increase_online_time, get_online_for_seconds
 from .prompt import personality_prompt, search_prompt
-from bot.config.models import GEMINI_SEARCH_MODEL, GEMINI_CONVERSATION_MODEL, LITELLM_CONVERSATION_MODEL, LITELLM_SEARCH_MODEL
+from bot.config.models import GEMINI_SEARCH_MODEL, GEMINI_CONVERSATION_MODEL, LITELLM_CONVERSATION_MODEL, LITELLM_SEARCH_MODEL, LITELLM_FALLBACK_TO_GEMINI, GEMINI_ENDPOINT
+from bot.services.model_resilience import ResilientLlm, SEARCH_PRIORITY
 
 logger = logging.getLogger(__name__)
 
@@ -43,83 +45,107 @@ def after_model_addTeleInfo_callback(callback_context: CallbackContext, llm_resp
     # llm_response.content.parts[0].text = f"[{datetime.now().strftime('%d-%m-%Y %I:%M %p')}] Dom (@domthebuilderbot): {llm_response.content.parts[0].text}"
     return None
 
-# Search Agent (Gemini)
-google_search_agent = Agent(
-    model=GEMINI_SEARCH_MODEL,
-    description="A general search agent with access to google search",
-    name="google_search",
-    instruction=search_prompt,
-    tools=[
-        google_search
-    ],
-    generate_content_config=types.GenerateContentConfig(
-        max_output_tokens=1000,
-        temperature=0.6,
-        top_p=0.9,
+# The agents are built on first use, so only the ones for the active LITELLM_MODE are
+# constructed and litellm is only imported when it is needed
+
+@functools.cache
+def get_gemini_search_agent() -> Agent:
+    """Search Agent (Gemini)"""
+    return Agent(
+        model=ResilientLlm(primary=Gemini(model=GEMINI_SEARCH_MODEL), endpoint=GEMINI_ENDPOINT, priority=SEARCH_PRIORITY),
+        description="A general search agent with access to google search",
+        name="google_search",
+        instruction=search_prompt,
+        tools=[
+            google_search
+        ],
+        generate_content_config=types.GenerateContentConfig(
+            max_output_tokens=1000,
+            temperature=0.6,
+            top_p=0.9,
+        )
     )
-)
 
-# Root Conversation Agent (Gemini)
-conversation_agent = Agent(
-    description="Dom is a university student in Singapore. He is a friendly and relatable person who is always willing to help. He is also a bit of a nerd and loves to learn new things.",
-    model=GEMINI_CONVERSATION_MODEL,
-    name="dom",
-    instruction=personality_prompt,
-    before_model_callback=update_prompt_variables_callback,
-    after_model_callback=after_model_addTeleInfo_callback,
-    tools=[
-        AgentTool(agent=google_search_agent),
-        FunctionTool(func=increase_online_time)
-    ],
-    generate_content_config=types.GenerateContentConfig(
-        max_output_tokens=2000,
-        temperature=1.25,
-        top_p=0.95,
+@functools.cache
+def get_gemini_conversation_agent() -> Agent:
+    """Root Conversation Agent (Gemini)"""
+    return Agent(
+        description="Dom is a university student in Singapore. He is a friendly and relatable person who is always willing to help. He is also a bit of a nerd and loves to learn new things.",
+        model=ResilientLlm(primary=Gemini(model=GEMINI_CONVERSATION_MODEL), endpoint=GEMINI_ENDPOINT),
+        name="dom",
+        instruction=personality_prompt,
+        before_model_callback=update_prompt_variables_callback,
+        after_model_callback=after_model_addTeleInfo_callback,
+        tools=[
+            AgentTool(agent=get_gemini_search_agent()),
+            FunctionTool(func=increase_online_time)
+        ],
+        generate_content_config=types.GenerateContentConfig(
+            max_output_tokens=2000,
+            temperature=1.25,
+            top_p=0.95,
+        )
     )
-)
 
-# Search Agent (LiteLLM)
-search_agent = Agent(
-    description="A general search agent with access to searxng search",
-    model=LiteLlm(
-        model=LITELLM_SEARCH_MODEL["model"],
-        api_base=LITELLM_SEARCH_MODEL["api_base"],
-        # Add timeout and retry settings to prevent hanging
-        timeout=30,
-        max_retries=2,
-        # Add temperature and other parameters for better stability
-        temperature=0.7,
-        max_tokens=1000
-    ),
-    name="searxng_search",
-    instruction=search_prompt,
-    tools=[
-        FunctionTool(func=searxng_search),
-    ],
-)
+@functools.cache
+def get_litellm_search_agent() -> Agent:
+    """Search Agent (LiteLLM)"""
+    from google.adk.models.lite_llm import LiteLlm
+    return Agent(
+        description="A general search agent with access to searxng search",
+        model=ResilientLlm(
+            primary=LiteLlm(
+                model=LITELLM_SEARCH_MODEL["model"],
+                api_base=LITELLM_SEARCH_MODEL["api_base"],
+                # Add timeout and retry settings to prevent hanging
+                timeout=30,
+                max_retries=2,
+                # Add temperature and other parameters for better stability
+                temperature=0.7,
+                max_tokens=1000
+            ),
+            endpoint=LITELLM_SEARCH_MODEL["api_base"],
+            priority=SEARCH_PRIORITY,
+            fallback=Gemini(model=GEMINI_SEARCH_MODEL) if LITELLM_FALLBACK_TO_GEMINI else None,
+            fallback_endpoint=GEMINI_ENDPOINT,
+        ),
+        name="searxng_search",
+        instruction=search_prompt,
+        tools=[
+            FunctionTool(func=searxng_search),
+        ],
+    )
 
-# Root Conversation Agent (LiteLLM)
-conversation_agent_lite = Agent(
-    description="Dom is a university student in Singapore. He is a friendly and relatable person who is always willing to help. He is also a bit of a nerd and loves to learn new things.",
-    model=LiteLlm(
-        model=LITELLM_CONVERSATION_MODEL["model"],
-        api_base=LITELLM_CONVERSATION_MODEL["api_base"],
-        # Add timeout and retry settings to prevent hanging
-        timeout=60,
-        max_retries=3,
-        # Add temperature and other parameters for better stability
-        temperature=0.8,
-        max_tokens=2000
-    ),
-    name="dom",
-    instruction=personality_prompt,
-    before_model_callback=update_prompt_variables_callback,
-    after_model_callback=after_model_addTeleInfo_callback,
-    tools=[
-        AgentTool(agent=search_agent),
-        FunctionTool(func=increase_online_time)
-    ],
-)
+@functools.cache
+def get_litellm_conversation_agent() -> Agent:
+    """Root Conversation Agent (LiteLLM)"""
+    from google.adk.models.lite_llm import LiteLlm
+    return Agent(
+        description="Dom is a university student in Singapore. He is a friendly and relatable person who is always willing to help. He is also a bit of a nerd and loves to learn new things.",
+        model=ResilientLlm(
+            primary=LiteLlm(
+                model=LITELLM_CONVERSATION_MODEL["model"],
+                api_base=LITELLM_CONVERSATION_MODEL["api_base"],
+                # Add timeout and retry settings to prevent hanging
+                timeout=60,
+                max_retries=3,
+                # Add temperature and other parameters for better stability
+                temperature=0.8,
+                max_tokens=2000
+            ),
+            endpoint=LITELLM_CONVERSATION_MODEL["api_base"],
+            fallback=Gemini(model=GEMINI_CONVERSATION_MODEL) if LITELLM_FALLBACK_TO_GEMINI else None,
+            fallback_endpoint=GEMINI_ENDPOINT,
+        ),
+        name="dom",
+        instruction=personality_prompt,
+        before_model_callback=update_prompt_variables_callback,
+        after_model_callback=after_model_addTeleInfo_callback,
+        tools=[
+            AgentTool(agent=get_litellm_search_agent()),
+            FunctionTool(func=increase_online_time)
+        ],
+    )
 
 # For testing the agent
 import uuid
@@ -144,7 +170,7 @@ async def test():
             app_name="dom",
             user_id="test_user",
             session_id=session_id,
-            state={"chat_id": "test_user", "summary": "No summary available", "individualisation_prompts": [], "sarcasm_level": 0.5, "playfulness_level": 0.5, "humor_level": 0.5, "formality_level": 0.5, "empathy_level": 0.5, "enthusiasm_level": 0.5, "singlish_level": 0.5, "emoji_level": 0.5}
+            state={"chat_id": "test_user", "summary": "No summary available", "individualisation_prompts": "", "sarcasm_level": 0.5, "playfulness_level": 0.5, "humor_level": 0.5, "formality_level": 0.5, "empathy_level": 0.5, "enthusiasm_level": 0.5, "singlish_level": 0.5, "emoji_level": 0.5}
         )
     session_object = await session_service.get_session(
         app_name="dom",
@@ -157,7 +183,7 @@ async def test():
     print(session_object.events)
     
     runner = Runner(
-        agent=conversation_agent,
+        agent=get_gemini_conversation_agent(),
         app_name="dom",
         session_service=session_service,
     )
@@ -3,7 +3,6 @@ from google.genai import types
 import aiohttp
 import json
 from typing import Dict, Any
-from dotenv import load_dotenv
 import logging
 
 # Configure logging
@@ -17,7 +16,6 @@ import logging
 # )
 logger = logging.getLogger(__name__)
 
-load_dotenv()
 import os
 
 async def searxng_search(keywords: str, tool_context: ToolContext) -> str:
@@ -1,14 +1,25 @@
-from .agent import summarising_agent, summarising_agent_lite
+from .agent import get_gemini_summarising_agent, get_litellm_summarising_agent
 from bot.config.models import LITELLM_MODE
 
 # Proxy agent that automatically selects based on LITELLM_MODE
 def get_summarising_agent():
     """Returns the appropriate summarising agent based on LITELLM_MODE setting."""
-    return summarising_agent_lite if LITELLM_MODE else summarising_agent
+    return get_litellm_summarising_agent() if LITELLM_MODE else get_gemini_summarising_agent()
+
+# The individual agents are still available under their old names, built when first accessed
+_AGENT_BUILDERS = {
+    'summarising_agent': get_gemini_summarising_agent,
+    'summarising_agent_lite': get_litellm_summarising_agent,
+}
+
+def __getattr__(name):
+    if name in _AGENT_BUILDERS:
+        return _AGENT_BUILDERS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Export the proxy function and individual agents
 __all__ = [
     'get_summarising_agent',
     'summarising_agent',
     'summarising_agent_lite'
-]
\ No newline at end of file
+]
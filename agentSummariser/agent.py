@@ -1,11 +1,13 @@
 from google.adk.agents import Agent
 from google.genai import types
 import logging
+import functools
 from typing import List
-from google.adk.models.lite_llm import LiteLlm
+from google.adk.models import Gemini
 
 from pydantic import BaseModel, Field
-from bot.config.models import GEMINI_SUMMARISATION_MODEL, LITELLM_SUMMARISATION_MODEL
+from bot.config.models import GEMINI_SUMMARISATION_MODEL, LITELLM_SUMMARISATION_MODEL, LITELLM_FALLBACK_TO_GEMINI, GEMINI_ENDPOINT
+from bot.services.model_resilience import ResilientLlm, SUMMARISATION_PRIORITY
 
 class UserInformation(BaseModel):
     telegram_handle: str = Field(description="The telegram handle of the user.")
@@ -27,43 +29,58 @@ class ChatParameters(BaseModel):
 
 class SummaryOutput(BaseModel):
     summary: str = Field(description="The summary of the conversation.")
-    user_information: List[UserInformation] = Field(description="The list of user information for all users in the conversation.")
+    user_information: List[UserInformation] = Field(description="The user information of the users who are new or changed in the conversation.")
     chat_parameters: ChatParameters = Field(description="The chat parameters of the conversation.")
+    memories: List[str] = Field(description="New facts and events from the conversation worth remembering later, each one understandable on its own.")
 
 from .prompt import summarisation_prompt
 
 logger = logging.getLogger(__name__)
 
-# Summarising Agent (Gemini)
-summarising_agent = Agent(
-    model=GEMINI_SUMMARISATION_MODEL,
-    name="summarising_agent",
-    instruction=summarisation_prompt,
-    output_schema=SummaryOutput,
-    disallow_transfer_to_parent=True,
-    disallow_transfer_to_peers=True,
-    generate_content_config=types.GenerateContentConfig(
-        max_output_tokens=2000,
-        temperature=0.5,
-        top_p=0.9,
+# The agents are built on first use, so only the one for the active LITELLM_MODE is
+# constructed and litellm is only imported when it is needed
+
+@functools.cache
+def get_gemini_summarising_agent() -> Agent:
+    """Summarising Agent (Gemini)"""
+    return Agent(
+        model=ResilientLlm(primary=Gemini(model=GEMINI_SUMMARISATION_MODEL), endpoint=GEMINI_ENDPOINT, priority=SUMMARISATION_PRIORITY),
+        name="summarising_agent",
+        instruction=summarisation_prompt,
+        output_schema=SummaryOutput,
+        disallow_transfer_to_parent=True,
+        disallow_transfer_to_peers=True,
+        generate_content_config=types.GenerateContentConfig(
+            max_output_tokens=2000,
+            temperature=0.5,
+            top_p=0.9,
+        )
     )
-)
 
-# Summarising Agent (LiteLLM)
-summarising_agent_lite = Agent(
-    model=LiteLlm(
-        model=LITELLM_SUMMARISATION_MODEL["model"],
-        api_base=LITELLM_SUMMARISATION_MODEL["api_base"],
-        # Add timeout and retry settings to prevent hanging
-        timeout=30,
-        max_retries=2,
-        # Add temperature and other parameters for better stability
-        temperature=0.5,
-        max_tokens=2000
-    ),
-    name="summarising_agent",
-    instruction=summarisation_prompt,
-    output_schema=SummaryOutput,
-    disallow_transfer_to_parent=True,
-    disallow_transfer_to_peers=True,
-)
\ No newline at end of file
+@functools.cache
+def get_litellm_summarising_agent() -> Agent:
+    """Summarising Agent (LiteLLM)"""
+    from google.adk.models.lite_llm import LiteLlm
+    return Agent(
+        model=ResilientLlm(
+            primary=LiteLlm(
+                model=LITELLM_SUMMARISATION_MODEL["model"],
+                api_base=LITELLM_SUMMARISATION_MODEL["api_base"],
+                # Add timeout and retry settings to prevent hanging
+                timeout=30,
+                max_retries=2,
+                # Add temperature and other parameters for better stability
+                temperature=0.5,
+                max_tokens=2000
+            ),
+            endpoint=LITELLM_SUMMARISATION_MODEL["api_base"],
+            priority=SUMMARISATION_PRIORITY,
+            fallback=Gemini(model=GEMINI_SUMMARISATION_MODEL) if LITELLM_FALLBACK_TO_GEMINI else None,
+            fallback_endpoint=GEMINI_ENDPOINT,
+        ),
+        name="summarising_agent",
+        instruction=summarisation_prompt,
+        output_schema=SummaryOutput,
+        disallow_transfer_to_parent=True,
+        disallow_transfer_to_peers=True,
+    )
@@ -1,3 +1,7 @@
 """
 Configuration settings for the Telegram bot.
-""" 
\ No newline at end of file
+"""
+from dotenv import load_dotenv
+
+# Load environment variables once, before any of the settings modules read them
+load_dotenv()
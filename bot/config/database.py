@@ -1,8 +1,5 @@
 from typing import Dict, Any
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 DATABASE_CONFIG: Dict[str, Any] = {
     'host': os.getenv('DB_HOST', 'localhost'),
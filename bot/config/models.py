@@ -1,7 +1,4 @@
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 # model="gemini-2.0-flash-lite",
 # model="gemini-2.5-flash-preview-04-17",
@@ -33,4 +30,24 @@ LITELLM_CONVERSATION_MODEL = {
 LITELLM_SUMMARISATION_MODEL = {
     "model": os.getenv("LITELLM_SUMMARISATION_MODEL", "ollama/gemma3:27b-it-qat"),
     "api_base": os.getenv("LITELLM_SUMMARISATION_BASE_URL", "http://192.168.68.23:11434/v1")
-}
\ No newline at end of file
+}
+# Model Resilience
+MODEL_BREAKER_FAILURES = int(os.getenv("MODEL_BREAKER_FAILURES", 5))  # consecutive failures before an endpoint's circuit opens
+MODEL_BREAKER_RESET_SECONDS = float(os.getenv("MODEL_BREAKER_RESET_SECONDS", 30))  # seconds before a probe call is let through
+MODEL_HEDGE_PERCENTILE = float(os.getenv("MODEL_HEDGE_PERCENTILE", 95))  # latency percentile after which the fallback is tried too, 0 disables hedging
+MODEL_TURN_DEADLINE = float(os.getenv("MODEL_TURN_DEADLINE", 180))  # seconds an agent turn may spend on model calls
+# Fall back to the Gemini models when the LiteLLM endpoint is slow or down (needs GOOGLE_API_KEY)
+LITELLM_FALLBACK_TO_GEMINI = os.getenv("LITELLM_FALLBACK_TO_GEMINI", "false").lower() in ("true", "1", "yes", "on")
+GEMINI_ENDPOINT = "gemini"
+
+# Local Model Concurrency (applies to each LiteLLM endpoint, Gemini is not limited)
+LITELLM_MAX_CONCURRENCY = int(os.getenv("LITELLM_MAX_CONCURRENCY", 2))  # generations sent to one endpoint at once
+LITELLM_MAX_QUEUE = int(os.getenv("LITELLM_MAX_QUEUE", 8))  # calls waiting for an endpoint before the lowest priority ones are shed
+MODEL_OVERLOAD_RETRY_SECONDS = float(os.getenv("MODEL_OVERLOAD_RETRY_SECONDS", 30))  # seconds a chat waits after its turn was shed before it is retried
+
+# Model Warm-up
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() in ("true", "1", "yes", "on")  # warm up the models at start-up and before chats wake up
+MODEL_KEEPALIVE_INTERVAL = int(os.getenv("MODEL_KEEPALIVE_INTERVAL", 240))  # seconds between keep-alive pings while any chat is online
+MODEL_PREWARM_LEAD = int(os.getenv("MODEL_PREWARM_LEAD", 120))  # seconds before WAKE_UP_TIME or an offline chat's return to warm up the models
+MODEL_WARMUP_TIMEOUT = float(os.getenv("MODEL_WARMUP_TIMEOUT", 120))  # seconds a warm-up call may take, loading a large local model is slow
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # how long Ollama keeps a model loaded after a keep-alive ping
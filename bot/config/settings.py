@@ -1,13 +1,9 @@
 import os
 import json
 import datetime
-from dotenv import load_dotenv
 from sqlalchemy.engine.url import URL
 import logging
 
-# Load environment variables
-load_dotenv()
-
 # Logging Configuration
 if os.getenv("LOG_LEVEL") == "DEBUG":
     LOG_LEVEL = logging.DEBUG
@@ -23,20 +19,30 @@ API_ID = os.getenv("TELEGRAM_API_ID")
 API_HASH = os.getenv("TELEGRAM_API_HASH")
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_GROUP_IDS = json.loads(os.getenv("ALLOWED_GROUP_IDS", "[]"))
+TELEGRAM_SESSION_STORE = os.getenv("TELEGRAM_SESSION_STORE", "database").lower()  # database keeps the Telethon session in the bot's database, file uses Telethon's session file
+TELEGRAM_SESSION_NAME = os.getenv("TELEGRAM_SESSION_NAME", "bot_session")  # name of the session in the database, and of the session file without .session
+SENDER_CACHE_SIZE = int(os.getenv("SENDER_CACHE_SIZE", 5000))  # message senders whose name and username are kept in memory
+SENDER_CACHE_TTL = int(os.getenv("SENDER_CACHE_TTL", 3600))  # in seconds, after which a cached sender is refreshed in the background
 
 # Dev Mode Configuration
 DEV_MODE = os.getenv("DEV_MODE", "false").lower() == "true"
 DEV_CHAT_ID = int(os.getenv("DEV_CHAT_ID", "0")) if os.getenv("DEV_CHAT_ID") else None
 
 # Database Configuration
-DB_URL = URL.create(
-    drivername="postgresql",
-    username=os.getenv("POSTGRES_USER"),
-    password=os.getenv("POSTGRES_PASSWORD"),
-    host=os.getenv("POSTGRES_HOST"),
-    port=os.getenv("POSTGRES_PORT","5432"),
-    database=os.getenv("POSTGRES_DATABASE")
-)
+DB_BACKEND = os.getenv("DB_BACKEND", "postgresql").lower()  # postgresql, or sqlite for single process deployments
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/bot.sqlite3")
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", 30))  # in seconds, how long a write waits for the database lock
+if DB_BACKEND == "sqlite":
+    DB_URL = URL.create(drivername="sqlite", database=SQLITE_PATH)
+else:
+    DB_URL = URL.create(
+        drivername="postgresql",
+        username=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT","5432"),
+        database=os.getenv("POSTGRES_DATABASE")
+    )
 
 # Bot Behavior Configuration
 WAKE_UP_TIME = datetime.time.fromisoformat(os.getenv("WAKE_UP_TIME", "07:30:00"))  # Format: HH:MM:SS
@@ -48,7 +54,31 @@ MAX_ONLINE_TIME = int(os.getenv("MAX_ONLINE_TIME", 900))  # in seconds
 MIN_RESPONSE_DELAY = int(os.getenv("MIN_RESPONSE_DELAY", 3))  # in seconds
 MAX_RESPONSE_DELAY = int(os.getenv("MAX_RESPONSE_DELAY", 12))  # in seconds
 SUMMARISING_AGENT_TOKEN_THRESHOLD = int(os.getenv("SUMMARISING_AGENT_TOKEN_THRESHOLD", 4000))
+SUMMARISATION_SOFT_THRESHOLD = int(os.getenv("SUMMARISATION_SOFT_THRESHOLD", 2500))  # estimated tokens above which a session is summarised in the nightly batch
+SUMMARISATION_BATCH_CONCURRENCY = int(os.getenv("SUMMARISATION_BATCH_CONCURRENCY", 2))  # sessions summarised at once by the batch
+SUMMARISATION_BATCH_INTERVAL = int(os.getenv("SUMMARISATION_BATCH_INTERVAL", 1800))  # in seconds, between batch passes during SLEEP_TIME to WAKE_UP_TIME
 MAX_OFFLINE_MESSAGES = int(os.getenv("MAX_OFFLINE_MESSAGES", 50))
+BACKLOG_COMPRESSION = os.getenv("BACKLOG_COMPRESSION", "threads").lower()  # off sends queued messages verbatim, collapse merges media runs and repeats, budget also cuts them to BACKLOG_TOKEN_BUDGET, threads also only keeps the reply threads with the bot in group chats
+BACKLOG_TOKEN_BUDGET = int(os.getenv("BACKLOG_TOKEN_BUDGET", 1500))  # tokens of queued messages sent to the agent in one turn with budget compression
+REPLY_CONTEXT_RECENT = int(os.getenv("REPLY_CONTEXT_RECENT", 8))  # latest group messages kept besides the reply threads with the bot, 0 keeps only the threads
+REPLY_GRAPH_MAX_MESSAGES = int(os.getenv("REPLY_GRAPH_MAX_MESSAGES", 5000))  # reply edges kept in memory per chat
+REPLY_GRAPH_MAX_CHATS = int(os.getenv("REPLY_GRAPH_MAX_CHATS", 500))  # chats whose reply graph is kept in memory
+REPLY_GRAPH_RETENTION_DAYS = int(os.getenv("REPLY_GRAPH_RETENTION_DAYS", 30))  # reply edges older than this are deleted
+BOT_NAMES = [name.strip() for name in os.getenv("BOT_NAMES", "dom,domthebuilderbot").split(",") if name.strip()]  # messages mentioning these names are never compressed away
+MEMORY_RETRIEVAL = os.getenv("MEMORY_RETRIEVAL", "true").lower() in ("true", "1", "yes", "on")  # put the memories relevant to each batch in the prompt instead of the whole summary
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", 5))  # memories put in the prompt per turn
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", 0.2))  # cosine similarity below which a memory is not relevant
+MEMORY_EMBEDDING_DIMENSIONS = int(os.getenv("MEMORY_EMBEDDING_DIMENSIONS", 1024))  # changing it needs the memories table emptied
+MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", 200))  # chats whose memory index is kept in memory
+WAKEUP_STAGGER = os.getenv("WAKEUP_STAGGER", "true").lower() in ("true", "1", "yes", "on")  # spread the morning return of chats with overnight backlogs
+WAKEUP_CONCURRENCY = int(os.getenv("WAKEUP_CONCURRENCY", 2))  # agent turns the model backend can run at once during the morning burst
+WAKEUP_TURN_SECONDS = int(os.getenv("WAKEUP_TURN_SECONDS", 20))  # in seconds, time of an agent turn besides reading the backlog
+WAKEUP_TOKENS_PER_SECOND = int(os.getenv("WAKEUP_TOKENS_PER_SECOND", 150))  # backlog tokens the model backend reads per second
+WAKEUP_PLAN_LEAD = int(os.getenv("WAKEUP_PLAN_LEAD", 600))  # in seconds, how long before WAKE_UP_TIME the wake-ups are planned
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))  # session events shown per /history page
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 200))  # recently active agent sessions kept in memory with their events
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", 600))  # in seconds, how long a turn may hold queued messages before they are redelivered
+QUEUE_MAX_DELIVERIES = int(os.getenv("QUEUE_MAX_DELIVERIES", 3))  # failed attempts before a queued message is moved to dead_letter_messages
 
 # Personality Parameters (0.0 to 1.0 scale)
 SARCASTIC_LEVEL = float(os.getenv("SARCASTIC_LEVEL", "0.7"))
@@ -58,4 +88,26 @@ FORMALITY_LEVEL = float(os.getenv("FORMALITY_LEVEL", "0.5"))
 EMPATHY_LEVEL = float(os.getenv("EMPATHY_LEVEL", "0.7"))
 ENTHUSIASM_LEVEL = float(os.getenv("ENTHUSIASM_LEVEL", "0.5"))
 SINGLISH_LEVEL = float(os.getenv("SINGLISH_LEVEL", "0.05"))
-EMOJI_LEVEL = float(os.getenv("EMOJI_LEVEL", "0.1"))
\ No newline at end of file
+EMOJI_LEVEL = float(os.getenv("EMOJI_LEVEL", "0.1"))
+
+# Process Role Configuration
+BOT_ROLE = os.getenv("BOT_ROLE", "all").lower()  # all, ingest (Telegram connection) or worker (agent turns)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 4))  # chats a worker process, or a single process bot, handles at once
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", 1))  # in seconds
+OUTBOUND_POLL_INTERVAL = float(os.getenv("OUTBOUND_POLL_INTERVAL", 0.5))  # in seconds
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 8))  # incoming updates handled at once by the process holding the Telegram connection
+INGEST_CHAT_QUEUE_SIZE = int(os.getenv("INGEST_CHAT_QUEUE_SIZE", 50))  # updates of one chat waiting to be handled
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 1000))  # updates of all chats waiting to be handled
+INGEST_DEFER_SECONDS = float(os.getenv("INGEST_DEFER_SECONDS", 5))  # in seconds, how long a command waits for room in a full queue before it is dropped, messages wait until there is room
+INGEST_MAX_DEFERRED = int(os.getenv("INGEST_MAX_DEFERRED", 200))  # updates waiting for room at once, past this messages are only stored and commands are dropped
+
+# Outbound Rate Limits (Telegram allows bots about 30 messages per second, 1 per second in a chat and 20 per minute in a group)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))  # messages per second across all chats
+SEND_PRIVATE_CHAT_RATE = float(os.getenv("SEND_PRIVATE_CHAT_RATE", 1))  # messages per second in a private chat
+SEND_GROUP_CHAT_RATE = float(os.getenv("SEND_GROUP_CHAT_RATE", 20))  # messages per minute in a group
+
+# Log Storage Configuration
+LOG_PARTITION_INTERVAL = os.getenv("LOG_PARTITION_INTERVAL", "day").lower()  # day or week
+LOG_PARTITION_PREMAKE = int(os.getenv("LOG_PARTITION_PREMAKE", 7))  # number of future partitions to create ahead
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", 0))  # 0 keeps logs forever
+LOG_ROLLUP_RETENTION_DAYS = int(os.getenv("LOG_ROLLUP_RETENTION_DAYS", 365))  # per-minute stats, 0 keeps them forever
@@ -1,16 +1,28 @@
 import logging
-from bot.config.settings import ALLOWED_GROUP_IDS, DEV_MODE, DEV_CHAT_ID, SARCASTIC_LEVEL, PLAYFUL_LEVEL, HUMOR_LEVEL, FORMALITY_LEVEL, EMPATHY_LEVEL, ENTHUSIASM_LEVEL, SINGLISH_LEVEL, EMOJI_LEVEL
+from typing import List, Optional
+from bot.config.settings import ALLOWED_GROUP_IDS, DEV_MODE, DEV_CHAT_ID, HISTORY_PAGE_SIZE, SARCASTIC_LEVEL, PLAYFUL_LEVEL, HUMOR_LEVEL, FORMALITY_LEVEL, EMPATHY_LEVEL, ENTHUSIASM_LEVEL, SINGLISH_LEVEL, EMOJI_LEVEL
 from .message_handler import MessageHandler
 from bot.utils.bot_state import BotState
-from google.adk.sessions import DatabaseSessionService
+from bot.utils.history_renderer import HistoryPageCache, render_event, chunk_entries
+from bot.services.session_service import EventLogSessionService
+from google.adk.sessions.base_session_service import GetSessionConfig
 
 
 logger = logging.getLogger(__name__)
 
 class CommandHandler:
-    def __init__(self, bot_state: BotState, session_service: DatabaseSessionService):
+    def __init__(self, bot_state: BotState, session_service: EventLogSessionService):
         self.bot_state = bot_state
         self.session_service = session_service
+        self.history_cache = HistoryPageCache()
+        self.send_scheduler = None  # Will be set by main.py
+
+    async def _reply(self, event, message: str):
+        """Reply to a command within the flood limits, through the send scheduler when this process has one."""
+        if self.send_scheduler is not None:
+            await self.send_scheduler.send(event.chat_id, message)
+        else:
+            await event.respond(message)
 
     async def is_allowed_chat(self, chat_id: int) -> bool:
         """Check if the chat is in the whitelist or dev mode."""
@@ -25,142 +37,119 @@ class CommandHandler:
         """Handle the /start command."""
         chat_id = event.chat_id
         if await self.is_allowed_chat(chat_id):
-            await event.respond("Hello! I'm now active in this group chat.")
+            await self._reply(event, "Hello! I'm now active in this group chat.")
         else:
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
 
     async def handle_history(self, event):
-        """Handle the /history command to show recent chat history."""
+        """Handle the /history command to show recent chat history, one page at a time."""
         chat_id = str(event.chat_id)
         if not await self.is_allowed_chat(int(chat_id)):
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
+            return
+        
+        # Page 1 is the most recent messages, /history 2 goes further back
+        parts = event.message.text.strip().split()
+        try:
+            page = int(parts[1]) if len(parts) > 1 else 1
+            if page < 1:
+                raise ValueError
+        except ValueError:
+            await self._reply(event, "Please specify a page number in the format: /history <page>\nExample: /history 2")
             return
         
         try:
             # Get session for this chat
-            session_id = f"chat_{chat_id}"
             try:
                 sessions = await self.session_service.list_sessions(
                     app_name="dom",
                     user_id=chat_id,
                 )
                 if not sessions.sessions:
-                    await event.respond("No chat history found.")
+                    await self._reply(event, "No chat history found.")
                     return
                 session = sessions.sessions[0]
             except Exception as e:
                 logger.error(f"Error getting session: {e}")
-                await event.respond("No chat history found.")
-                return
-
-            # Get session details
-            session_object = await self.session_service.get_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session.id,
-            )
-
-            if not session_object.events:
-                await event.respond("No chat history found.")
+                await self._reply(event, "No chat history found.")
                 return
 
-            # Format the history
-            history_text = "📜 Recent messages in this chat:\n\n"
-            for session_event in session_object.events[-20:]:  # Show last 20 messages
-                if session_event.author == "user":
-                    # Check if it is a function call
-                    if session_event.content.parts[0].function_call:
-                        history_text += f"Function called: {session_event.content.parts[0].function_call.name}\n"
-                        history_text += f"Function response: {session_event.content.parts[0].function_call.response}\n"
-                        continue
-                    # Extract just the text portion from the content
-                    content_text = session_event.content.parts[0].text if hasattr(session_event.content, 'parts') else session_event.content
-                    history_text += f"User: {content_text}\n"
-                elif session_event.author == "dom":
-                    # Extract just the text portion from the content
-                    # Handle multiple parts if they exist
-                    if hasattr(session_event.content, 'parts'):
-                        content_texts = []
-                        for part in session_event.content.parts:
-                            if part.function_call != None:
-                                content_texts.append(f"Function called: {part.function_call.name}\n")
-                                content_texts.append(f"Function arguments: {part.function_call.args}\n")
-                                continue
-                            if part.function_response != None:
-                                content_texts.append(f"Function called: {part.function_response.name}\n")
-                                content_texts.append(f"Function response: {part.function_response.response}\n")
-                                continue
-                            if hasattr(part, 'text'):
-                                if part.text == None:
-                                    print(part)
-                                content_texts.append(part.text)
-                        content_text = "\n".join(content_texts)
-                    else:
-                        content_text = session_event.content
-                    
-                    logger.debug(f"content_text: {content_text}")
-                    history_text += f"Dom: {content_text.replace("%next_message%", "\n").replace("%no_response%", "")}\n"
+            chunks = self.history_cache.get(session.id, page, session.last_update_time)
+            if chunks is None:
+                chunks = await self._render_history_page(chat_id, session.id, page)
+                if chunks is None:
+                    await self._reply(event, "No chat history found." if page == 1 else f"There is no page {page} of the chat history.")
+                    return
+                self.history_cache.put(session.id, page, session.last_update_time, chunks)
 
-            # Split message if it's too long for Telegram (4096 character limit)
-            if len(history_text) >= 4096:
-                # Split into chunks of 4000 characters to be safe
-                chunk_size = 4000
-                chunks = [history_text[i:i + chunk_size] for i in range(0, len(history_text), chunk_size)]
-                
-                for i, chunk in enumerate(chunks):
-                    if i == 0:
-                        await event.respond(chunk)
-                    else:
-                        # Add continuation indicator for subsequent chunks
-                        await event.respond(f"...(continued)\n{chunk}")
-            else:
-                await event.respond(history_text)
+            for chunk in chunks:
+                await self._reply(event, chunk)
         except Exception as e:
             logger.error(f"Error getting chat history: {e}")
-            await event.respond("Sorry, I encountered an error while retrieving the chat history.")
+            await self._reply(event, "Sorry, I encountered an error while retrieving the chat history.")
+
+    async def _render_history_page(self, chat_id: str, session_id: str, page: int) -> Optional[List[str]]:
+        """Render a page of history, reading only the events up to and including that page.
+
+        Returns:
+            The page split into Telegram-sized messages, None if the page is empty
+        """
+        # One extra event tells us whether an older page exists
+        session_object = await self.session_service.get_session(
+            app_name="dom",
+            user_id=chat_id,
+            session_id=session_id,
+            config=GetSessionConfig(num_recent_events=page * HISTORY_PAGE_SIZE + 1),
+        )
+        if not session_object or not session_object.events:
+            return None
+
+        events = session_object.events
+        page_end = len(events) - (page - 1) * HISTORY_PAGE_SIZE
+        if page_end <= 0:
+            return None
+        has_older = len(events) > page * HISTORY_PAGE_SIZE
+        page_events = events[max(page_end - HISTORY_PAGE_SIZE, 0):page_end]
+
+        entries = [entry for entry in (render_event(session_event) for session_event in page_events) if entry]
+        if not entries:
+            entries = ["(nothing to show on this page)"]
+        if has_older:
+            entries.append(f"Use /history {page + 1} to see older messages.")
+        header = "📜 Recent messages in this chat:\n" if page == 1 else f"📜 Recent messages in this chat (page {page}):\n"
+        return chunk_entries(entries, header=header)
 
     async def handle_clear(self, event):
         """Handle the /clear command to clear chat history."""
         chat_id = str(event.chat_id)
         if not await self.is_allowed_chat(int(chat_id)):
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
             return
         
         try:
             # Get session for this chat
-            session_id = f"chat_{chat_id}"
             try:
                 sessions = await self.session_service.list_sessions(
                     app_name="dom",
                     user_id=chat_id,
                 )
                 if not sessions.sessions:
-                    await event.respond("No chat history to clear.")
+                    await self._reply(event, "No chat history to clear.")
                     return
-                # session = sessions.sessions[0]
-                if len(sessions.sessions) > 0:
-                    session_oldest = sessions.sessions[-1]
-                    # Delete the oldest session
-                    await self.session_service.delete_session(
-                        app_name="dom",
-                        user_id=chat_id,
-                        session_id=session_oldest.id,
-                    )
-                else:
-                    await event.respond("No chat history to clear.")
+                session_id = sessions.sessions[-1].id
             except Exception as e:
                 logger.error(f"Error getting session: {e}")
-                await event.respond("No chat history to clear.")
+                await self._reply(event, "No chat history to clear.")
                 return
 
-            # Create a new session to clear history
-            await self.session_service.create_session(
+            # Reset the session's events and state to clear history
+            await self.session_service.reset_events(
                 app_name="dom",
                 user_id=chat_id,
                 session_id=session_id,
                 state={
                     "chat_id": chat_id,
-                    "individualisation_prompts": [],
+                    "individualisation_prompts": "",
                     "summary": "No summary available",
                     "sarcasm_level": SARCASTIC_LEVEL,
                     "playfulness_level": PLAYFUL_LEVEL,
@@ -172,36 +161,43 @@ class CommandHandler:
                     "emoji_level": EMOJI_LEVEL,
                 }
             )
-            await event.respond("Chat history has been cleared.")
+            await self._reply(event, "Chat history has been cleared.")
         except Exception as e:
             logger.error(f"Error clearing chat history: {e}")
-            await event.respond("Sorry, I encountered an error while clearing the chat history.")
+            await self._reply(event, "Sorry, I encountered an error while clearing the chat history.")
+
+    async def handle_urgent(self, event, message_handler: Optional[MessageHandler]):
+        """Handle the /urgent command to force the bot back online.
 
-    async def handle_urgent(self, event, message_handler: MessageHandler):
-        """Handle the /urgent command to force the bot back online."""
+        Without a message handler the missed messages are left queued for a chat worker.
+        """
         chat_id = event.chat_id
         if not await self.is_allowed_chat(chat_id):
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
             return
         
         if self.bot_state.is_offline(chat_id):
             # Force bot back online
             queued_messages = self.bot_state.force_online(chat_id)
+            if self.send_scheduler is not None:
+                # Replies to this chat go out ahead of other chats for a while
+                self.send_scheduler.mark_urgent(chat_id)
             
             if queued_messages:
-                await event.respond("I'm back online! What's up? Let's catch up on the messages I missed")
+                await self._reply(event, "I'm back online! What's up? Let's catch up on the messages I missed")
                 # Now process the messages in the context
-                await message_handler.handle_after_idling_messages(event)
+                if message_handler is not None:
+                    await message_handler.handle_after_idling_messages(event)
             else:
-                await event.respond("I'm back online! What's up?")
+                await self._reply(event, "I'm back online! What's up?")
         else:
-            await event.respond("I'm already online! What do you need?")
+            await self._reply(event, "I'm already online! What do you need?")
 
     async def handle_sleep(self, event):
         """Handle the /sleep command to put the bot to sleep for a specified duration."""
         chat_id = event.chat_id
         if not await self.is_allowed_chat(chat_id):
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
             return
 
         # Get the duration from the message
@@ -209,7 +205,7 @@ class CommandHandler:
         parts = message_text.split()
         
         if len(parts) != 2:
-            await event.respond("Please specify a duration in the format: /sleep <duration>\nExample: /sleep 30s, /sleep 5m, /sleep 2h, /sleep 1d")
+            await self._reply(event, "Please specify a duration in the format: /sleep <duration>\nExample: /sleep 30s, /sleep 5m, /sleep 2h, /sleep 1d")
             return
 
         try:
@@ -226,19 +222,19 @@ class CommandHandler:
             else:
                 display_duration = f"{duration // 86400} days"
             
-            await event.respond(f"I'm going to sleep for {display_duration}. Use /urgent to wake me up if needed.")
+            await self._reply(event, f"I'm going to sleep for {display_duration}. Use /urgent to wake me up if needed.")
         except ValueError as e:
-            await event.respond(str(e))
+            await self._reply(event, str(e))
 
     async def handle_status(self, event):
         """Handle the /status command to check if the bot is offline and show last seen time."""
         chat_id = event.chat_id
         if not await self.is_allowed_chat(chat_id):
-            await event.respond("Sorry, I'm not allowed to participate in this chat.")
+            await self._reply(event, "Sorry, I'm not allowed to participate in this chat.")
             return
         
         status_message = self.bot_state.get_status(str(chat_id))
-        await event.respond(status_message)
+        await self._reply(event, status_message)
 
     def _format_time_delta(self, time_diff):
         """Format a timedelta into a human-readable string."""
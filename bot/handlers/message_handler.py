@@ -16,27 +16,111 @@ from bot.config.settings import (
     ENTHUSIASM_LEVEL, 
     SINGLISH_LEVEL, 
     EMOJI_LEVEL, 
-    MAX_OFFLINE_MESSAGES
+    MAX_OFFLINE_MESSAGES,
+    BACKLOG_COMPRESSION,
+    BACKLOG_TOKEN_BUDGET,
+    BOT_NAMES,
+    REPLY_CONTEXT_RECENT,
+    MEMORY_RETRIEVAL,
+    WORKER_CONCURRENCY,
     )
-from bot.config.models import LITELLM_MODE
+from bot.config.models import LITELLM_MODE, MODEL_TURN_DEADLINE, MODEL_OVERLOAD_RETRY_SECONDS
 from google.adk.runners import Runner
-from google.adk.sessions import DatabaseSessionService
+from bot.services.session_service import TokenCountingSessionService
+from google.adk.sessions.base_session_service import GetSessionConfig
 from google.genai import types
 from google.genai.types import Part
-from google.adk.events import Event
+from google.adk.events import Event, EventActions
 from bot.utils.bot_state import BotState
-from agentSummariser import get_summarising_agent
-import json
+from bot.services.model_resilience import ModelOverloadedError, ModelUnavailableError, model_deadline, remaining_time
+from bot.services.summarisation_service import SummarisationService
+from bot.utils.user_profiles import extract_handles, render_profiles_for_prompt
+from bot.utils.backlog_compressor import BacklogCompressor, parse_backlog
+from bot.services.reply_graph import ReplyGraphIndex
+from bot.services.sender_cache import SenderCache
 
 logger = logging.getLogger(__name__)
 
+# Recent session events searched for the message of a failed run before it is resumed
+RESUME_LOOKBACK_EVENTS = 20
+
 class MessageHandler:
-    def __init__(self, bot_state: BotState, command_handler, runner: Runner, session_service: DatabaseSessionService):
+    def __init__(self, bot_state: BotState, command_handler, runner: Runner, session_service: TokenCountingSessionService):
         self.bot_state = bot_state
         self.command_handler = command_handler
         self.runner = runner
         self.session_service = session_service
+        self.summariser = SummarisationService(bot_state, session_service)
+        self.token_estimator = session_service.token_counter.estimator
+        self.backlog_compressor = BacklogCompressor(BACKLOG_COMPRESSION, BACKLOG_TOKEN_BUDGET, BOT_NAMES, self.token_estimator.count,
+                                                    recent=REPLY_CONTEXT_RECENT)
+        # Which message each message replies to, so group backlogs can be cut down to the threads with the bot
+        self.reply_graph = ReplyGraphIndex(bot_state.db)
+        # Names of message senders, so most messages don't have to look their sender up
+        self.sender_cache = SenderCache()
+        # Chats whose session state no longer holds profiles as a list, checked once per process
+        self._legacy_profiles_checked = set()
         self.client = None  # Will be set by main.py
+        self.send_scheduler = None  # Will be set by main.py when this process holds the Telegram connection
+        # False in the ingest process, where agent turns are left to the worker processes
+        self.process_turns = True
+        # References to running turns, the event loop only keeps weak ones
+        self._turns = set()
+        # Turns run at once in this process, like the chats a worker process handles at once
+        self._turn_slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    
+    def _event_for_chat(self, chat_id: str):
+        """Create a stand-in for a Telethon event, for turns that are not triggered by a message."""
+        class MockEvent:
+            def __init__(self, chat_id, client):
+                self.chat_id = int(chat_id)
+                self.client = client
+            
+            async def respond(self, message):
+                # Use the bot's client to send the message
+                if self.client:
+                    await self.client.send_message(self.chat_id, message)
+                else:
+                    logger.error("No client available to send message")
+        
+        return MockEvent(chat_id, self.client)
+    
+    async def _get_or_create_session(self, chat_id: str):
+        """Get the agent session for a chat, creating it with the default state if needed."""
+        try:
+            session = await self.session_service.list_sessions(
+                app_name="dom",
+                user_id=chat_id,
+            )
+            return session.sessions[0]
+        except Exception as e:
+            logger.info(f"Could not find Session, creating new one: {e}")
+            return await self.session_service.create_session(
+                app_name="dom",
+                user_id=chat_id,
+                session_id=f"chat_{chat_id}",
+                state={
+                    "chat_id": chat_id,
+                    "individualisation_prompts": "",
+                    "summary": "No summary available",
+                    "sarcasm_level": SARCASTIC_LEVEL,
+                    "playfulness_level": PLAYFUL_LEVEL,
+                    "humor_level": HUMOR_LEVEL,
+                    "formality_level": FORMALITY_LEVEL,
+                    "empathy_level": EMPATHY_LEVEL,
+                    "enthusiasm_level": ENTHUSIASM_LEVEL,
+                    "singlish_level": SINGLISH_LEVEL,
+                    "emoji_level": EMOJI_LEVEL,
+                }
+            )
+    
+    @staticmethod
+    def _new_messages_note(number_of_messages: int, first_message_id: str) -> str:
+        """Build the system note for a turn answering newly received messages."""
+        # Setting system message to tell Dom what had been happening 
+        system_message = f"System forced me to wake up due to receiving {number_of_messages} total notifications. \n\n" if number_of_messages >= MAX_OFFLINE_MESSAGES else f"Received {number_of_messages} notifications. \n\n"
+        system_message += f"Previous message id: {int(first_message_id)-1}\n" if first_message_id != "-1" else ""
+        return system_message
     
     async def _handle_litellm_session_issue(self, chat_id: str, session_id: str):
         """Handle LiteLLM session issues by recreating the session if needed."""
@@ -54,32 +138,33 @@ class MessageHandler:
             # If session exists but has issues, we might need to clear it
             if session and hasattr(session, 'events') and len(session.events) > 10:
                 logger.warning(f"Session {session_id} has many events, clearing for LiteLLM stability")
-                # Create a new session with the same state but fresh events
-                await self.session_service.delete_session(
-                    app_name="dom",
-                    user_id=chat_id,
-                    session_id=session_id,
-                )
-                
-                # Recreate session with same state
-                await self.session_service.create_session(
+                # Keep the state but start over with fresh events
+                await self.session_service.reset_events(
                     app_name="dom",
                     user_id=chat_id,
                     session_id=session_id,
-                    state=session.state
                 )
                 
         except Exception as e:
             logger.error(f"Error handling LiteLLM session: {e}")
     
     async def _run_agent_with_retry(self, chat_id: str, session_id: str, message, max_retries=3):
-        """Run the agent with retry logic for LiteLLM stability."""
+        """Run the agent, resuming the turn after a failure instead of starting it over.
+        
+        Every event that was yielded has already been saved to the session, so a retry
+        continues from there: the message is not appended a second time and tool calls are
+        not replayed. A resumed run only yields new events, so parts that were already sent
+        are not sent again.
+        """
         for attempt in range(max_retries):
+            new_message = message
+            if attempt > 0 and await self._message_in_session(chat_id, session_id, message):
+                new_message = None
             try:
                 async for event_response in self.runner.run_async(
                     user_id=chat_id,
                     session_id=session_id,
-                    new_message=message,
+                    new_message=new_message,
                 ):
                     yield event_response
                     
@@ -87,22 +172,67 @@ class MessageHandler:
                         break
                 return  # Success, exit retry loop
                 
+            except ModelUnavailableError:
+                # Every endpoint has its circuit open, retrying now would fail the same way
+                raise
             except Exception as e:
                 logger.warning(f"Agent call attempt {attempt + 1} failed: {e}")
                 
                 if LITELLM_MODE and "Internal Server Error" in str(e):
                     # For LiteLLM, try to fix session issues
                     await self._handle_litellm_session_issue(chat_id, session_id)
-                    
-                if attempt == max_retries - 1:
+                
+                remaining = remaining_time()
+                if attempt == max_retries - 1 or (remaining is not None and remaining <= 0):
                     # Last attempt failed, re-raise the exception
                     raise e
-                    
-                # Wait before retry
-                await asyncio.sleep(1 * (attempt + 1))
+                
+                # Exponential back-off with jitter, within what is left of the deadline
+                backoff = 2 ** attempt + random.random()
+                if remaining is not None:
+                    backoff = min(backoff, remaining)
+                await asyncio.sleep(backoff)
+    
+    async def _message_in_session(self, chat_id: str, session_id: str, message) -> bool:
+        """Check whether a failed run already appended the message to the session."""
+        session = await self.session_service.get_session(
+            app_name="dom",
+            user_id=chat_id,
+            session_id=session_id,
+            config=GetSessionConfig(num_recent_events=RESUME_LOOKBACK_EVENTS),
+        )
+        if not session:
+            return False
+        return any(event.author == "user" and event.content == message for event in session.events)
+    
+    async def _delayed_turn(self, event, chat_id: str, session, delay: int):
+        """Answer a chat's queued messages once the processing delay has passed.
+        
+        At most WORKER_CONCURRENCY turns run at once, the others wait for a slot after their delay.
+        """
+        try:
+            # Show typing status during the delay
+            async with event.client.action(event.chat_id, 'typing'):
+                await asyncio.sleep(delay)
+                
+                try:
+                    async with self._turn_slots:
+                        await self._run_queued_turn(event, chat_id, session, self._new_messages_note, "Unread messages:")
+                finally:
+                    # Clear the processing delay once the turn is over, even if it failed
+                    self.bot_state.clear_processing_delay(chat_id)
+        except Exception as e:
+            logger.error(f"Error getting response from agent: {e}")
+            await event.respond("Sorry, I encountered an error while processing your message.")
     
-    async def handle_message(self, event):
-        """Handle incoming messages."""
+    async def handle_message(self, event, schedule_turn: bool = True):
+        """Handle incoming messages.
+        
+        Args:
+            event: The Telethon message event
+            schedule_turn: Whether to schedule a reply, otherwise the message is only queued and
+                answered by the stranded message sweep or a worker process
+        """
         logger.info(f"\n=== New Message Received from {event.chat_id} at {datetime.now().strftime('%d-%m-%Y %I:%M %p')} ===")
         if DEV_MODE:
             logger.info(f"DEV MODE ACTIVE - Only chat {DEV_CHAT_ID} is allowed")
@@ -134,8 +264,8 @@ class MessageHandler:
             # This is not currently stored. 
             message_text = "[Other Media]"
         
-        sender = await event.get_sender()
-        logger.info(f"Sender: {sender.first_name if sender else 'Unknown User'} (@{sender.username if sender else 'Unknown Username'}), Message: {message_text}")
+        sender = await self.sender_cache.get(event)
+        logger.info(f"Sender: {sender.first_name} (@{sender.username}), Message: {message_text}")
         
         # Filtering out all messages that are not text
         if not hasattr(event.message, 'text') or not event.message.text:
@@ -149,40 +279,19 @@ class MessageHandler:
             return
             
         # Get session for this chat
-        session_id = f"chat_{chat_id}"
         try:
-            try:
-                session = await self.session_service.list_sessions(
-                    app_name="dom",
-                    user_id=chat_id,
-                )
-                session = session.sessions[0]
-            except Exception as e:
-                logger.error(f"Could not find Session, creating new one: {e}")
-                session = await self.session_service.create_session(
-                    app_name="dom",
-                    user_id=chat_id,
-                    session_id=session_id,
-                    state={
-                        "chat_id": chat_id,
-                        "individualisation_prompts": [],
-                        "summary": "No summary available",
-                        "sarcasm_level": SARCASTIC_LEVEL,
-                        "playfulness_level": PLAYFUL_LEVEL,
-                        "humor_level": HUMOR_LEVEL,
-                        "formality_level": FORMALITY_LEVEL,
-                        "empathy_level": EMPATHY_LEVEL,
-                        "enthusiasm_level": ENTHUSIASM_LEVEL,
-                        "singlish_level": SINGLISH_LEVEL,
-                        "emoji_level": EMOJI_LEVEL,
-                    }
-                )
+            session = await self._get_or_create_session(chat_id)
 
             # As long as chat is not sleeping, we add the message to the queued messages
             message_id = event.message.id
             reply_to_id = event.message.reply_to_msg_id if hasattr(event.message, 'reply_to_msg_id') else None
-            new_message = f"[{datetime.now().strftime('%d-%m-%Y %I:%M %p')}] {sender.first_name if sender else 'Unknown User'} (@{sender.username if sender else 'Unknown Username'}) [msg_id:{message_id}{f' reply_to:{reply_to_id}' if reply_to_id else ''}]: {message_text}"
+            new_message = f"[{datetime.now().strftime('%d-%m-%Y %I:%M %p')}] {sender.first_name} (@{sender.username}) [msg_id:{message_id}{f' reply_to:{reply_to_id}' if reply_to_id else ''}]: {message_text}"
             number_of_queued_messages = self.bot_state.add_to_queued_messages(chat_id, new_message)
+            self.reply_graph.record(chat_id, message_id, reply_to_id)
+            
+            if not schedule_turn:
+                logger.info(f"Queued message for chat {chat_id} without scheduling a turn")
+                return
             
             # Check if summarization is currently running for this chat
             if self.bot_state.is_summarization_locked(chat_id):
@@ -208,81 +317,16 @@ class MessageHandler:
             delay = int(random.triangular(MIN_RESPONSE_DELAY, MAX_RESPONSE_DELAY, MIN_RESPONSE_DELAY + (MAX_RESPONSE_DELAY - MIN_RESPONSE_DELAY) * 0.20))
             logger.info(f"Setting processing delay of {delay} seconds for chat {chat_id}")
             self.bot_state.set_processing_delay(chat_id, delay)
+            
+            # A worker process picks the chat up once the delay has passed
+            if not self.process_turns:
+                logger.info(f"Queued turn for chat {chat_id} for a worker")
+                return
         
-            # Show typing status during the delay
-            async with event.client.action(event.chat_id, 'typing'):
-                await asyncio.sleep(delay)
-                
-                # Get queued messages
-                queued_messages = self.bot_state.get_queued_messages(chat_id)
-                logger.debug(f"queued_messages: {queued_messages}")
-                
-                # Create message object with context from queued messages
-                logger.info("Creating message object for agent...")
-                try:
-                    # Try to get latest message id to reverse engineer previous message id
-                    try:
-                        first_message_id = queued_messages["messages"].split("msg_id:")[1].split(" ")[0].replace("]:", "")
-                    except Exception as e:
-                        logger.info(f"No previous message id found, setting to 0")
-                        first_message_id = "-1"
-                    
-                    # Setting system message to tell Dom what had been happening 
-                    system_message = f"System forced me to wake up due to receiving {queued_messages["number_of_messages"]} total notifications. \n\n" if queued_messages["number_of_messages"] >= MAX_OFFLINE_MESSAGES else f"Received {queued_messages["number_of_messages"]} notifications. \n\n"
-                    system_message += f"Previous message id: {int(first_message_id)-1}\n" if first_message_id != "-1" else ""
-                    system = types.Content(role="model", parts=[types.Part(text=system_message)])
-                    system_event = Event(author="dom", content=system)
-                    
-                    # Appending system message to session
-                    await self.session_service.append_event(session, system_event)
-                    session = await self.session_service.get_session(
-                        app_name="dom",
-                        user_id=chat_id,
-                        session_id=session_id,
-                    )
-                    
-                    # Creating message object for agent that shows all the unread messages
-                    message = types.Content(role="user", parts=[types.Part(text=f"Unread messages:\n{queued_messages['messages']}")])
-                    logger.debug(f"Message object: {message}")
-                except Exception as e:
-                    logger.error(f"Error creating message object: {e}")
-                    message = types.Content(role="user", parts=[types.Part(text=f"Unread messages:\n{queued_messages['messages']}")])
-                
-                # Get response from agent using runner with retry logic
-                logger.info("Getting response from agent...")
-                event_response = None
-                
-                # Clear queued messages
-                self.bot_state.clear_queued_messages(chat_id)
-                
-                # Use the new retry wrapper for better LiteLLM stability
-                async for event_response in self._run_agent_with_retry(
-                    chat_id=chat_id,
-                    session_id=session_id,
-                    message=message,
-                    max_retries=3 if LITELLM_MODE else 1
-                ):
-                    logger.info(f"Event response received: {event_response}")
-                    
-                    # Check if this event has text content (pre-function call response)
-                    if hasattr(event_response.content, 'parts') and event_response.content.parts:
-                        for part in event_response.content.parts:
-                            await self._parse_and_send_agent_response(event, part)
-                    
-                    if event_response.is_final_response():
-                        logger.debug(f"Final event response received: {event_response.content}")
-                        break
-                else:
-                    raise Exception("No response received from agent")
-                
-                # Clear the processing delay once the agent has responded
-                self.bot_state.clear_processing_delay(chat_id)
-                
-                # Check if input tokens more than the threshold, we will summarise the session
-                input_tokens = event_response.usage_metadata.prompt_token_count
-                logger.info(f"Current Input Tokens used: {input_tokens}")
-                if input_tokens > SUMMARISING_AGENT_TOKEN_THRESHOLD:
-                    await self._handle_session_summary(chat_id, session_id)
+            # The turn runs on its own so the ingest worker can move on to the next update
+            turn = asyncio.create_task(self._delayed_turn(event, chat_id, session, delay))
+            self._turns.add(turn)
+            turn.add_done_callback(self._turns.discard)
                     
         except Exception as e:
             logger.error(f"Error getting response from agent: {e}")
@@ -309,21 +353,7 @@ class MessageHandler:
         # Handle both event and chat_id inputs
         if isinstance(chat_id_or_event, str):
             chat_id = chat_id_or_event
-            
-            # Create a mock event with the chat_id
-            class MockEvent:
-                def __init__(self, chat_id, client):
-                    self.chat_id = int(chat_id)
-                    self.client = client
-                
-                async def respond(self, message):
-                    # Use the bot's client to send the message
-                    if self.client:
-                        await self.client.send_message(self.chat_id, message)
-                    else:
-                        logger.error("No client available to send message")
-            
-            event = MockEvent(chat_id, self.client)
+            event = self._event_for_chat(chat_id)
         else:
             event = chat_id_or_event
             chat_id = str(event.chat_id)
@@ -361,111 +391,264 @@ class MessageHandler:
             return
         
         # Get or create session for this chat
-        session_id = f"chat_{chat_id}"
-        try:
-            session = await self.session_service.list_sessions(
-                app_name="dom",
-                user_id=chat_id,
-            )
-            session = session.sessions[0]
-        except Exception as e:
-            logger.info(f"Could not find Session, creating new one: {e}")
-            session = await self.session_service.create_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session_id,
-                state={
-                    "chat_id": chat_id,
-                    "individualisation_prompts": [],
-                    "summary": "No summary available",
-                    "sarcasm_level": SARCASTIC_LEVEL,
-                    "playfulness_level": PLAYFUL_LEVEL,
-                    "humor_level": HUMOR_LEVEL,
-                    "formality_level": FORMALITY_LEVEL,
-                    "empathy_level": EMPATHY_LEVEL,
-                    "enthusiasm_level": ENTHUSIASM_LEVEL,
-                    "singlish_level": SINGLISH_LEVEL,
-                    "emoji_level": EMOJI_LEVEL,
-                }
-            )
+        session = await self._get_or_create_session(chat_id)
 
-        # Create message object with context from queued messages
-        logger.info("Creating message object for agent...")
-        try:
-            # Try to get latest message id to reverse engineer previous message id
-            try:
-                first_message_id = queued_messages["messages"].split("msg_id:")[1].split(" ")[0].replace("]:", "")
-            except Exception as e:
-                logger.info(f"No previous message id found, setting to 0")
-                first_message_id = "-1"
-            
-            # Setting system message to tell Dom what had been happening 
-            system_message = ""
+        # Setting system message to tell Dom what had been happening 
+        def build_system_message(number_of_messages: int, first_message_id: str) -> str:
             if urgent_messages:
                 system_message = f"User called me urgently, forcing me to wake up. \n\n"
             elif after_summarization:
                 system_message = f"Summarisation just finished. \n\n"
             else:
                 system_message = f"I just came back online. \n\n"
-            
-            # Setting system message to tell Dom what had been happening 
-            system_message += f"Received {queued_messages['number_of_messages']} notifications. \n\n" if queued_messages['number_of_messages'] != 0 else ""
+            system_message += f"Received {number_of_messages} notifications. \n\n" if number_of_messages != 0 else ""
             system_message += f"Previous message id: {int(first_message_id)-1}\n The following are the unread messages:\n" if first_message_id != "-1" else ""
-            system = types.Content(role="model", parts=[types.Part(text=system_message)])
-            system_event = Event(author="dom", content=system)
-            
-            # Appending system message to session
-            await self.session_service.append_event(session, system_event)
-            session = await self.session_service.get_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session_id,
-            )   
-            
-            # Creating message object for agent that shows all the unread messages
-            message = types.Content(role="user", parts=[types.Part(text=f"Messages:\n{queued_messages['messages']}")])
-            logger.debug(f"Message object: {message}")
-        except Exception as e:
-            logger.error(f"Error creating message object: {e}")
-            message = types.Content(role="user", parts=[types.Part(text=f"Messages:\n{queued_messages['messages']}")])
+            return system_message
         
-        # Get response from agent using runner with retry logic
-        logger.info("Getting response from agent...")
+        async with event.client.action(event.chat_id, 'typing'):
+            await self._run_queued_turn(event, chat_id, session, build_system_message, "Messages:")
+
+        if after_summarization:
+            logger.info("=== After Summarization Messages Processing Complete ===\n")
+        else:
+            logger.info("=== After Idling / Urgent Messages Processing Complete ===\n")
+    
+    async def _run_queued_turn(self, event, chat_id: str, session, build_system_message, message_header: str) -> bool:
+        """Run one agent turn over the queued messages of a chat.
         
-        # Clear queued messages
-        self.bot_state.clear_queued_messages(chat_id)
+        The messages are claimed under a lease and only acknowledged once every reply has been
+        sent. A failed turn releases them for another attempt, and if the process dies they are
+        handed out again when the lease expires. A turn shed because the model endpoint is
+        overloaded is deferred: its messages are held back for MODEL_OVERLOAD_RETRY_SECONDS
+        without counting a delivery, and no error is shown in the chat.
         
-        # Use the new retry wrapper for better LiteLLM stability
-        async with event.client.action(event.chat_id, 'typing'):
-            async for event_response in self._run_agent_with_retry(
-                chat_id=chat_id,
-                session_id=session_id,
-                message=message,
-                max_retries=3 if LITELLM_MODE else 1
-            ):
-                logger.info(f"Event response received: {event_response}")
+        Args:
+            event: The event used to send the replies
+            chat_id: The chat ID
+            session: The chat's agent session
+            build_system_message: Builds the system note for the turn from the number of
+                messages and the id of the first one
+            message_header: First line of the user message that lists the queued messages
+        
+        Returns:
+            False if there were no queued messages to process or the turn was deferred
+        """
+        session_id = f"chat_{chat_id}"
+        
+        # Summarise first when the prompt would already be over the threshold, rather than
+        # paying for an oversized turn and summarising after it
+        pending_messages = self._compress_backlog(chat_id, self.bot_state.get_queued_messages(chat_id)["messages"])
+        session_tokens = await self.session_service.get_token_count("dom", chat_id, session_id)
+        estimated_tokens = self.token_estimator.estimate_prompt(session_tokens + self.token_estimator.count(pending_messages))
+        if estimated_tokens > SUMMARISING_AGENT_TOKEN_THRESHOLD:
+            logger.info(f"Estimated {estimated_tokens} input tokens for chat {chat_id}, summarising before the turn")
+            session = await self._summarise_before_turn(chat_id, session_id) or session
+        
+        batch = self.bot_state.claim_queued_messages(chat_id)
+        if batch is None:
+            logger.info(f"No unclaimed messages in queue for chat {chat_id}, nothing to process")
+            return False
+        logger.debug(f"queued_messages: {batch}")
+        
+        try:
+            # Create message object with context from queued messages
+            logger.info("Creating message object for agent...")
+            try:
+                # Try to get latest message id to reverse engineer previous message id
+                try:
+                    first_message_id = batch["messages"].split("msg_id:")[1].split(" ")[0].replace("]:", "")
+                except Exception as e:
+                    logger.info(f"No previous message id found, setting to 0")
+                    first_message_id = "-1"
                 
-                # Check if this event has text content (pre-function call response)
-                if hasattr(event_response.content, 'parts') and event_response.content.parts:
-                    for part in event_response.content.parts:
-                        await self._parse_and_send_agent_response(event, part)
+                system = types.Content(role="model", parts=[types.Part(text=build_system_message(batch["number_of_messages"], first_message_id))])
+                # Only the profiles of the users in this batch and the memories relevant to it go into the prompt
+                state_delta = {"individualisation_prompts": await self._render_batch_profiles(chat_id, session, batch["messages"])}
+                if MEMORY_RETRIEVAL:
+                    state_delta["memories"] = self._render_batch_memories(chat_id, batch["messages"])
+                system_event = Event(
+                    author="dom",
+                    content=system,
+                    actions=EventActions(state_delta=state_delta),
+                )
                 
-                if event_response.is_final_response():
-                    logger.debug(f"Final event response received: {event_response.content}")
-                    break
-            else:
-                raise Exception("No response received from agent")
+                # Appending system message to session
+                await self.session_service.append_event(session, system_event)
+            except Exception as e:
+                logger.error(f"Error creating message object: {e}")
+            
+            # Creating message object for agent that shows all the unread messages
+            # Large backlogs are cut down to the token budget, see BACKLOG_COMPRESSION
+            message = types.Content(role="user", parts=[types.Part(text=f"{message_header}\n{self._compress_backlog(chat_id, batch['messages'])}")])
+            logger.debug(f"Message object: {message}")
+            
+            # Get response from agent using runner with retry logic
+            logger.info("Getting response from agent...")
+            event_response = None
             
-            # Check if we need to summarise the session
+            # The retry wrapper resumes a failed run, and the deadline bounds the whole turn
+            with model_deadline(MODEL_TURN_DEADLINE):
+                async for event_response in self._run_agent_with_retry(
+                    chat_id=chat_id,
+                    session_id=session_id,
+                    message=message,
+                ):
+                    logger.info(f"Event response received: {event_response}")
+                    
+                    # Check if this event has text content (pre-function call response)
+                    if hasattr(event_response.content, 'parts') and event_response.content.parts:
+                        for part in event_response.content.parts:
+                            await self._parse_and_send_agent_response(event, part)
+                    
+                    if event_response.is_final_response():
+                        logger.debug(f"Final event response received: {event_response.content}")
+                        self._calibrate_token_estimate(session_id, event_response)
+                        break
+                else:
+                    raise Exception("No response received from agent")
+        except ModelOverloadedError as e:
+            # Shed before reaching the model, the turn is deferred rather than failed and the
+            # chat is picked up again once the messages are no longer held back
+            logger.warning(f"Turn for chat {chat_id} was shed, retrying in {MODEL_OVERLOAD_RETRY_SECONDS}s: {e}")
+            self.bot_state.release_queued_messages(batch["token"], failed=False, retry_after_seconds=MODEL_OVERLOAD_RETRY_SECONDS)
+            return False
+        except asyncio.CancelledError:
+            # Cut short, which is not a failed delivery
+            self.bot_state.release_queued_messages(batch["token"], failed=False)
+            raise
+        except BaseException:
+            # The batch goes back to the queue for the next turn
+            self.bot_state.release_queued_messages(batch["token"])
+            raise
+        
+        # The reply has been sent, so the messages are done with
+        self.bot_state.ack_queued_messages(batch["token"])
+        
+        # Check if input tokens more than the threshold, we will summarise the session
+        if event_response.usage_metadata is not None and event_response.usage_metadata.prompt_token_count:
             input_tokens = event_response.usage_metadata.prompt_token_count
-            logger.info(f"Current Input Tokens used: {input_tokens}")
-            if input_tokens > SUMMARISING_AGENT_TOKEN_THRESHOLD:
-                await self._handle_session_summary(chat_id, session_id)
-
-        if after_summarization:
-            logger.info("=== After Summarization Messages Processing Complete ===\n")
         else:
-            logger.info("=== After Idling / Urgent Messages Processing Complete ===\n")
+            # LiteLLM responses do not always report usage, fall back to the local count
+            input_tokens = self.token_estimator.estimate_prompt(self.session_service.token_counter.get(session_id) or 0)
+        logger.info(f"Current Input Tokens used: {input_tokens}")
+        if input_tokens > SUMMARISING_AGENT_TOKEN_THRESHOLD:
+            await self._handle_session_summary(chat_id, session_id)
+        return True
+    
+    def _calibrate_token_estimate(self, session_id: str, final_event: Event):
+        """Calibrate the local token estimate against the prompt size the model reported."""
+        usage = final_event.usage_metadata
+        session_tokens = self.session_service.token_counter.get(session_id)
+        if usage is None or not usage.prompt_token_count or session_tokens is None:
+            return
+        # The final event was already appended, but it was not part of the prompt
+        self.token_estimator.calibrate(session_tokens - self.token_estimator.count_event(final_event), usage.prompt_token_count)
+    
+    def _compress_backlog(self, chat_id: str, messages: str) -> str:
+        """Compress queued messages for the prompt, see BACKLOG_COMPRESSION."""
+        try:
+            reply_graph = self.reply_graph.get(chat_id)
+        except Exception as e:
+            logger.error(f"Error loading the reply graph of chat {chat_id}: {e}")
+            reply_graph = None
+        # Telegram uses negative ids for groups
+        return self.backlog_compressor.compress(messages, reply_graph=reply_graph, group_chat=int(chat_id) < 0)
+
+    async def _import_legacy_profiles(self, chat_id: str, session_id: str):
+        """Move the profiles of a session from before profiles were stored per user out of its state.
+        
+        The rendered profiles replace them in the state on the next turn, so this has to run
+        first. Sessions found by listing come without their state, so it is read here.
+        """
+        if chat_id in self._legacy_profiles_checked:
+            return
+        session = await self.session_service.get_session(
+            app_name="dom",
+            user_id=chat_id,
+            session_id=session_id,
+            config=GetSessionConfig(num_recent_events=1),
+        )
+        legacy_profiles = session.state.get("individualisation_prompts") if session else None
+        if isinstance(legacy_profiles, list) and legacy_profiles:
+            # Raises if they can't be saved, so the list is not overwritten before it was imported
+            self.summariser.import_legacy_profiles(chat_id, legacy_profiles)
+        self._legacy_profiles_checked.add(chat_id)
+
+    async def _render_batch_profiles(self, chat_id: str, session, messages: str) -> str:
+        """Render the profiles of the users who sent or are mentioned in a batch of messages."""
+        await self._import_legacy_profiles(chat_id, session.id)
+        try:
+            profiles = self.bot_state.get_user_profiles(chat_id, extract_handles(messages))
+        except Exception as e:
+            logger.error(f"Error getting user profiles for chat {chat_id}: {e}")
+            profiles = []
+        return render_profiles_for_prompt(profiles)
+
+    def _render_batch_memories(self, chat_id: str, messages: str) -> str:
+        """Render the long-term memories of a chat most relevant to a batch of messages."""
+        # Match on who said what, the headers' times and message ids would only add noise
+        query = "\n".join(f"{message.sender} {message.text}" for message in parse_backlog(messages)) or messages
+        try:
+            return self.summariser.memory_store.render_for_prompt(chat_id, query)
+        except Exception as e:
+            logger.error(f"Error searching memories for chat {chat_id}: {e}")
+            return "No relevant memories"
+
+    async def _summarise_before_turn(self, chat_id: str, session_id: str):
+        """Summarise a session ahead of a turn.
+        
+        Returns:
+            The new session, or None if the session was left as it was
+        """
+        if not self.bot_state.set_summarization_lock(chat_id):
+            logger.warning(f"Summarization lock already exists for chat {chat_id}, skipping summarization")
+            return None
+        try:
+            await self.summariser.summarise_session(chat_id, session_id)
+        except Exception as e:
+            logger.error(f"Error summarising session for chat {chat_id} before the turn: {e}")
+            return None
+        finally:
+            self.bot_state.clear_summarization_lock(chat_id)
+        return await self._get_or_create_session(chat_id)
+    
+    async def resume_pending_chats(self, chat_ids: list):
+        """Process chats whose queued messages were left unanswered, one chat at a time."""
+        for chat_id in chat_ids:
+            # Offline chats are picked up by the offline to online transition instead
+            if self.bot_state.is_offline(str(chat_id)) or self.bot_state.is_sleeping(str(chat_id)):
+                continue
+            logger.info(f"Resuming queued messages for chat {chat_id}")
+            try:
+                await self.handle_after_idling_messages(str(chat_id))
+            except Exception as e:
+                logger.error(f"Error resuming queued messages for chat {chat_id}: {e}")
+    
+    async def process_chat(self, chat_id: str):
+        """Answer a chat's queued messages in a worker process.
+        
+        When the ingest process scheduled a reply (a processing delay is set) this finishes
+        what handle_message started. Otherwise the messages were left over, e.g. while the
+        chat was offline, and are handled like messages received while idling.
+        """
+        if self.bot_state.get_processing_delay(chat_id) is None:
+            await self.handle_after_idling_messages(chat_id)
+            return
+        
+        if self.bot_state.is_summarization_locked(chat_id):
+            logger.info(f"Summarization is currently running for chat {chat_id}, messages will be processed after it")
+            return
+        
+        event = self._event_for_chat(chat_id)
+        try:
+            session = await self._get_or_create_session(chat_id)
+            async with event.client.action(event.chat_id, 'typing'):
+                await self._run_queued_turn(event, chat_id, session, self._new_messages_note, "Unread messages:")
+        except Exception as e:
+            logger.error(f"Error getting response from agent: {e}")
+            await event.respond("Sorry, I encountered an error while processing your message.")
+        finally:
+            self.bot_state.clear_processing_delay(chat_id)
     
     async def _parse_and_send_agent_response(self, event, part: Part):
         """Parse the agent response and return the messages to be sent."""
@@ -486,11 +669,13 @@ class MessageHandler:
         for msg in messages:
             logger.info(f"msg: {msg}")
             if msg.strip():  # Only send non-empty messages
-                # Send the response
-                await event.respond(msg.strip())
+                # Send the response, the scheduler keeps a natural delay between messages
+                if self.send_scheduler is not None:
+                    await self.send_scheduler.send(event.chat_id, msg.strip())
+                else:
+                    # Worker processes only queue the message, the ingest process schedules it
+                    await event.respond(msg.strip())
                 logger.info(f"Response sent successfully: {msg.strip()}")
-                # Add a small delay between messages to make it feel more natural
-                await asyncio.sleep(random.triangular(1, 4, 3))
         
 
     async def _handle_session_summary(self, chat_id: str, session_id: str):
@@ -506,170 +691,7 @@ class MessageHandler:
             return
         
         try:
-            logger.info(f"Starting session summarization for chat {chat_id}")
-            
-            # Get the history
-            history = await self.session_service.get_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session_id,
-            )
-            # Build the history string
-            # Store state in a temporary variable
-            temp_state = history.state
-            # Get the summary
-            summary = temp_state["summary"]
-            # Get the individualisation prompts
-            individualisation_prompts = temp_state["individualisation_prompts"]
-            # Get the sarcasm level
-            sarcasm_level = temp_state["sarcasm_level"]
-            # Get the playfulness level
-            playfulness_level = temp_state["playfulness_level"]
-            # Get the humor level
-            humor_level = temp_state["humor_level"]
-            # Get the formality level
-            formality_level = temp_state["formality_level"]
-            # Get the empathy level
-            empathy_level = temp_state["empathy_level"]
-            # Get the enthusiasm level
-            enthusiasm_level = temp_state["enthusiasm_level"]
-            # Get the singlish level
-            singlish_level = temp_state["singlish_level"]
-            # Get the emoji level
-            emoji_level = temp_state["emoji_level"]
-            
-            # Build the history string
-            history_string = "This section is the current state of the agent:\n"
-            history_string += f"Summary: {summary}\n\n"
-            history_string += f"User information: {individualisation_prompts}\n\n"
-            history_string += f"Sarcasm level: {sarcasm_level}\n"
-            history_string += f"Playfulness level: {playfulness_level}\n"
-            history_string += f"Humor level: {humor_level}\n"
-            history_string += f"Formality level: {formality_level}\n"
-            history_string += f"Empathy level: {empathy_level}\n"
-            history_string += f"Enthusiasm level: {enthusiasm_level}\n"
-            history_string += f"Singlish level: {singlish_level}\n"
-            history_string += f"Emoji level: {emoji_level}\n"
-            
-            history_string += "\n\nThis section is the history of the conversation:\n"
-            for historyEvent in history.events:
-                if historyEvent.author == "user":
-                    # Check if it is a function call
-                    if historyEvent.content.parts[0].function_call:
-                        history_string += f"Function called: {historyEvent.content.parts[0].function_call.name}\n"
-                        history_string += f"Function response: {historyEvent.content.parts[0].function_call.response}\n"
-                        continue
-                    # Extract just the text portion from the content
-                    content_text = historyEvent.content.parts[0].text if hasattr(historyEvent.content, 'parts') else historyEvent.content
-                    history_string += f"User(s): {content_text}\n"
-                elif historyEvent.author == "dom":
-                    # Handle multiple parts if they exist
-                    if hasattr(historyEvent.content, 'parts'):
-                        content_texts = []
-                        for part in historyEvent.content.parts:
-                            if part.function_call != None:
-                                content_texts.append(f"Function called: {part.function_call.name}\n")
-                                content_texts.append(f"Function arguments: {part.function_call.args}\n")
-                                continue
-                            if part.function_response != None:
-                                content_texts.append(f"Function called: {part.function_response.name}\n")
-                                content_texts.append(f"Function response: {part.function_response.response}\n")
-                                continue
-                            if hasattr(part, 'text'):
-                                if part.text == None:
-                                    print(part)
-                                    continue  # Skip this part if text is None
-                                content_texts.append(part.text)
-                        content_text = "\n".join(content_texts)
-                    else:
-                        content_text = historyEvent.content
-                    
-                    # Ensure content_text is not None before calling replace
-                    if content_text is not None:
-                        history_string += f"Dom: {content_text.replace('%next_message%', '\n').replace('%no_response%', '')}\n"
-                    else:
-                        history_string += f"Dom: [No content]\n"
-            
-            # Send the history to an agent to summarise and generate the individualisation prompts
-            self_destruct_session_id = f"self_destruct_{chat_id}"
-            summarising_agent_runner = Runner(
-                agent=get_summarising_agent(),
-                app_name="summarising_agent",
-                session_service=self.session_service,
-            )
-            await self.session_service.delete_session(
-                app_name="summarising_agent",
-                user_id=chat_id,
-                session_id=self_destruct_session_id,
-            )
-            session = await self.session_service.create_session(
-                app_name="summarising_agent",
-                user_id=chat_id,
-                session_id=self_destruct_session_id,
-            )
-            async for event_response in summarising_agent_runner.run_async(
-                user_id=chat_id,
-                session_id=self_destruct_session_id,
-                new_message=types.Content(role="user", parts=[types.Part(text=history_string)]),
-            ):
-                if event_response.is_final_response():
-                    summary = event_response.content.parts[0].text
-                    # This is a json string, we need to parse it according to the pydantic model defined in the agent
-                    summary = json.loads(summary)
-                    logger.info(f"Summary: {summary['summary']}")
-                    logger.info(f"User information: {summary['user_information']}")
-                    logger.info(f"Chat parameters: {summary['chat_parameters']}")
-                    break
-
-            # Delete the summarising agent session
-            await self.session_service.delete_session(
-                app_name="summarising_agent",
-                user_id=chat_id,
-                session_id=self_destruct_session_id,
-            )
-            
-            # Delete the current session
-            await self.session_service.delete_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session_id,
-            )
-            
-            individualisation_prompts = []
-            # Build user information prompts into a string
-            for user_information in summary['user_information']:
-                user_info = f"Telegram Handle: {user_information['telegram_handle']}\n"
-                user_info += f"Telegram Name: {user_information['telegram_name']}\n"
-                user_info += f"Preferred Name: {user_information['preferred_name']}\n"
-                user_info += f"Habits and Style: {user_information['habits_and_style']}\n"
-                user_info += f"Communication Preferences: {user_information['communication_preferences']}\n"
-                user_info += f"Special Notes: {user_information['special_notes']}\n"
-                individualisation_prompts.append(user_info)
-            
-            chat_parameters = summary.get('chat_parameters', {'sarcasm_level': 0.5, 'playfulness_level': 0.5, 'humor_level': 0.5, 'formality_level': 0.5, 'empathy_level': 0.5, 'enthusiasm_level': 0.5, 'singlish_level': 0.5, 'emoji_level': 0.5})
-            
-            # Update history state with the new summary and individualisation prompts
-            temp_state["summary"] = summary['summary']
-            temp_state["individualisation_prompts"] = individualisation_prompts
-            temp_state["sarcasm_level"] = chat_parameters['sarcasm_level']
-            temp_state["playfulness_level"] = chat_parameters['playfulness_level']
-            temp_state["humor_level"] = chat_parameters['humor_level']
-            temp_state["formality_level"] = chat_parameters['formality_level']
-            temp_state["empathy_level"] = chat_parameters['empathy_level']
-            temp_state["enthusiasm_level"] = chat_parameters['enthusiasm_level']
-            temp_state["singlish_level"] = chat_parameters['singlish_level']
-            temp_state["emoji_level"] = chat_parameters['emoji_level']
-            
-            # Create a new session with the updated state
-            await self.session_service.create_session(
-                app_name="dom",
-                user_id=chat_id,
-                session_id=session_id,
-                state=temp_state,
-            )
-            
-            logger.info(f"Session summarization completed for chat {chat_id}")
-            
+            await self.summariser.summarise_session(chat_id, session_id)
         finally:
             # Clear summarization lock
             try:
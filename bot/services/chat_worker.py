@@ -0,0 +1,70 @@
+import os
+import socket
+import asyncio
+import logging
+from typing import Dict
+from bot.config.settings import WORKER_CONCURRENCY, WORKER_POLL_INTERVAL
+from bot.utils.bot_state import BotState
+
+logger = logging.getLogger(__name__)
+
+class ChatWorker:
+    """Runs agent turns for chats with queued messages in a process without a Telegram connection.
+
+    Chats are owned through leases in chat_leases, so any number of worker processes can share
+    one database without two of them answering the same chat at once.
+    """
+
+    def __init__(self, bot_state: BotState, message_handler, concurrency: int = WORKER_CONCURRENCY,
+                 poll_interval: float = WORKER_POLL_INTERVAL):
+        self.bot_state = bot_state
+        self.message_handler = message_handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._active: Dict[str, asyncio.Task] = {}
+
+    async def run(self):
+        """Claim and process chats until cancelled."""
+        logger.info(f"Chat worker {self.owner} started, handling up to {self.concurrency} chats at once")
+        try:
+            while True:
+                try:
+                    self._claim_chats()
+                except Exception as e:
+                    logger.error(f"Error claiming chats: {e}")
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            for task in self._active.values():
+                task.cancel()
+            await asyncio.gather(*self._active.values(), return_exceptions=True)
+
+    def _claim_chats(self):
+        if len(self._active) >= self.concurrency:
+            return
+        # Chats with a future processing delay or a running turn are left out by the query
+        for chat_id in self.bot_state.get_stranded_chats():
+            if len(self._active) >= self.concurrency:
+                break
+            if chat_id in self._active:
+                continue
+            # Messages of offline and sleeping chats wait until the chat comes back online, and
+            # the turn that holds a summarization lock picks up what arrived during it
+            if self.bot_state.is_offline(chat_id) or self.bot_state.is_sleeping(chat_id) or self.bot_state.is_summarization_locked(chat_id):
+                continue
+            if not self.bot_state.acquire_chat_lease(chat_id, self.owner):
+                continue
+            self._active[chat_id] = asyncio.create_task(self._process_chat(chat_id))
+
+    async def _process_chat(self, chat_id: str):
+        try:
+            logger.info(f"Worker {self.owner} processing chat {chat_id}")
+            await self.message_handler.process_chat(chat_id)
+        except Exception as e:
+            logger.error(f"Error processing chat {chat_id}: {e}")
+        finally:
+            self._active.pop(chat_id, None)
+            try:
+                self.bot_state.release_chat_lease(chat_id, self.owner)
+            except Exception as e:
+                logger.error(f"Error releasing chat lease for {chat_id}: {e}")
@@ -1,12 +1,16 @@
 from datetime import datetime, timedelta
 from typing import Optional
 import logging
+import uuid
 import random
 import asyncio
-from sqlalchemy import create_engine, Column, String, DateTime, Text, Boolean, Integer
+from sqlalchemy import Column, String, Text, Boolean, Integer, LargeBinary, Index, or_, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from bot.config.settings import DB_URL, WAKE_UP_TIME, SLEEP_TIME, MIN_OFFLINE_TIME, MAX_OFFLINE_TIME, MIN_ONLINE_TIME, MAX_ONLINE_TIME, DEV_MODE, DEV_CHAT_ID
+from bot.config.settings import DB_URL, WAKE_UP_TIME, SLEEP_TIME, MIN_OFFLINE_TIME, MAX_OFFLINE_TIME, MIN_ONLINE_TIME, MAX_ONLINE_TIME, DEV_MODE, DEV_CHAT_ID, QUEUE_LEASE_SECONDS, QUEUE_MAX_DELIVERIES
+from bot.utils.time_utils import now, in_time_window, next_time_of_day
+from bot.utils.db_engine import get_engine, ensure_tables, dialect_insert
+from bot.utils.db_types import TZDateTime
 
 logger = logging.getLogger(__name__)
 Base = declarative_base()
@@ -16,45 +20,155 @@ class ChatState(Base):
     
     chat_id = Column(String, primary_key=True)
     is_sleeping = Column(Boolean, default=False)
-    sleep_until = Column(DateTime, nullable=True)
+    sleep_until = Column(TZDateTime, nullable=True)
     is_offline = Column(Boolean, default=False)
-    offline_until = Column(DateTime, nullable=True)
-    online_until = Column(DateTime, nullable=True)
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    offline_until = Column(TZDateTime, nullable=True)
+    online_until = Column(TZDateTime, nullable=True)
+    created_at = Column(TZDateTime, default=now)
+    updated_at = Column(TZDateTime, default=now, onupdate=now)
+
+    __table_args__ = (
+        Index('ix_chat_states_sleep_until', 'sleep_until'),
+        Index('ix_chat_states_offline_until', 'offline_until'),
+        Index('ix_chat_states_online_until', 'online_until'),
+    )
 
 class ProcessingDelay(Base):
     __tablename__ = 'processing_delays'
     
     chat_id = Column(String, primary_key=True)
-    delay_until = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.now)
+    delay_until = Column(TZDateTime, nullable=False)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_processing_delays_delay_until', 'delay_until'),
+    )
+
+class QueuedMessage(Base):
+    __tablename__ = 'queued_messages'
+    
+    # One row per incoming message, claimed under a lease while a turn is answering it
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    claim_token = Column(String(32), nullable=True)
+    claimed_until = Column(TZDateTime, nullable=True)
+    delivery_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_queued_messages_chat_id_id', 'chat_id', 'id'),
+        Index('ix_queued_messages_claim_token', 'claim_token'),
+    )
+
+class DeadLetterMessage(Base):
+    __tablename__ = 'dead_letter_messages'
+    
+    # Queued messages whose turns kept failing, kept for inspection instead of being deleted
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    queued_message_id = Column(Integer, nullable=False)
+    chat_id = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    delivery_count = Column(Integer, nullable=False)
+    queued_at = Column(TZDateTime, nullable=True)
+    dropped_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_dead_letter_messages_chat_id', 'chat_id'),
+    )
+
+class ChatLease(Base):
+    __tablename__ = 'chat_leases'
+    
+    # The worker process that currently owns a chat, so only one runs turns for it at a time
+    chat_id = Column(String, primary_key=True)
+    owner = Column(String(100), nullable=False)
+    leased_until = Column(TZDateTime, nullable=False)
+
+class OutboundMessage(Base):
+    __tablename__ = 'outbound_messages'
+    
+    # Replies written by workers and sent by the ingest process, which owns the Telegram connection
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    claimed_until = Column(TZDateTime, nullable=True)  # also used to back off failed sends
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_outbound_messages_claimed_until', 'claimed_until'),
+    )
+
+class ReplyEdge(Base):
+    __tablename__ = 'reply_edges'
+    
+    # Which message each message of a chat replies to, and whether the bot sent it
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    parent_id = Column(Integer, nullable=True)
+    from_bot = Column(Boolean, nullable=False, default=False)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_reply_edges_chat_id_message_id', 'chat_id', 'message_id', unique=True),
+        Index('ix_reply_edges_chat_id_id', 'chat_id', 'id'),
+        Index('ix_reply_edges_created_at', 'created_at'),
+    )
 
-class MessageQueue(Base):
-    __tablename__ = 'message_queues'
+class UserProfile(Base):
+    __tablename__ = 'user_profiles'
     
+    # What the summarising agent knows about each user of a chat, keyed by lowercased handle without the @
     chat_id = Column(String, primary_key=True)
-    messages = Column(Text)
-    number_of_messages = Column(Integer, default=0)
-    created_at = Column(DateTime, default=datetime.now)
-    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    handle = Column(String, primary_key=True)
+    telegram_name = Column(Text, nullable=True)
+    preferred_name = Column(Text, nullable=True)
+    habits_and_style = Column(Text, nullable=True)
+    communication_preferences = Column(Text, nullable=True)
+    special_notes = Column(Text, nullable=True)
+    updated_at = Column(TZDateTime, default=now, onupdate=now)
+
+USER_PROFILE_FIELDS = ('telegram_name', 'preferred_name', 'habits_and_style', 'communication_preferences', 'special_notes')
+
+class Memory(Base):
+    __tablename__ = 'memories'
+    
+    # Summary fragments and facts of a chat, with their embedding as float32 bytes
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # "summary" or "fact"
+    text = Column(Text, nullable=False)
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_memories_chat_id_id', 'chat_id', 'id'),
+    )
 
 class SummarizationLock(Base):
     __tablename__ = 'summarization_locks'
     
     chat_id = Column(String, primary_key=True)
-    locked_at = Column(DateTime, default=datetime.now)
-    created_at = Column(DateTime, default=datetime.now)
+    locked_at = Column(TZDateTime, default=now)
+    created_at = Column(TZDateTime, default=now)
+
+    __table_args__ = (
+        Index('ix_summarization_locks_locked_at', 'locked_at'),
+    )
 
 class DatabaseService:
-    def __init__(self):
-        self.engine = create_engine(DB_URL)
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else get_engine(DB_URL)
         self.Session = sessionmaker(bind=self.engine)
-        Base.metadata.create_all(self.engine)
+        # Postgres or SQLite INSERT, for upserts
+        self.insert = dialect_insert(self.engine)
+        ensure_tables(Base.metadata, self.engine)
 
     def _initialize_chat_state(self, chat_id: str) -> ChatState:
         """Initialize a new chat state with default values."""
-        current_time = datetime.now()
+        current_time = now()
         online_time = int(random.triangular(MIN_ONLINE_TIME, MAX_ONLINE_TIME, MAX_ONLINE_TIME - (MAX_ONLINE_TIME - MIN_ONLINE_TIME) * 0.2))
         return ChatState(
             chat_id=str(chat_id),
@@ -118,7 +232,7 @@ class DatabaseService:
             session.refresh(chat_state)
             if not chat_state.is_sleeping:
                 return False
-            if chat_state.sleep_until and datetime.now() >= chat_state.sleep_until:
+            if chat_state.sleep_until and now() >= chat_state.sleep_until:
                 # Auto-wake up if sleep time is over
                 self.set_chat_state(str(chat_id), is_sleeping=False, sleep_until=None)
                 return False
@@ -138,7 +252,7 @@ class DatabaseService:
                 session.commit()
                 return False
 
-            current_time = datetime.now()
+            current_time = now()
             session.refresh(chat_state)
 
             # Handle sleep state transition
@@ -165,11 +279,11 @@ class DatabaseService:
             # Handle online state transition
             if not chat_state.is_offline and chat_state.online_until and current_time >= chat_state.online_until:
                 chat_state.is_offline = True
-                time_to_sleep = datetime.now().time().replace(hour=SLEEP_TIME.hour, minute=SLEEP_TIME.minute, second=SLEEP_TIME.second)
-                time_to_wake_up = datetime.now().time().replace(hour=WAKE_UP_TIME.hour, minute=WAKE_UP_TIME.minute, second=WAKE_UP_TIME.second)
-                if datetime.now().time() > time_to_sleep or datetime.now().time() < time_to_wake_up:
+                if in_time_window(SLEEP_TIME, WAKE_UP_TIME, current_time):
                     offline_time = int(random.triangular(MIN_OFFLINE_TIME, MAX_OFFLINE_TIME, MAX_OFFLINE_TIME - (MAX_OFFLINE_TIME - MIN_OFFLINE_TIME) * 0.2))
-                    wake_up_time = datetime.now().replace(hour=WAKE_UP_TIME.hour, minute=WAKE_UP_TIME.minute, second=WAKE_UP_TIME.second)
+                    # The next WAKE_UP_TIME, which is tomorrow when going offline before midnight.
+                    # The wake-up scheduler may move it to spread out the morning backlog
+                    wake_up_time = next_time_of_day(WAKE_UP_TIME, current_time)
                     chat_state.offline_until = wake_up_time + timedelta(seconds=offline_time)
                 else:
                     offline_time = int(random.triangular(MIN_OFFLINE_TIME, MAX_OFFLINE_TIME, MAX_OFFLINE_TIME - (MAX_OFFLINE_TIME - MIN_OFFLINE_TIME) * 0.2))
@@ -180,6 +294,84 @@ class DatabaseService:
 
             return chat_state.is_offline
 
+    def count_online_chats(self) -> int:
+        """Count the chats that are online right now."""
+        session = self.Session()
+        try:
+            return session.query(ChatState).filter(
+                ChatState.is_sleeping == False,
+                ChatState.is_offline == False,
+                ChatState.online_until > now(),
+            ).count()
+        finally:
+            session.close()
+
+    def get_next_chat_return(self) -> Optional[datetime]:
+        """Get the earliest time an offline or sleeping chat comes back, None if none will."""
+        session = self.Session()
+        try:
+            current_time = now()
+            next_online = session.query(func.min(ChatState.offline_until)).filter(
+                ChatState.is_offline == True,
+                ChatState.offline_until > current_time,
+            ).scalar()
+            next_awake = session.query(func.min(ChatState.sleep_until)).filter(
+                ChatState.is_sleeping == True,
+                ChatState.sleep_until > current_time,
+            ).scalar()
+            returns = [time for time in (next_online, next_awake) if time is not None]
+            return min(returns) if returns else None
+        finally:
+            session.close()
+
+    def get_offline_backlogs(self, start: datetime, end: datetime) -> list[tuple[str, datetime, int, int]]:
+        """Get the offline chats that come back between two times with the size of their queued backlog.
+        
+        Returns:
+            List of (chat_id, offline_until, number of queued messages, characters queued), earliest return first
+        """
+        session = self.Session()
+        try:
+            rows = session.query(
+                ChatState.chat_id,
+                ChatState.offline_until,
+                func.count(QueuedMessage.id),
+                func.coalesce(func.sum(func.length(QueuedMessage.message)), 0),
+            ).outerjoin(QueuedMessage, QueuedMessage.chat_id == ChatState.chat_id).filter(
+                ChatState.is_offline == True,
+                ChatState.offline_until >= start,
+                ChatState.offline_until <= end,
+            ).group_by(ChatState.chat_id, ChatState.offline_until).order_by(ChatState.offline_until).all()
+            return [(chat_id, offline_until, int(count), int(characters)) for chat_id, offline_until, count, characters in rows]
+        finally:
+            session.close()
+
+    def reschedule_offline_chats(self, offline_until: dict[str, datetime]) -> int:
+        """Move the time offline chats come back online. Chats that are no longer offline are left alone.
+        
+        Args:
+            offline_until: The new offline_until of each chat ID
+        
+        Returns:
+            Number of chats rescheduled
+        """
+        session = self.Session()
+        try:
+            rescheduled = 0
+            for chat_id, until in offline_until.items():
+                rescheduled += session.query(ChatState).filter(
+                    ChatState.chat_id == str(chat_id),
+                    ChatState.is_offline == True,
+                ).update({ChatState.offline_until: until}, synchronize_session=False)
+            session.commit()
+            return rescheduled
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error rescheduling offline chats: {e}")
+            raise
+        finally:
+            session.close()
+
     def on_offline_to_online(self, chat_id: str):
         """Callback for when a chat transitions from offline to online."""
         if hasattr(self, 'message_handler'):
@@ -245,20 +437,28 @@ class DatabaseService:
         finally:
             session.close()
 
+    def clear_all_processing_delays(self) -> int:
+        """Clear processing delays for every chat, e.g. ones left behind by a previous process."""
+        session = self.Session()
+        try:
+            cleared = session.query(ProcessingDelay).delete()
+            session.commit()
+            return cleared
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error clearing processing delays: {e}")
+            raise
+        finally:
+            session.close()
+
     def add_to_message_queue(self, chat_id: str, message: str) -> int:
-        """Add a message to the queue for a chat."""
+        """Add a message to the queue for a chat. Returns the number of unacknowledged messages."""
         session = self.Session()
         try:
-            queue = session.query(MessageQueue).filter_by(chat_id=str(chat_id)).first()
-            if queue:
-                queue.messages = (queue.messages or "") + f"{message}\n"
-                queue.number_of_messages += 1
-            else:
-                queue = MessageQueue(chat_id=str(chat_id), messages=f"{message}\n", number_of_messages=1)
-                session.add(queue)
+            session.add(QueuedMessage(chat_id=str(chat_id), message=message))
             session.commit()
             logger.info(f"Message added to queue for chat {chat_id}")
-            return queue.number_of_messages
+            return session.query(QueuedMessage).filter_by(chat_id=str(chat_id)).count()
         except Exception as e:
             session.rollback()
             logger.error(f"Error adding message to queue: {e}")
@@ -267,11 +467,171 @@ class DatabaseService:
             session.close()
 
     def get_message_queue(self, chat_id: str) -> dict[str, int | int]:
-        """Get all queued messages for a chat."""
+        """Get all unacknowledged messages for a chat, including ones claimed by a running turn."""
         session = self.Session()
         try:
-            queue = session.query(MessageQueue).filter_by(chat_id=str(chat_id)).first()
-            return {"messages": queue.messages if queue else "", "number_of_messages": int(queue.number_of_messages) if queue else 0}
+            rows = session.query(QueuedMessage).filter_by(chat_id=str(chat_id)).order_by(QueuedMessage.id).all()
+            return {"messages": "".join(f"{row.message}\n" for row in rows), "number_of_messages": len(rows)}
+        finally:
+            session.close()
+
+    def claim_message_batch(self, chat_id: str, lease_seconds: int = QUEUE_LEASE_SECONDS) -> Optional[dict]:
+        """Claim the unclaimed messages of a chat for one agent turn.
+        
+        Claimed messages stay in the queue until `ack_message_batch` and are handed out again
+        once the lease expires, so a crash mid-turn never loses them. Messages whose turns
+        already failed QUEUE_MAX_DELIVERIES times are moved to dead_letter_messages instead of
+        being retried. Nothing is claimed while the chat's messages are held back after a shed
+        turn, so the messages that arrive meanwhile are answered together with them.
+        
+        Args:
+            chat_id: The chat ID
+            lease_seconds: How long the batch is reserved for the caller
+        
+        Returns:
+            Dictionary with the claim token, the messages and their count, None if there is nothing to claim
+        """
+        session = self.Session()
+        try:
+            current_time = now()
+            held_back = session.query(QueuedMessage.id).filter(
+                QueuedMessage.chat_id == str(chat_id),
+                QueuedMessage.claim_token.is_(None),
+                QueuedMessage.claimed_until > current_time,
+            ).first()
+            if held_back is not None:
+                logger.info(f"Queued messages for chat {chat_id} are held back after a shed turn, not claiming")
+                return None
+            
+            rows = session.query(QueuedMessage).filter(
+                QueuedMessage.chat_id == str(chat_id),
+                or_(QueuedMessage.claimed_until.is_(None), QueuedMessage.claimed_until < current_time)
+            ).order_by(QueuedMessage.id).with_for_update(skip_locked=True).all()
+            
+            batch = []
+            for row in rows:
+                if row.delivery_count >= QUEUE_MAX_DELIVERIES:
+                    logger.error(f"Moving queued message {row.id} for chat {chat_id} to the dead letters after {row.delivery_count} failed deliveries: {row.message}")
+                    session.add(DeadLetterMessage(
+                        queued_message_id=row.id,
+                        chat_id=row.chat_id,
+                        message=row.message,
+                        delivery_count=row.delivery_count,
+                        queued_at=row.created_at,
+                        dropped_at=current_time,
+                    ))
+                    session.delete(row)
+                    continue
+                batch.append(row)
+            
+            if not batch:
+                session.commit()
+                return None
+            
+            token = uuid.uuid4().hex
+            for row in batch:
+                row.claim_token = token
+                row.claimed_until = current_time + timedelta(seconds=lease_seconds)
+                row.delivery_count += 1
+            session.commit()
+            logger.info(f"Claimed {len(batch)} queued messages for chat {chat_id}")
+            return {
+                "token": token,
+                "messages": "".join(f"{row.message}\n" for row in batch),
+                "number_of_messages": len(batch),
+            }
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error claiming message batch: {e}")
+            raise
+        finally:
+            session.close()
+
+    def ack_message_batch(self, token: str) -> int:
+        """Remove a claimed batch from the queue once its reply has been sent."""
+        session = self.Session()
+        try:
+            deleted = session.query(QueuedMessage).filter_by(claim_token=token).delete()
+            session.commit()
+            if deleted == 0:
+                logger.warning(f"Message batch {token} was already acknowledged or its lease was taken over")
+            else:
+                logger.info(f"Acknowledged {deleted} queued messages")
+            return deleted
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error acknowledging message batch: {e}")
+            raise
+        finally:
+            session.close()
+
+    def release_message_batch(self, token: str, failed: bool = True, retry_after_seconds: float = 0) -> int:
+        """Return a claimed batch to the queue so it can be retried without waiting for the lease.
+        
+        Args:
+            token: The claim token of the batch
+            failed: Whether the turn failed. A turn that was cancelled or shed before reaching
+                the model does not count towards QUEUE_MAX_DELIVERIES.
+            retry_after_seconds: How long the chat's messages are held back before they can be
+                claimed again, the chat is picked up as stranded once this has passed
+        """
+        session = self.Session()
+        try:
+            claimed_until = now() + timedelta(seconds=retry_after_seconds) if retry_after_seconds > 0 else None
+            values = {QueuedMessage.claim_token: None, QueuedMessage.claimed_until: claimed_until}
+            if not failed:
+                values[QueuedMessage.delivery_count] = QueuedMessage.delivery_count - 1
+            released = session.query(QueuedMessage).filter_by(claim_token=token).update(values)
+            session.commit()
+            logger.info(f"Released {released} queued messages")
+            return released
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error releasing message batch: {e}")
+            raise
+        finally:
+            session.close()
+
+    def release_all_message_leases(self) -> int:
+        """Release every claimed message, for use at start-up when no turn can be running.
+        
+        Their turns were cut short by the restart rather than failing, so their delivery counts are reset.
+        """
+        session = self.Session()
+        try:
+            released = session.query(QueuedMessage).filter(QueuedMessage.claim_token.isnot(None)).update(
+                {QueuedMessage.claim_token: None, QueuedMessage.claimed_until: None, QueuedMessage.delivery_count: 0}
+            )
+            session.commit()
+            return released
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error releasing message leases: {e}")
+            raise
+        finally:
+            session.close()
+
+    def get_stranded_chats(self, older_than_seconds: int = 0) -> list[str]:
+        """Get chats with unclaimed messages that no turn is about to pick up.
+        
+        A chat is skipped while it has a live lease (a turn is running) or an active
+        processing delay (a turn is about to claim the messages).
+        
+        Args:
+            older_than_seconds: Only consider messages that have been waiting at least this long
+        """
+        session = self.Session()
+        try:
+            current_time = now()
+            leased_chats = session.query(QueuedMessage.chat_id).filter(QueuedMessage.claimed_until >= current_time)
+            delayed_chats = session.query(ProcessingDelay.chat_id).filter(ProcessingDelay.delay_until > current_time)
+            rows = session.query(QueuedMessage.chat_id).filter(
+                or_(QueuedMessage.claimed_until.is_(None), QueuedMessage.claimed_until < current_time),
+                QueuedMessage.created_at <= current_time - timedelta(seconds=older_than_seconds),
+                QueuedMessage.chat_id.notin_(leased_chats),
+                QueuedMessage.chat_id.notin_(delayed_chats),
+            ).distinct().all()
+            return [row.chat_id for row in rows]
         finally:
             session.close()
 
@@ -279,7 +639,7 @@ class DatabaseService:
         """Clear all queued messages for a chat."""
         session = self.Session()
         try:
-            session.query(MessageQueue).filter_by(chat_id=str(chat_id)).delete()
+            session.query(QueuedMessage).filter_by(chat_id=str(chat_id)).delete()
             session.commit()
             logger.info(f"Cleared message queue for chat {chat_id}")
         except Exception as e:
@@ -289,6 +649,274 @@ class DatabaseService:
         finally:
             session.close()
 
+    def acquire_chat_lease(self, chat_id: str, owner: str, lease_seconds: int = QUEUE_LEASE_SECONDS) -> bool:
+        """Take or renew ownership of a chat. Returns False if another owner holds a live lease."""
+        session = self.Session()
+        try:
+            current_time = now()
+            statement = self.insert(ChatLease).values(
+                chat_id=str(chat_id),
+                owner=owner,
+                leased_until=current_time + timedelta(seconds=lease_seconds),
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[ChatLease.chat_id],
+                set_={'owner': statement.excluded.owner, 'leased_until': statement.excluded.leased_until},
+                where=or_(ChatLease.leased_until < current_time, ChatLease.owner == owner),
+            ).returning(ChatLease.chat_id)
+            acquired = session.execute(statement).first() is not None
+            session.commit()
+            return acquired
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error acquiring chat lease: {e}")
+            raise
+        finally:
+            session.close()
+
+    def release_chat_lease(self, chat_id: str, owner: str) -> None:
+        """Give up ownership of a chat."""
+        session = self.Session()
+        try:
+            session.query(ChatLease).filter_by(chat_id=str(chat_id), owner=owner).delete()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error releasing chat lease: {e}")
+            raise
+        finally:
+            session.close()
+
+    def enqueue_outbound_message(self, chat_id: str, message: str) -> None:
+        """Queue a reply for the ingest process to send."""
+        session = self.Session()
+        try:
+            session.add(OutboundMessage(chat_id=str(chat_id), message=message))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error queueing outbound message: {e}")
+            raise
+        finally:
+            session.close()
+
+    def claim_outbound_messages(self, limit: int = 20, lease_seconds: int = 60) -> list[dict]:
+        """Claim the oldest sendable outbound messages, in the order they were queued.
+        
+        Chats with a message that is being sent or backing off after a failure are skipped
+        entirely, so later messages never overtake it.
+        """
+        session = self.Session()
+        try:
+            current_time = now()
+            waiting_chats = session.query(OutboundMessage.chat_id).filter(OutboundMessage.claimed_until >= current_time)
+            rows = session.query(OutboundMessage).filter(
+                or_(OutboundMessage.claimed_until.is_(None), OutboundMessage.claimed_until < current_time),
+                OutboundMessage.chat_id.notin_(waiting_chats),
+            ).order_by(OutboundMessage.id).limit(limit).with_for_update(skip_locked=True).all()
+            for row in rows:
+                row.claimed_until = current_time + timedelta(seconds=lease_seconds)
+                row.attempts += 1
+            session.commit()
+            return [{"id": row.id, "chat_id": row.chat_id, "message": row.message, "attempts": row.attempts} for row in rows]
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error claiming outbound messages: {e}")
+            raise
+        finally:
+            session.close()
+
+    def ack_outbound_message(self, message_id: int) -> None:
+        """Remove an outbound message once it has been sent."""
+        session = self.Session()
+        try:
+            session.query(OutboundMessage).filter_by(id=message_id).delete()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error acknowledging outbound message: {e}")
+            raise
+        finally:
+            session.close()
+
+    def retry_outbound_message(self, message_id: int, retry_after_seconds: float) -> None:
+        """Make a claimed outbound message sendable again after a delay."""
+        session = self.Session()
+        try:
+            session.query(OutboundMessage).filter_by(id=message_id).update(
+                {OutboundMessage.claimed_until: now() + timedelta(seconds=retry_after_seconds)}
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error rescheduling outbound message: {e}")
+            raise
+        finally:
+            session.close()
+
+    def get_session_content_sizes(self, app_name: str = "dom") -> list[tuple[str, str, int]]:
+        """Get the total size of the event contents of every agent session of an app.
+        
+        Reads the tables of the session service, which live in the same database. Only the
+        events since each session was last reset are counted.
+        
+        Returns:
+            (user_id, session_id, characters) rows
+        """
+        session = self.Session()
+        try:
+            rows = session.execute(text("""
+                SELECT s.user_id, s.id, coalesce(sum(e.size), 0)
+                FROM agent_sessions AS s
+                JOIN agent_session_events AS e
+                  ON e.app_name = s.app_name AND e.user_id = s.user_id AND e.session_id = s.id AND e.seq >= s.first_seq
+                WHERE s.app_name = :app_name
+                GROUP BY s.user_id, s.id
+            """), {"app_name": app_name}).all()
+            return [(row[0], row[1], int(row[2])) for row in rows]
+        finally:
+            session.close()
+
+    def add_reply_edge(self, chat_id: str, message_id: int, parent_id: Optional[int], from_bot: bool = False) -> None:
+        """Record which message a message replies to. A message that is already recorded is left alone."""
+        session = self.Session()
+        try:
+            statement = self.insert(ReplyEdge).values(
+                chat_id=str(chat_id), message_id=message_id, parent_id=parent_id, from_bot=from_bot, created_at=now()
+            ).on_conflict_do_nothing(index_elements=[ReplyEdge.chat_id, ReplyEdge.message_id])
+            session.execute(statement)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error adding reply edge: {e}")
+            raise
+        finally:
+            session.close()
+
+    def get_reply_edges(self, chat_id: str, after_id: int = 0, limit: int = 5000) -> list[tuple[int, int, Optional[int], bool]]:
+        """Get the latest reply edges of a chat recorded after a row id, oldest first.
+        
+        Returns:
+            List of (row id, message_id, parent_id, from_bot)
+        """
+        session = self.Session()
+        try:
+            rows = session.query(ReplyEdge.id, ReplyEdge.message_id, ReplyEdge.parent_id, ReplyEdge.from_bot).filter(
+                ReplyEdge.chat_id == str(chat_id),
+                ReplyEdge.id > after_id,
+            ).order_by(ReplyEdge.id.desc()).limit(limit).all()
+            return [(row.id, row.message_id, row.parent_id, row.from_bot) for row in reversed(rows)]
+        finally:
+            session.close()
+
+    def delete_reply_edges_before(self, cutoff: datetime) -> int:
+        """Delete reply edges recorded before a time."""
+        session = self.Session()
+        try:
+            deleted = session.query(ReplyEdge).filter(ReplyEdge.created_at < cutoff).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error deleting reply edges: {e}")
+            raise
+        finally:
+            session.close()
+
+    def get_user_profiles(self, chat_id: str, handles: Optional[list[str]] = None) -> list[dict]:
+        """Get the user profiles of a chat, ordered by handle.
+        
+        Args:
+            chat_id: The chat ID
+            handles: Only get these handles (lowercased, without the @), None gets every profile
+        """
+        session = self.Session()
+        try:
+            query = session.query(UserProfile).filter(UserProfile.chat_id == str(chat_id))
+            if handles is not None:
+                if not handles:
+                    return []
+                query = query.filter(UserProfile.handle.in_(handles))
+            return [
+                {"handle": row.handle, **{field: getattr(row, field) for field in USER_PROFILE_FIELDS}}
+                for row in query.order_by(UserProfile.handle).all()
+            ]
+        finally:
+            session.close()
+
+    def save_user_profiles(self, chat_id: str, profiles: list[dict]) -> int:
+        """Insert or replace user profiles of a chat. Profiles of users not in the list are kept.
+        
+        Returns:
+            Number of profiles saved
+        """
+        rows = [
+            {"chat_id": str(chat_id), "handle": profile["handle"], "updated_at": now(),
+             **{field: profile.get(field) for field in USER_PROFILE_FIELDS}}
+            for profile in profiles
+        ]
+        if not rows:
+            return 0
+        session = self.Session()
+        try:
+            statement = self.insert(UserProfile).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[UserProfile.chat_id, UserProfile.handle],
+                set_={field: statement.excluded[field] for field in (*USER_PROFILE_FIELDS, "updated_at")},
+            )
+            session.execute(statement)
+            session.commit()
+            return len(rows)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error saving user profiles: {e}")
+            raise
+        finally:
+            session.close()
+
+    def add_memories(self, chat_id: str, memories: list[tuple[str, str, bytes]]) -> int:
+        """Add memories to a chat.
+        
+        Args:
+            chat_id: The chat ID
+            memories: List of (kind, text, embedding)
+        
+        Returns:
+            Number of memories added
+        """
+        if not memories:
+            return 0
+        session = self.Session()
+        try:
+            session.add_all([
+                Memory(chat_id=str(chat_id), kind=kind, text=text, embedding=embedding, created_at=now())
+                for kind, text, embedding in memories
+            ])
+            session.commit()
+            return len(memories)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error adding memories: {e}")
+            raise
+        finally:
+            session.close()
+
+    def get_memories(self, chat_id: str, after_id: int = 0) -> list[tuple[int, str, str, bytes]]:
+        """Get the memories of a chat added after a row id, oldest first.
+        
+        Returns:
+            List of (row id, kind, text, embedding)
+        """
+        session = self.Session()
+        try:
+            rows = session.query(Memory.id, Memory.kind, Memory.text, Memory.embedding).filter(
+                Memory.chat_id == str(chat_id),
+                Memory.id > after_id,
+            ).order_by(Memory.id).all()
+            return [(row.id, row.kind, row.text, bytes(row.embedding)) for row in rows]
+        finally:
+            session.close()
+
     def set_summarization_lock(self, chat_id: str) -> bool:
         """Set a summarization lock for a chat. Returns True if lock was acquired, False if already locked."""
         session = self.Session()
@@ -319,7 +947,7 @@ class DatabaseService:
             lock = session.query(SummarizationLock).filter_by(chat_id=str(chat_id)).first()
             if lock:
                 # Check if the lock is stale (older than 30 minutes)
-                cutoff_time = datetime.now() - timedelta(minutes=30)
+                cutoff_time = now() - timedelta(minutes=30)
                 if lock.locked_at < cutoff_time:
                     logger.info(f"Found stale summarization lock for chat {chat_id}, clearing it")
                     session.delete(lock)
@@ -358,7 +986,7 @@ class DatabaseService:
         """
         session = self.Session()
         try:
-            cutoff_time = datetime.now() - timedelta(minutes=timeout_minutes)
+            cutoff_time = now() - timedelta(minutes=timeout_minutes)
             stale_locks = session.query(SummarizationLock).filter(
                 SummarizationLock.locked_at < cutoff_time
             ).all()
@@ -390,7 +1018,7 @@ def get_online_for_seconds(chat_id: str) -> int:
         chat_state = session.query(ChatState).filter(ChatState.chat_id == chat_id).first()
         if not chat_state:
             return 0
-        return (chat_state.online_until - datetime.now()).total_seconds()
+        return (chat_state.online_until - now()).total_seconds()
     except Exception as e:
         logger.error(f"Error getting online for seconds: {e}")
         return 0
@@ -410,8 +1038,8 @@ def increase_online_time(chat_id: str, seconds: int = 60) -> dict:
     session = DatabaseService().Session()
     try:
         chat_state = session.query(ChatState).filter_by(chat_id=str(chat_id)).first()
-        current_online_time = (chat_state.online_until - datetime.now()).total_seconds()
-        chat_state.online_until = datetime.now() + timedelta(seconds=(int(current_online_time) + int(seconds)))
+        current_online_time = (chat_state.online_until - now()).total_seconds()
+        chat_state.online_until = now() + timedelta(seconds=(int(current_online_time) + int(seconds)))
         session.commit()
         logger.info(f"Increased online time for chat {chat_id} by {seconds} seconds")
         return {
@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+from collections import Counter, OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+from bot.config.settings import (
+    INGEST_WORKERS,
+    INGEST_CHAT_QUEUE_SIZE,
+    INGEST_MAX_PENDING,
+    INGEST_DEFER_SECONDS,
+    INGEST_MAX_DEFERRED,
+)
+
+logger = logging.getLogger(__name__)
+
+# Updates remembered to drop the ones Telegram delivers again, e.g. while catching up after a reconnect
+SEEN_UPDATES = 5000
+
+class _Update:
+    def __init__(self, kind: str, event, handler: Callable[..., Awaitable], coalesce_key: Optional[tuple]):
+        self.kind = kind
+        self.event = event
+        self.handler = handler
+        self.coalesce_key = coalesce_key
+        self.queued_at = time.monotonic()
+
+class IngestQueue:
+    """Admits Telegram updates into bounded per-chat queues consumed by a fixed pool of workers.
+
+    Telethon starts a task for every update, so without this a burst of messages runs that
+    many handlers at once, each with its own database session. Here at most `workers`
+    handlers run at a time. A chat's updates are handled in order, one at a time, and chats
+    take turns so a busy group can't hold up the others.
+
+    Updates are shed before they use a worker. An update already seen is dropped, and a
+    command the chat already has queued is coalesced with it. When the chat's queue or the
+    whole queue is full, the update is deferred until there is room, and the updates of a
+    chat that arrive while some are deferred wait behind them so the chat stays in order.
+    A deferred update is still a Telethon task holding its event, so at most `max_deferred`
+    updates are deferred at once. An update submitted with an `overflow` handler, such as a
+    message, which would never be answered if it was dropped, waits until there is room,
+    and past that limit it is passed to `overflow` straight away instead of being queued.
+    Other updates are dropped if there is still no room after `defer_seconds`, or right
+    away past that limit. Queue depth and shed counts are logged by `report`.
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS, chat_queue_size: int = INGEST_CHAT_QUEUE_SIZE,
+                 max_pending: int = INGEST_MAX_PENDING, defer_seconds: float = INGEST_DEFER_SECONDS,
+                 max_deferred: int = INGEST_MAX_DEFERRED):
+        self.workers = workers
+        self.chat_queue_size = chat_queue_size
+        self.max_pending = max_pending
+        self.defer_seconds = defer_seconds
+        self.max_deferred = max_deferred
+        self._chats: Dict[int, Deque[_Update]] = {}
+        # Chats waiting for a worker, a chat is in here or being handled while it is scheduled
+        self._ready: "asyncio.Queue[int]" = asyncio.Queue()
+        self._scheduled: Set[int] = set()
+        self._pending = 0
+        self._deferred = 0
+        # Deferred updates of each chat in the order they arrived
+        self._waiters: Dict[int, Deque[object]] = {}
+        self._space = asyncio.Condition()
+        self._seen: "OrderedDict[tuple, None]" = OrderedDict()
+        self.counts = Counter()
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        """Updates queued and not yet handled."""
+        return self._pending
+
+    def _has_room(self, chat_id: int) -> bool:
+        return self._pending < self.max_pending and len(self._chats.get(chat_id, ())) < self.chat_queue_size
+
+    def _is_duplicate(self, key: tuple) -> bool:
+        if key in self._seen:
+            return True
+        self._seen[key] = None
+        while len(self._seen) > SEEN_UPDATES:
+            self._seen.popitem(last=False)
+        return False
+
+    async def submit(self, kind: str, event, handler: Callable[..., Awaitable], coalesce: bool = False,
+                     overflow: Optional[Callable[..., Awaitable]] = None) -> bool:
+        """Queue an update to be handled by `handler(event)`.
+
+        Args:
+            kind: What the update is for, such as "message" or the command
+            event: The Telethon event
+            handler: Coroutine function handling the event
+            coalesce: Whether the update is dropped when the chat has the same one queued
+            overflow: Coroutine function the update is passed to instead of being dropped when
+                too many updates are deferred, it should only do cheap work such as storing it
+
+        Returns:
+            Whether the update was queued
+        """
+        chat_id = int(event.chat_id)
+        if self._is_duplicate((kind, chat_id, event.message.id)):
+            self.counts["duplicates"] += 1
+            return False
+        coalesce_key = (kind, (event.message.text or "").strip()) if coalesce else None
+        if coalesce_key is not None and any(update.coalesce_key == coalesce_key for update in self._chats.get(chat_id, ())):
+            self.counts["coalesced"] += 1
+            return False
+        if (chat_id in self._waiters or not self._has_room(chat_id)) and not await self._defer(chat_id, overflow is None):
+            if overflow is None:
+                self.counts["dropped"] += 1
+                logger.debug(f"Ingest queue is full, dropped a {kind} update from chat {chat_id}")
+                return False
+            self.counts["overflowed"] += 1
+            try:
+                await overflow(event)
+            except Exception as e:
+                self.counts["failed"] += 1
+                logger.error(f"Error handling overflowing {kind} update from chat {chat_id}: {e}")
+            return False
+
+        self._chats.setdefault(chat_id, deque()).append(_Update(kind, event, handler, coalesce_key))
+        self._pending += 1
+        self.max_depth = max(self.max_depth, self._pending)
+        self.counts["queued"] += 1
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        return True
+
+    async def _defer(self, chat_id: int, timeout: bool) -> bool:
+        """Wait until there is room for an update of a chat and the chat's earlier deferred updates are queued.
+
+        Args:
+            chat_id: The chat of the update
+            timeout: Whether to give up after `defer_seconds`
+
+        Returns:
+            Whether the update can be queued, False if it timed out or too many updates are waiting
+        """
+        if self._deferred >= self.max_deferred or (timeout and self.defer_seconds <= 0):
+            return False
+        ticket = object()
+        waiters = self._waiters.setdefault(chat_id, deque())
+        waiters.append(ticket)
+        self._deferred += 1
+        self.counts["deferred"] += 1
+        async with self._space:
+            try:
+                ready = self._space.wait_for(lambda: waiters[0] is ticket and self._has_room(chat_id))
+                await (asyncio.wait_for(ready, self.defer_seconds) if timeout else ready)
+                return True
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                # Still holding the lock, so the next waiter only checks once this update is queued
+                self._deferred -= 1
+                waiters.remove(ticket)
+                if not waiters:
+                    del self._waiters[chat_id]
+                self._space.notify_all()
+
+    async def _work(self):
+        while True:
+            chat_id = await self._ready.get()
+            updates = self._chats[chat_id]
+            update = updates.popleft()
+            self._pending -= 1
+            async with self._space:
+                self._space.notify_all()
+            try:
+                await update.handler(update.event)
+                self.counts["handled"] += 1
+            except Exception as e:
+                self.counts["failed"] += 1
+                logger.error(f"Error handling {update.kind} update from chat {chat_id}: {e}")
+            finally:
+                # Back of the line, so other chats get a turn between this chat's updates
+                if updates:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chats[chat_id]
+                    self._scheduled.discard(chat_id)
+
+    def report(self):
+        """Log the queue depth and the updates shed since the last report."""
+        shed = self.counts["duplicates"] + self.counts["coalesced"] + self.counts["dropped"] + self.counts["overflowed"]
+        log = logger.warning if self.counts["dropped"] or self.counts["overflowed"] else logger.info
+        if self.counts["queued"] or shed:
+            log(
+                f"Ingest queue: {self.counts['queued']} queued, {shed} shed ({self.counts['dropped']} dropped, "
+                f"{self.counts['overflowed']} overflowed), "
+                f"depth {self._pending} (max {self.max_depth}) in {len(self._chats)} chats",
+                extra={"extra_data": {
+                    "metric": "ingest_queue",
+                    "depth": self._pending,
+                    "max_depth": self.max_depth,
+                    "chats": len(self._chats),
+                    "deferred_now": self._deferred,
+                    **self.counts,
+                }}
+            )
+        self.counts.clear()
+        self.max_depth = self._pending
+
+    async def run(self):
+        """Run the worker pool until cancelled."""
+        workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
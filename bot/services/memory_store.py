@@ -0,0 +1,158 @@
+import re
+import time
+import zlib
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from bot.config.settings import (
+    MEMORY_TOP_K,
+    MEMORY_MIN_SCORE,
+    MEMORY_EMBEDDING_DIMENSIONS,
+    MEMORY_MAX_CHATS,
+)
+from bot.services.database_service import DatabaseService
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"[^\W_]+", re.UNICODE)
+# Memories at least this similar to one the chat already has are not stored again
+DUPLICATE_SIMILARITY = 0.9
+
+class HashingEmbedder:
+    """Embeds text on the CPU by hashing its words, word pairs and character trigrams into a
+    fixed number of dimensions.
+
+    It needs no model download and embeds a memory in well under a millisecond. Texts that
+    share words, names and word stems end up close, which is what matching the memories of
+    a chat against its latest messages needs.
+    """
+
+    def __init__(self, dimensions: int = MEMORY_EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> List[str]:
+        words = [word.lower() for word in WORD.findall(text)]
+        features = list(words)
+        features.extend(f"{first} {second}" for first, second in zip(words, words[1:]))
+        for word in words:
+            padded = f"<{word}>"
+            features.extend(f"#{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed texts into unit length float32 rows, all zero for texts without words."""
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            # crc32 rather than hash(), which is salted per process
+            hashes = np.array([zlib.crc32(feature.encode()) for feature in self._features(text)], dtype=np.uint32)
+            if not len(hashes):
+                continue
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dimensions, signs)
+        # Damp features repeated many times in one text
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+class ChatMemories:
+    """The memories of one chat and their embeddings, one row per memory."""
+
+    def __init__(self, dimensions: int):
+        self.kinds: List[str] = []
+        self.texts: List[str] = []
+        self.matrix = np.zeros((0, dimensions), dtype=np.float32)
+        # Id of the newest database row loaded, to only fetch newer memories on refresh
+        self.last_row_id = 0
+
+    def extend(self, rows: List[Tuple[int, str, str, bytes]]):
+        if not rows:
+            return
+        self.kinds.extend(kind for _, kind, _, _ in rows)
+        self.texts.extend(text for _, _, text, _ in rows)
+        embeddings = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, _, _, embedding in rows])
+        self.matrix = np.vstack([self.matrix, embeddings])
+        self.last_row_id = rows[-1][0]
+
+class MemoryStore:
+    """Long-term memories of the chats, stored in the memories table and searched by similarity.
+
+    Each summarisation adds the facts the summarising agent picked out and the summary it
+    wrote. Each turn only the MEMORY_TOP_K memories most similar to the batch of unread
+    messages go into the prompt, so the prompt stays the same size however old a chat gets.
+    The memories of recently active chats are kept in memory as one matrix per chat, and
+    pick up rows other processes added every time they are searched.
+    """
+
+    def __init__(self, db: DatabaseService, embedder: Optional[HashingEmbedder] = None,
+                 max_chats: int = MEMORY_MAX_CHATS):
+        self.db = db
+        self.embedder = embedder or HashingEmbedder()
+        self.max_chats = max_chats
+        self._chats: "OrderedDict[str, ChatMemories]" = OrderedDict()
+
+    def _memories(self, chat_id: str) -> ChatMemories:
+        chat_id = str(chat_id)
+        memories = self._chats.get(chat_id)
+        if memories is None:
+            memories = self._chats[chat_id] = ChatMemories(self.embedder.dimensions)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        memories.extend(self.db.get_memories(chat_id, after_id=memories.last_row_id))
+        return memories
+
+    def search(self, chat_id: str, query: str, k: int = MEMORY_TOP_K,
+               min_score: float = MEMORY_MIN_SCORE) -> List[Tuple[float, str]]:
+        """Find the memories of a chat most similar to a text.
+
+        Returns:
+            Up to k (similarity, text) pairs, in the order the memories were added
+        """
+        started = time.perf_counter()
+        memories = self._memories(chat_id)
+        if not memories.texts or k <= 0:
+            return []
+        scores = memories.matrix @ self.embedder.embed([query])[0]
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        found = [(float(scores[index]), memories.texts[index]) for index in sorted(top) if scores[index] >= min_score]
+        logger.debug(
+            f"Searched {len(memories.texts)} memories of chat {chat_id} in {(time.perf_counter() - started) * 1000:.2f}ms",
+            extra={"extra_data": {
+                "metric": "memory_search",
+                "memories": len(memories.texts),
+                "found": len(found),
+                "milliseconds": round((time.perf_counter() - started) * 1000, 3),
+            }}
+        )
+        return found
+
+    def add(self, chat_id: str, facts: Sequence[str], summary: Optional[str] = None) -> int:
+        """Add facts and a summary to a chat's memories, leaving out near duplicates.
+
+        Returns:
+            Number of memories added
+        """
+        candidates = [("fact", fact.strip()) for fact in facts if fact and fact.strip()]
+        if summary and summary.strip():
+            candidates.append(("summary", summary.strip()))
+        if not candidates:
+            return 0
+        memories = self._memories(chat_id)
+        embeddings = self.embedder.embed([text for _, text in candidates])
+        kept = []
+        for (kind, text), embedding in zip(candidates, embeddings):
+            if not embedding.any():
+                continue
+            existing = [memories.matrix] + [kept_embedding[None, :] for _, _, kept_embedding in kept]
+            if max(float((matrix @ embedding).max(initial=-1.0)) for matrix in existing) >= DUPLICATE_SIMILARITY:
+                continue
+            kept.append((kind, text, embedding))
+        return self.db.add_memories(str(chat_id), [(kind, text, embedding.astype(np.float32).tobytes()) for kind, text, embedding in kept])
+
+    def render_for_prompt(self, chat_id: str, query: str) -> str:
+        """Render the memories relevant to a batch of messages for the conversation prompt."""
+        found = self.search(chat_id, query)
+        if not found:
+            return "No relevant memories"
+        return "\n".join(f"- {text}" for _, text in found)
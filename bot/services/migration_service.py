@@ -0,0 +1,409 @@
+import os
+import logging
+from dataclasses import dataclass
+from typing import List, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy import Column, Integer, String, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable, CreateIndex
+from bot.config.settings import DB_URL
+from bot.services import database_service, session_service, telegram_session
+from bot.utils import postgres_logger
+from bot.utils.time_utils import now
+from bot.utils.db_engine import get_engine, ensure_tables, is_sqlite
+from bot.utils.db_types import TZDateTime
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+# Arbitrary key for the Postgres advisory lock held while upgrading
+MIGRATION_LOCK_KEY = 726_000_001
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(TZDateTime, default=now)
+
+@dataclass(frozen=True)
+class Migration:
+    """A single schema migration.
+
+    Statements must be idempotent, as tables created by `create_all` on a fresh database
+    already have the final shape and the migrations are still applied on top of them.
+    """
+    version: int
+    description: str
+    statements: Tuple[str, ...]
+
+def _local_timezone_name() -> str:
+    """Get the IANA name of the system timezone from /etc/localtime or /etc/timezone."""
+    try:
+        target = os.path.realpath("/etc/localtime")
+        if "zoneinfo/" in target:
+            return target.split("zoneinfo/", 1)[1]
+    except OSError:
+        pass
+    try:
+        with open("/etc/timezone") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def _legacy_timezone_sql() -> str:
+    """Get the SQL timezone that naive timestamps were written in.
+
+    The bot used to store `datetime.now()` without a timezone, so existing values are in
+    the local time of the bot process rather than the database server. A named zone is
+    used rather than a fixed offset so that values from both sides of a DST change are
+    converted correctly.
+
+    Raises:
+        ValueError: If the timezone is not a valid IANA name
+    """
+    # POSIX allows a leading colon or a full path to the zone file
+    tz_name = os.getenv("TZ", "").lstrip(":")
+    if "zoneinfo/" in tz_name:
+        tz_name = tz_name.split("zoneinfo/", 1)[1]
+    if not tz_name:
+        tz_name = _local_timezone_name()
+    if not tz_name:
+        logger.warning("Could not determine the local timezone, converting naive timestamps as UTC")
+        tz_name = "UTC"
+    try:
+        ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(
+            f"TZ={tz_name!r} is not a valid IANA timezone name, set TZ to the zone the bot used "
+            "(e.g. Asia/Singapore) to convert naive timestamps"
+        ) from None
+    return "'" + tz_name.replace("'", "''") + "'"
+
+def _to_timestamptz(table: str, columns: List[str]) -> str:
+    """Build an ALTER TABLE statement converting naive timestamp columns to timestamptz."""
+    alterations = ",\n    ".join(
+        f"ALTER COLUMN {column} TYPE TIMESTAMPTZ USING {column} AT TIME ZONE {{tz}}"
+        for column in columns
+    )
+    # Only convert when the columns are still naive so the statement is safe to re-run
+    return f"""
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = '{table}' AND column_name = '{columns[0]}'
+          AND data_type = 'timestamp without time zone'
+    ) THEN
+        ALTER TABLE {table}
+    {alterations};
+    END IF;
+END $$;
+"""
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        version=1,
+        description="Add time indexes and convert timestamps to timezone-aware types",
+        statements=(
+            _to_timestamptz('chat_states', ['sleep_until', 'offline_until', 'online_until', 'created_at', 'updated_at']),
+            _to_timestamptz('processing_delays', ['delay_until', 'created_at']),
+            _to_timestamptz('message_queues', ['created_at', 'updated_at']),
+            _to_timestamptz('summarization_locks', ['locked_at', 'created_at']),
+            _to_timestamptz('log_entries', ['timestamp']),
+            "CREATE INDEX IF NOT EXISTS ix_chat_states_sleep_until ON chat_states (sleep_until);",
+            "CREATE INDEX IF NOT EXISTS ix_chat_states_offline_until ON chat_states (offline_until);",
+            "CREATE INDEX IF NOT EXISTS ix_chat_states_online_until ON chat_states (online_until);",
+            "CREATE INDEX IF NOT EXISTS ix_processing_delays_delay_until ON processing_delays (delay_until);",
+            "CREATE INDEX IF NOT EXISTS ix_summarization_locks_locked_at ON summarization_locks (locked_at);",
+            "CREATE INDEX IF NOT EXISTS ix_log_entries_timestamp ON log_entries (timestamp);",
+            "CREATE INDEX IF NOT EXISTS ix_log_entries_level_timestamp ON log_entries (level, timestamp);",
+            "CREATE INDEX IF NOT EXISTS ix_log_entries_logger_name_timestamp ON log_entries (logger_name, timestamp);",
+        ),
+    ),
+    Migration(
+        version=2,
+        description="Convert log_entries to a time-range partitioned table",
+        statements=(
+            # Partition boundaries are computed in the bot's local time
+            "SET LOCAL TIME ZONE {tz};",
+            # The existing table becomes the first partition, covering everything up to the end of its last day
+            """
+DO $$
+DECLARE
+    legacy_upper TIMESTAMPTZ;
+BEGIN
+    IF to_regclass('log_entries') IS NOT NULL
+       AND NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'log_entries'::regclass) THEN
+        ALTER TABLE log_entries RENAME TO log_entries_legacy;
+        ALTER TABLE log_entries_legacy DROP CONSTRAINT log_entries_pkey;
+        ALTER TABLE log_entries_legacy ADD CONSTRAINT log_entries_legacy_pkey PRIMARY KEY (id, timestamp);
+        ALTER INDEX IF EXISTS ix_log_entries_timestamp RENAME TO ix_log_entries_legacy_timestamp;
+        ALTER INDEX IF EXISTS ix_log_entries_level_timestamp RENAME TO ix_log_entries_legacy_level_timestamp;
+        ALTER INDEX IF EXISTS ix_log_entries_logger_name_timestamp RENAME TO ix_log_entries_legacy_logger_name_timestamp;
+
+        CREATE TABLE log_entries (
+            id INTEGER NOT NULL DEFAULT nextval('log_entries_id_seq'),
+            timestamp TIMESTAMPTZ NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            logger_name VARCHAR(100) NOT NULL,
+            message TEXT NOT NULL,
+            module VARCHAR(100),
+            function VARCHAR(100),
+            line_number INTEGER,
+            exception_info TEXT,
+            extra_data TEXT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        ALTER TABLE log_entries_legacy ALTER COLUMN id DROP DEFAULT;
+        ALTER SEQUENCE log_entries_id_seq OWNED BY log_entries.id;
+        CREATE INDEX ix_log_entries_timestamp ON log_entries (timestamp);
+        CREATE INDEX ix_log_entries_level_timestamp ON log_entries (level, timestamp);
+        CREATE INDEX ix_log_entries_logger_name_timestamp ON log_entries (logger_name, timestamp);
+
+        SELECT date_trunc('day', COALESCE(max(timestamp), now())) + INTERVAL '1 day'
+        INTO legacy_upper FROM log_entries_legacy;
+        EXECUTE format(
+            'ALTER TABLE log_entries ATTACH PARTITION log_entries_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+            legacy_upper
+        );
+    END IF;
+END $$;
+""",
+            "CREATE TABLE IF NOT EXISTS log_entries_default PARTITION OF log_entries DEFAULT;",
+        ),
+    ),
+    Migration(
+        version=3,
+        description="Add full-text and trigram search indexes on log messages",
+        statements=(
+            # The 'simple' configuration keeps identifiers and error codes intact instead of stemming them
+            "ALTER TABLE log_entries ADD COLUMN IF NOT EXISTS message_tsv TSVECTOR "
+            "GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED;",
+            "CREATE INDEX IF NOT EXISTS ix_log_entries_message_tsv ON log_entries USING GIN (message_tsv);",
+            # pg_trgm is a contrib extension and may be missing or need superuser, substring search then stays on ILIKE
+            """
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm is not available, substring log search will not be indexed';
+END $$;
+""",
+            """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        CREATE INDEX IF NOT EXISTS ix_log_entries_message_trgm ON log_entries USING GIN (message gin_trgm_ops);
+    END IF;
+END $$;
+""",
+        ),
+    ),
+    Migration(
+        version=4,
+        description="Move queued message blobs into leased per-message rows",
+        statements=(
+            # Each queued message starts with its "[dd-mm-yyyy hh:mm AM]" timestamp, which is
+            # where the blob is split so multi-line messages stay whole
+            r"""
+DO $$
+BEGIN
+    IF to_regclass('message_queues') IS NOT NULL THEN
+        INSERT INTO queued_messages (chat_id, message, delivery_count, created_at)
+        SELECT queue.chat_id, part.message, 0, queue.created_at
+        FROM message_queues AS queue,
+             regexp_split_to_table(
+                 rtrim(queue.messages, E'\n'),
+                 E'\\n(?=\\[[0-9]{2}-[0-9]{2}-[0-9]{4} )'
+             ) WITH ORDINALITY AS part(message, position)
+        WHERE rtrim(coalesce(queue.messages, ''), E'\n') <> ''
+        ORDER BY queue.chat_id, part.position;
+        DROP TABLE message_queues;
+    END IF;
+END $$;
+""",
+        ),
+    ),
+    Migration(
+        version=5,
+        description="Copy agent sessions into the append-only session event tables",
+        statements=(
+            # Events are rebuilt as Event JSON and stored uncompressed, their actions are left
+            # out as ADK pickles them. The ADK tables are kept to allow going back.
+            """
+DO $$
+BEGIN
+    IF to_regclass('sessions') IS NOT NULL AND to_regclass('events') IS NOT NULL THEN
+        INSERT INTO agent_session_events (app_name, user_id, session_id, seq, event_id, author, timestamp, size, compressed, payload)
+        SELECT app_name, user_id, session_id,
+               row_number() OVER (PARTITION BY app_name, user_id, session_id ORDER BY timestamp, id),
+               id, author, extract(epoch FROM timestamp AT TIME ZONE {tz}),
+               coalesce(length(content::text), 0), false,
+               convert_to(jsonb_strip_nulls(jsonb_build_object(
+                   'id', id,
+                   'invocation_id', invocation_id,
+                   'author', author,
+                   'branch', branch,
+                   'timestamp', extract(epoch FROM timestamp AT TIME ZONE {tz}),
+                   'content', content,
+                   'grounding_metadata', grounding_metadata,
+                   'long_running_tool_ids', long_running_tool_ids_json::jsonb,
+                   'partial', partial,
+                   'turn_complete', turn_complete,
+                   'error_code', error_code,
+                   'error_message', error_message,
+                   'interrupted', interrupted
+               ))::text, 'UTF8')
+        FROM events
+        ON CONFLICT DO NOTHING;
+        INSERT INTO agent_sessions (app_name, user_id, id, state, first_seq, next_seq, created_at, update_time)
+        SELECT s.app_name, s.user_id, s.id, coalesce(s.state, '{}'::jsonb), 1,
+               (SELECT count(*) + 1 FROM events AS e WHERE e.app_name = s.app_name AND e.user_id = s.user_id AND e.session_id = s.id),
+               s.create_time AT TIME ZONE {tz}, s.update_time AT TIME ZONE {tz}
+        FROM sessions AS s
+        ON CONFLICT DO NOTHING;
+    END IF;
+END $$;
+""",
+        ),
+    ),
+]
+
+class MigrationService:
+    """Applies versioned schema migrations on top of `create_all`.
+
+    `create_all` only creates missing tables, so any change to an existing table (indexes,
+    column types) has to go through a migration listed in `MIGRATIONS`.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else get_engine(DB_URL)
+        self.Session = sessionmaker(bind=self.engine)
+
+    @staticmethod
+    def _metadatas():
+        return [database_service.Base.metadata, postgres_logger.Base.metadata, session_service.Base.metadata, telegram_session.Base.metadata, Base.metadata]
+
+    def create_tables(self) -> None:
+        """Create any missing tables in their latest shape."""
+        for metadata in self._metadatas():
+            ensure_tables(metadata, self.engine)
+
+    def get_current_version(self) -> int:
+        """Get the latest applied migration version, 0 if none has been applied."""
+        ensure_tables(Base.metadata, self.engine)
+        session = self.Session()
+        try:
+            versions = [row.version for row in session.query(SchemaMigration.version).all()]
+            return max(versions) if versions else 0
+        finally:
+            session.close()
+
+    def get_pending_migrations(self) -> List[Migration]:
+        """Get migrations that have not been applied yet, in order."""
+        current_version = self.get_current_version()
+        return [migration for migration in MIGRATIONS if migration.version > current_version]
+
+    def upgrade(self) -> List[int]:
+        """Create missing tables and apply all pending migrations.
+
+        Returns:
+            The versions of the migrations that were applied
+        """
+        if is_sqlite(self.engine):
+            return self._upgrade_sqlite()
+        # Several bot processes may start at once, only one of them gets to upgrade at a time
+        with self.engine.connect() as lock_connection:
+            lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+            try:
+                self.create_tables()
+                applied = []
+                for migration in self.get_pending_migrations():
+                    logger.info(f"Applying schema migration {migration.version}: {migration.description}")
+                    with self.engine.begin() as connection:
+                        for statement in self._render(migration):
+                            connection.execute(text(statement))
+                        connection.execute(
+                            SchemaMigration.__table__.insert().values(
+                                version=migration.version,
+                                description=migration.description,
+                                applied_at=now(),
+                            )
+                        )
+                    applied.append(migration.version)
+            finally:
+                lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+                lock_connection.commit()
+        if applied:
+            logger.info(f"Applied schema migrations: {applied}")
+        return applied
+
+    def _upgrade_sqlite(self) -> List[int]:
+        """Create missing tables and record every migration as applied.
+
+        The migrations convert data and features of older Postgres schemas, and a SQLite
+        database is always created in the latest shape. Full-text log search and log
+        partitions are Postgres only, so they are not recreated.
+        """
+        self.create_tables()
+        pending = self.get_pending_migrations()
+        if pending:
+            with self.engine.begin() as connection:
+                connection.execute(SchemaMigration.__table__.insert(), [
+                    {'version': migration.version, 'description': migration.description, 'applied_at': now()}
+                    for migration in pending
+                ])
+        return [migration.version for migration in pending]
+
+    @staticmethod
+    def _render(migration: Migration) -> List[str]:
+        tz = _legacy_timezone_sql()
+        # Literal braces are not expected in migration SQL, so plain replace is enough
+        return [statement.replace("{tz}", tz) for statement in migration.statements]
+
+    @classmethod
+    def generate_sql(cls, from_version: int = 0, include_tables: bool = True) -> str:
+        """Generate the SQL for an upgrade without connecting to the database.
+
+        Args:
+            from_version: Only include migrations newer than this version
+            include_tables: Whether to include CREATE TABLE statements for missing tables
+
+        Returns:
+            A SQL script that can be reviewed and applied manually
+        """
+        dialect = postgresql.dialect()
+        script = ["BEGIN;"]
+        if include_tables:
+            for metadata in cls._metadatas():
+                for table in metadata.sorted_tables:
+                    script.append(f"{str(CreateTable(table, if_not_exists=True).compile(dialect=dialect)).strip()};")
+                    for index in sorted(table.indexes, key=lambda index: index.name):
+                        script.append(f"{str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)).strip()};")
+        for migration in MIGRATIONS:
+            if migration.version <= from_version:
+                continue
+            script.append(f"\n-- Migration {migration.version}: {migration.description}")
+            script.extend(statement.strip() for statement in cls._render(migration))
+            script.append(
+                "INSERT INTO schema_migrations (version, description, applied_at) "
+                f"VALUES ({migration.version}, '{migration.description}', now()) ON CONFLICT DO NOTHING;"
+            )
+        script.append("COMMIT;")
+        return "\n".join(script) + "\n"
+
+    def close(self):
+        """Close the database connection."""
+        self.engine.dispose()
+
+def run_migrations(engine=None) -> List[int]:
+    """Quick function to bring the schema up to date."""
+    service = MigrationService(engine)
+    try:
+        return service.upgrade()
+    finally:
+        if engine is None:
+            service.close()
@@ -0,0 +1,369 @@
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+from collections import deque
+from contextvars import ContextVar
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Tuple
+from google.adk.models import BaseLlm, LlmRequest, LlmResponse
+from bot.config.models import (
+    MODEL_BREAKER_FAILURES,
+    MODEL_BREAKER_RESET_SECONDS,
+    MODEL_HEDGE_PERCENTILE,
+    GEMINI_ENDPOINT,
+    LITELLM_MAX_CONCURRENCY,
+    LITELLM_MAX_QUEUE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Latencies kept per model to compute the hedging delay
+LATENCY_WINDOW = 200
+# Hedging starts once a model has this many successful calls to base the delay on
+MIN_LATENCY_SAMPLES = 20
+
+# Call priorities on a limited endpoint, lower is served first
+CONVERSATION_PRIORITY = 0
+SEARCH_PRIORITY = 1
+SUMMARISATION_PRIORITY = 2
+WARMUP_PRIORITY = 3
+
+_deadline: ContextVar[Optional[float]] = ContextVar("model_deadline", default=None)
+
+class ModelUnavailableError(Exception):
+    """Raised when every endpoint that could serve a model call has its circuit open."""
+
+class ModelOverloadedError(ModelUnavailableError):
+    """Raised when a call is shed because too many calls are waiting for its endpoint."""
+
+@contextlib.contextmanager
+def model_deadline(seconds: float):
+    """Limit the model calls made inside the block to finish within `seconds`.
+
+    The deadline is carried in a context variable, so it reaches the model calls made deep
+    inside the agent runner. A nested deadline can only shorten the outer one.
+    """
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+def remaining_time() -> Optional[float]:
+    """Seconds left until the current deadline, None if no deadline is set."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+class CircuitBreaker:
+    """Stops calls to an endpoint after repeated failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are refused.
+    Once `reset_timeout` seconds have passed a single probe call is let through (half-open),
+    and its outcome closes or reopens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = MODEL_BREAKER_FAILURES,
+                 reset_timeout: float = MODEL_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow_request(self) -> bool:
+        """Check whether a call may be made now. A True result must be followed by a
+        record_success, record_failure or release."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit for {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self):
+        """Give back a call that was cancelled before it had an outcome."""
+        self._probing = False
+
+class LatencyTracker:
+    """Keeps recent call latencies of a model."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """Nearest-rank percentile of the recent latencies, None until there are enough samples."""
+        if len(self.samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        rank = max(1, math.ceil(percentile / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+class EndpointLimiter:
+    """Bounds the concurrent calls to an endpoint and admits waiting calls by priority.
+
+    When `max_queue` calls are already waiting, the lowest priority one is shed with a
+    ModelOverloadedError, which is the new call itself if nothing waiting is less important.
+    """
+
+    def __init__(self, name: str, slots: int = LITELLM_MAX_CONCURRENCY, max_queue: int = LITELLM_MAX_QUEUE):
+        self.name = name
+        self.slots = slots
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiting: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int):
+        """Hold one of the endpoint's slots for the duration of the block."""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int):
+        if self.active < self.slots and not self._waiting:
+            self.active += 1
+            return
+
+        if len(self._waiting) >= self.max_queue:
+            worst = max(self._waiting)
+            if worst[0] <= priority:
+                self._report_shed(priority)
+                raise ModelOverloadedError(f"Too many calls waiting for {self.name}")
+            self._report_shed(worst[0])
+            self._waiting.remove(worst)
+            heapq.heapify(self._waiting)
+            worst[2].set_exception(ModelOverloadedError(f"Too many calls waiting for {self.name}"))
+
+        entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, entry)
+        queue_depth = len(self._waiting)
+        started = time.monotonic()
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+            elif entry[2].done() and not entry[2].cancelled() and entry[2].exception() is None:
+                # The slot was handed over just before the cancellation, pass it on
+                self.release()
+            raise
+
+        wait = time.monotonic() - started
+        logger.info(
+            f"Waited {wait:.2f}s for a model slot on {self.name}",
+            extra={"extra_data": {
+                "metric": "model_queue_wait",
+                "endpoint": self.name,
+                "priority": priority,
+                "wait_seconds": round(wait, 3),
+                "queue_depth": queue_depth,
+            }}
+        )
+
+    def release(self):
+        # Hand the slot straight to the most important waiting call
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _report_shed(self, priority: int):
+        logger.warning(
+            f"Shedding a priority {priority} model call, {len(self._waiting)} calls are waiting for {self.name}",
+            extra={"extra_data": {
+                "metric": "model_queue_shed",
+                "endpoint": self.name,
+                "priority": priority,
+                "queue_depth": len(self._waiting),
+            }}
+        )
+
+# Shared by every ResilientLlm, so agents on the same endpoint see the same circuit and slots
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[Tuple[str, str], LatencyTracker] = {}
+_limiters: Dict[str, EndpointLimiter] = {}
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """Get the circuit breaker of an endpoint."""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+def get_limiter(endpoint: str) -> Optional[EndpointLimiter]:
+    """Get the concurrency limiter of an endpoint, None for Gemini, which is not limited."""
+    if endpoint == GEMINI_ENDPOINT:
+        return None
+    limiter = _limiters.get(endpoint)
+    if limiter is None:
+        limiter = _limiters[endpoint] = EndpointLimiter(endpoint)
+    return limiter
+
+def get_latency_tracker(endpoint: str, model: str) -> LatencyTracker:
+    """Get the latency tracker of a model on an endpoint."""
+    tracker = _latencies.get((endpoint, model))
+    if tracker is None:
+        tracker = _latencies[(endpoint, model)] = LatencyTracker()
+    return tracker
+
+class ResilientLlm(BaseLlm):
+    """Wraps a model with a circuit breaker, deadlines and an optional fallback model.
+
+    When the primary model takes longer than its usual latency (MODEL_HEDGE_PERCENTILE of
+    recent calls) a hedged request is sent to the fallback model and whichever answers first
+    is used. The fallback is also used when the primary fails or its circuit is open.
+    Responses are collected before they are yielded, so a failed or losing call never hands
+    out partial output. Calls to a LiteLLM endpoint wait for one of its slots, served in
+    `priority` order. Streaming is not supported.
+    """
+
+    primary: BaseLlm
+    endpoint: str
+    priority: int = CONVERSATION_PRIORITY
+    fallback: Optional[BaseLlm] = None
+    fallback_endpoint: Optional[str] = None
+
+    def __init__(self, **data):
+        data.setdefault("model", data["primary"].model)
+        super().__init__(**data)
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        for response in await self._generate(llm_request):
+            yield response
+
+    async def _call(self, llm: BaseLlm, endpoint: str, llm_request: LlmRequest) -> List[LlmResponse]:
+        """Make one call that the endpoint's breaker already allowed, within the deadline."""
+        breaker = get_breaker(endpoint)
+        # Models may modify the request, and a hedged call must not see the other call's changes
+        request = llm_request.model_copy(deep=True)
+        request.model = llm.model
+        timeout = remaining_time()
+        if timeout is not None and timeout <= 0:
+            # The turn ran out of time before this call, which says nothing about the endpoint's health
+            breaker.release()
+            raise TimeoutError(f"Deadline exceeded before calling {llm.model}")
+        try:
+            responses, latency = await asyncio.wait_for(self._limited_collect(llm, endpoint, request), timeout=timeout)
+        except ModelOverloadedError:
+            # Shed before it was sent, which says nothing about the endpoint's health
+            breaker.release()
+            raise
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except asyncio.TimeoutError:
+            # The turn's deadline passed, possibly while waiting for a slot, so like a shed call
+            # it is not counted against the endpoint
+            logger.warning(f"Model {llm.model} at {endpoint} did not answer before the turn's deadline")
+            breaker.release()
+            raise
+        except Exception as e:
+            logger.warning(f"Model {llm.model} at {endpoint} failed: {e!r}")
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        get_latency_tracker(endpoint, llm.model).add(latency)
+        return responses
+
+    async def _limited_collect(self, llm: BaseLlm, endpoint: str, llm_request: LlmRequest) -> Tuple[List[LlmResponse], float]:
+        """Collect the responses of a call, returning them with the call's latency excluding time spent queued."""
+        limiter = get_limiter(endpoint)
+        async with limiter.slot(self.priority) if limiter is not None else contextlib.nullcontext():
+            started = time.monotonic()
+            responses = [response async for response in llm.generate_content_async(llm_request, stream=False)]
+            return responses, time.monotonic() - started
+
+    def _start_fallback(self, llm_request: LlmRequest) -> Optional[asyncio.Task]:
+        if self.fallback is None or not get_breaker(self.fallback_endpoint).allow_request():
+            return None
+        return asyncio.create_task(self._call(self.fallback, self.fallback_endpoint, llm_request))
+
+    async def _generate(self, llm_request: LlmRequest) -> List[LlmResponse]:
+        tasks = set()
+        fallback_started = False
+        if get_breaker(self.endpoint).allow_request():
+            tasks.add(asyncio.create_task(self._call(self.primary, self.endpoint, llm_request)))
+        else:
+            logger.warning(f"Circuit for {self.endpoint} is open, skipping {self.primary.model}")
+
+        try:
+            if not tasks:
+                fallback = self._start_fallback(llm_request)
+                if fallback is None:
+                    raise ModelUnavailableError(f"No model available for {self.model}, circuit for {self.endpoint} is open")
+                tasks.add(fallback)
+                fallback_started = True
+            elif self.fallback is not None and MODEL_HEDGE_PERCENTILE > 0:
+                hedge_delay = get_latency_tracker(self.endpoint, self.primary.model).percentile(MODEL_HEDGE_PERCENTILE)
+                if hedge_delay is not None:
+                    done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                    if not done:
+                        hedge = self._start_fallback(llm_request)
+                        if hedge is not None:
+                            logger.info(f"{self.primary.model} slower than {hedge_delay:.1f}s, hedging with {self.fallback.model}")
+                            tasks.add(hedge)
+                            fallback_started = True
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not tasks and not fallback_started:
+                    fallback_started = True
+                    fallback = self._start_fallback(llm_request)
+                    if fallback is not None:
+                        logger.info(f"Retrying failed {self.primary.model} call with {self.fallback.model}")
+                        tasks.add(fallback)
+            raise error
+        finally:
+            # The losing call of a hedge, or every call if the caller was cancelled
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+import contextlib
+from datetime import datetime
+from typing import List, Optional, Tuple
+import aiohttp
+from google.adk.models import BaseLlm, Gemini, LlmRequest
+from google.genai import types
+from agentConversation import get_conversation_agent, get_search_agent
+from agentSummariser import get_summarising_agent
+from bot.config.models import (
+    MODEL_KEEPALIVE_INTERVAL,
+    MODEL_PREWARM_LEAD,
+    MODEL_WARMUP_TIMEOUT,
+    OLLAMA_KEEP_ALIVE,
+)
+from bot.config.settings import WAKE_UP_TIME
+from bot.services.database_service import DatabaseService
+from bot.services.model_resilience import ModelOverloadedError, WARMUP_PRIORITY, get_limiter
+from bot.utils.time_utils import next_time_of_day, now
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PROMPT = "Hi"
+
+def _ollama_model(llm: BaseLlm) -> Optional[str]:
+    """Get the Ollama name of a LiteLLM model, None if it is not served by Ollama."""
+    provider, _, name = llm.model.partition("/")
+    return name if provider.startswith("ollama") and name else None
+
+class ModelWarmer:
+    """Keeps the connections to the model backends open and local models loaded.
+
+    Every model the agents use is warmed up at start-up with a one token generation, which
+    opens the client's connection pool and makes Ollama load the model. While any chat is
+    online the backends get a keep-alive ping every MODEL_KEEPALIVE_INTERVAL, and when no
+    chat is online the models are warmed up again MODEL_PREWARM_LEAD seconds before
+    WAKE_UP_TIME or before the first offline chat comes back.
+    """
+
+    def __init__(self, db: DatabaseService, keepalive_interval: int = MODEL_KEEPALIVE_INTERVAL,
+                 prewarm_lead: int = MODEL_PREWARM_LEAD):
+        self.db = db
+        self.keepalive_interval = keepalive_interval
+        self.prewarm_lead = prewarm_lead
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._prewarmed_for: Optional[datetime] = None
+
+    def _models(self) -> List[Tuple[BaseLlm, str]]:
+        """Get each model the agents may call with its endpoint, including fallbacks."""
+        models = []
+        seen = set()
+        for agent in (get_conversation_agent(), get_search_agent(), get_summarising_agent()):
+            resilient = agent.model
+            for llm, endpoint in ((resilient.primary, resilient.endpoint), (resilient.fallback, resilient.fallback_endpoint)):
+                if llm is None or (llm.model, endpoint) in seen:
+                    continue
+                seen.add((llm.model, endpoint))
+                models.append((llm, endpoint))
+        return models
+
+    async def warm_up(self, reason: str):
+        """Send a one token generation to every model, at the lowest priority on limited endpoints."""
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(self._warm_up_model(llm, endpoint) for llm, endpoint in self._models()),
+            return_exceptions=True,
+        )
+        warmed = sum(1 for result in results if result is True)
+        logger.info(
+            f"Warmed up {warmed} of {len(results)} models ({reason}) in {time.monotonic() - started:.2f}s",
+            extra={"extra_data": {
+                "metric": "model_warmup",
+                "reason": reason,
+                "models": len(results),
+                "warmed": warmed,
+                "seconds": round(time.monotonic() - started, 3),
+            }}
+        )
+
+    async def _warm_up_model(self, llm: BaseLlm, endpoint: str) -> bool:
+        started = time.monotonic()
+        limiter = get_limiter(endpoint)
+        try:
+            async with limiter.slot(WARMUP_PRIORITY) if limiter is not None else contextlib.nullcontext():
+                if _ollama_model(llm) is not None:
+                    # Loads the model and keeps it loaded for OLLAMA_KEEP_ALIVE
+                    await self._ollama_keep_alive(llm, endpoint)
+                await asyncio.wait_for(self._generate(llm, endpoint), timeout=MODEL_WARMUP_TIMEOUT)
+        except ModelOverloadedError:
+            # The endpoint is busy with real calls, so it is warm already
+            logger.debug(f"Skipped warming up {llm.model}, {endpoint} is busy")
+            return False
+        except Exception as e:
+            logger.warning(f"Could not warm up {llm.model} at {endpoint}: {e!r}")
+            return False
+        logger.debug(f"Warmed up {llm.model} at {endpoint} in {time.monotonic() - started:.2f}s")
+        return True
+
+    async def _generate(self, llm: BaseLlm, endpoint: str):
+        if isinstance(llm, Gemini):
+            request = LlmRequest(
+                model=llm.model,
+                contents=[types.Content(role="user", parts=[types.Part(text=WARMUP_PROMPT)])],
+                config=types.GenerateContentConfig(max_output_tokens=1),
+            )
+            async for _ in llm.generate_content_async(request):
+                pass
+        else:
+            # LiteLlm takes its token limit from its constructor, so the call is made on its client directly
+            await llm.llm_client.acompletion(
+                model=llm.model,
+                messages=[{"role": "user", "content": WARMUP_PROMPT}],
+                tools=None,
+                api_base=endpoint,
+                max_tokens=1,
+                timeout=MODEL_WARMUP_TIMEOUT,
+            )
+
+    async def _ollama_keep_alive(self, llm: BaseLlm, endpoint: str):
+        """Load an Ollama model, or extend how long it stays loaded, without generating anything."""
+        if self._http is None:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=MODEL_WARMUP_TIMEOUT))
+        base_url = endpoint.rstrip("/").removesuffix("/v1")
+        async with self._http.post(
+            f"{base_url}/api/generate",
+            json={"model": _ollama_model(llm), "keep_alive": OLLAMA_KEEP_ALIVE},
+        ) as response:
+            response.raise_for_status()
+
+    async def keep_alive(self):
+        """Ping every model backend so its connections stay open and local models stay loaded."""
+        for llm, endpoint in self._models():
+            try:
+                if _ollama_model(llm) is not None:
+                    await self._ollama_keep_alive(llm, endpoint)
+                elif isinstance(llm, Gemini):
+                    # Counting tokens is free and keeps the client's connection open
+                    await asyncio.wait_for(
+                        llm.api_client.aio.models.count_tokens(model=llm.model, contents=WARMUP_PROMPT),
+                        timeout=MODEL_WARMUP_TIMEOUT,
+                    )
+                else:
+                    await self._warm_up_model(llm, endpoint)
+            except Exception as e:
+                logger.warning(f"Keep-alive ping to {llm.model} at {endpoint} failed: {e!r}")
+
+    def _next_wake_up(self) -> datetime:
+        """Get the next time chats come back online, WAKE_UP_TIME or an offline chat's return."""
+        wake_up = next_time_of_day(WAKE_UP_TIME)
+        chat_return = self.db.get_next_chat_return()
+        return min(wake_up, chat_return) if chat_return is not None else wake_up
+
+    async def run(self):
+        """Warm up the models, then keep them warm until cancelled."""
+        try:
+            await self.warm_up("start-up")
+            while True:
+                delay = self.keepalive_interval
+                try:
+                    if self.db.count_online_chats() > 0:
+                        await self.keep_alive()
+                    else:
+                        wake_up = self._next_wake_up()
+                        until_prewarm = (wake_up - now()).total_seconds() - self.prewarm_lead
+                        if until_prewarm <= 0 and wake_up != self._prewarmed_for:
+                            self._prewarmed_for = wake_up
+                            await self.warm_up(f"before {wake_up:%H:%M:%S}")
+                        elif until_prewarm > 0:
+                            delay = min(delay, until_prewarm)
+                except Exception as e:
+                    logger.error(f"Error keeping the models warm: {e}")
+                await asyncio.sleep(max(delay, 1))
+        finally:
+            if self._http is not None:
+                await self._http.close()
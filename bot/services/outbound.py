@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import contextlib
+from bot.config.settings import OUTBOUND_POLL_INTERVAL, QUEUE_MAX_DELIVERIES
+from bot.services.database_service import DatabaseService
+
+logger = logging.getLogger(__name__)
+
+class OutboundQueueClient:
+    """Stands in for the TelegramClient in worker processes.
+
+    Only the ingest process holds the Telegram connection, so messages are written to the
+    outbound_messages table and sent from there by the OutboundDispatcher.
+    """
+
+    def __init__(self, db: DatabaseService):
+        self.db = db
+
+    async def send_message(self, chat_id, message: str):
+        """Queue a message for the ingest process to send."""
+        self.db.enqueue_outbound_message(str(chat_id), message)
+
+    def action(self, chat_id, action: str):
+        """Chat actions such as typing need the Telegram connection, so they are skipped."""
+        return contextlib.nullcontext()
+
+class OutboundDispatcher:
+    """Sends the replies queued by worker processes, in order per chat.
+
+    The client is the SendScheduler, which waits out flood waits itself.
+    """
+
+    def __init__(self, client, db: DatabaseService, poll_interval: float = OUTBOUND_POLL_INTERVAL):
+        self.client = client
+        self.db = db
+        self.poll_interval = poll_interval
+
+    async def run(self):
+        """Send queued messages until cancelled."""
+        while True:
+            try:
+                sent = await self.dispatch_once()
+                if not sent:
+                    await asyncio.sleep(self.poll_interval)
+            except Exception as e:
+                logger.error(f"Error in outbound dispatcher: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def dispatch_once(self) -> int:
+        """Send one batch of queued messages.
+
+        Returns:
+            Number of messages sent
+        """
+        chats = {}
+        for item in self.db.claim_outbound_messages():
+            chats.setdefault(item["chat_id"], []).append(item)
+        # Chats are sent concurrently, so the rate limit of one chat does not hold up the others
+        results = await asyncio.gather(*(self._dispatch_chat(chat_id, items) for chat_id, items in chats.items()))
+        return sum(results)
+
+    async def _dispatch_chat(self, chat_id: str, items: list) -> int:
+        """Send a chat's claimed messages in order."""
+        sent = 0
+        for index, item in enumerate(items):
+            try:
+                await self.client.send_message(int(chat_id), item["message"])
+                self.db.ack_outbound_message(item["id"])
+                sent += 1
+                continue
+            except Exception as e:
+                if item["attempts"] >= QUEUE_MAX_DELIVERIES:
+                    logger.error(f"Dropping outbound message {item['id']} for chat {chat_id} after {item['attempts']} attempts: {e}")
+                    self.db.ack_outbound_message(item["id"])
+                    continue
+                retry_after = 2 ** item["attempts"]
+                logger.warning(f"Failed to send outbound message {item['id']} to chat {chat_id}, retrying in {retry_after} seconds: {e}")
+            # The rest of the chat's batch waits behind the failed message to keep the order
+            for waiting in items[index:]:
+                self.db.retry_outbound_message(waiting["id"], retry_after)
+            break
+        return sent
@@ -0,0 +1,90 @@
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional, Set
+from bot.config.settings import REPLY_GRAPH_MAX_MESSAGES, REPLY_GRAPH_MAX_CHATS, REPLY_GRAPH_RETENTION_DAYS
+from bot.services.database_service import DatabaseService
+from bot.utils.time_utils import now
+
+logger = logging.getLogger(__name__)
+
+# Reply chains longer than this are not followed any further
+MAX_CHAIN_DEPTH = 50
+
+class ReplyGraph:
+    """The reply edges of one chat, message id to the id of the message it replies to."""
+
+    def __init__(self, max_messages: int = REPLY_GRAPH_MAX_MESSAGES):
+        self.max_messages = max_messages
+        self.parents: "OrderedDict[int, Optional[int]]" = OrderedDict()
+        self.bot_messages: Set[int] = set()
+        # Id of the newest database row loaded, to only fetch newer edges on refresh
+        self.last_row_id = 0
+
+    def add(self, message_id: int, parent_id: Optional[int], from_bot: bool = False):
+        self.parents[message_id] = parent_id
+        self.parents.move_to_end(message_id)
+        if from_bot:
+            self.bot_messages.add(message_id)
+        while len(self.parents) > self.max_messages:
+            oldest, _ = self.parents.popitem(last=False)
+            self.bot_messages.discard(oldest)
+
+    def touches_bot(self, message_id: int) -> bool:
+        """Check whether a message is, or replies through a chain of replies to, a message from the bot."""
+        current: Optional[int] = message_id
+        for _ in range(MAX_CHAIN_DEPTH):
+            if current is None:
+                return False
+            if current in self.bot_messages:
+                return True
+            current = self.parents.get(current)
+        return False
+
+class ReplyGraphIndex:
+    """Reply graphs of the chats, kept in memory and persisted in the reply_edges table.
+
+    Incoming messages are recorded as they are queued and the bot's messages once they are
+    sent. Other processes write edges too (the ingest process records what a worker's turn
+    reads), so a graph picks up newer rows from the database every time it is read.
+    """
+
+    def __init__(self, db: DatabaseService, max_chats: int = REPLY_GRAPH_MAX_CHATS):
+        self.db = db
+        self.max_chats = max_chats
+        self._graphs: "OrderedDict[str, ReplyGraph]" = OrderedDict()
+
+    def _graph(self, chat_id: str) -> ReplyGraph:
+        graph = self._graphs.get(chat_id)
+        if graph is None:
+            graph = self._graphs[chat_id] = ReplyGraph()
+        self._graphs.move_to_end(chat_id)
+        while len(self._graphs) > self.max_chats:
+            self._graphs.popitem(last=False)
+        return graph
+
+    def get(self, chat_id: str) -> ReplyGraph:
+        """Get a chat's reply graph, including edges recorded since it was last read."""
+        graph = self._graph(str(chat_id))
+        for row_id, message_id, parent_id, from_bot in self.db.get_reply_edges(str(chat_id), after_id=graph.last_row_id,
+                                                                               limit=graph.max_messages):
+            graph.add(message_id, parent_id, from_bot)
+            graph.last_row_id = row_id
+        return graph
+
+    def record(self, chat_id, message_id: int, parent_id: Optional[int], from_bot: bool = False):
+        """Record a message of a chat and the message it replies to."""
+        try:
+            self.db.add_reply_edge(str(chat_id), message_id, parent_id, from_bot)
+        except Exception as e:
+            logger.error(f"Error recording reply edge for message {message_id} in chat {chat_id}: {e}")
+
+    def record_sent(self, chat_id, message):
+        """Record a message the bot sent, called with the Telegram message returned by the send."""
+        if message is None or getattr(message, "id", None) is None:
+            return
+        self.record(chat_id, message.id, getattr(message, "reply_to_msg_id", None), from_bot=True)
+
+    def prune(self, retention_days: int = REPLY_GRAPH_RETENTION_DAYS) -> int:
+        """Delete the reply edges older than the retention period."""
+        return self.db.delete_reply_edges_before(now() - timedelta(days=retention_days))
@@ -0,0 +1,219 @@
+import time
+import random
+import asyncio
+import logging
+import itertools
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+from telethon.errors import FloodWaitError
+from bot.config.settings import SEND_GLOBAL_RATE, SEND_PRIVATE_CHAT_RATE, SEND_GROUP_CHAT_RATE
+
+logger = logging.getLogger(__name__)
+
+# Send priorities, lower is sent first
+URGENT = 0
+PRIVATE = 1
+GROUP = 2
+
+# Sends to a chat stay urgent for this long after /urgent
+URGENT_WINDOW_SECONDS = 300
+# Messages a chat can send back to back before its rate applies
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_BURST = 5
+# Minimum pause between two messages to the same chat, (low, high, mode) in seconds, so
+# split replies still read like someone typing
+HUMAN_SPACING = (1, 4, 3)
+# Chat state is forgotten after this long without sends
+IDLE_CHAT_SECONDS = 600
+
+class TokenBucket:
+    """Allows `rate` sends per second on average with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Allow no sends for the next `seconds`."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class _Outgoing:
+    def __init__(self, message: str, priority: int, seq: int, future: asyncio.Future):
+        self.message = message
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+class _ChatState:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.pending: Deque[_Outgoing] = deque()
+        self.not_before = 0.0
+        self.in_flight = False
+
+class SendScheduler:
+    """Sends messages through the Telegram client within Telegram's flood limits.
+
+    Every send takes a token from a global bucket and from its chat's bucket. Messages to a
+    chat go out in order with human-like spacing between them, and across chats urgent
+    replies go first, then private chats, then groups. A FloodWaitError pauses the chat and
+    the global bucket, since Telegram's flood limits apply to the whole account, and the
+    message is sent again once the wait is over.
+    """
+
+    def __init__(self, client, global_rate: float = SEND_GLOBAL_RATE,
+                 private_rate: float = SEND_PRIVATE_CHAT_RATE, group_rate: float = SEND_GROUP_CHAT_RATE):
+        self.client = client
+        self.private_rate = private_rate
+        self.group_rate = group_rate / 60
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats: Dict[int, _ChatState] = {}
+        self._urgent_until: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        # References to running sends, the event loop only keeps weak ones
+        self._sending = set()
+        # Called with the chat ID and the sent Telegram message after every successful send
+        self.on_sent: Optional[Callable] = None
+
+    def mark_urgent(self, chat_id, seconds: float = URGENT_WINDOW_SECONDS):
+        """Send a chat's messages ahead of other chats for a while."""
+        self._urgent_until[int(chat_id)] = time.monotonic() + seconds
+
+    def _priority(self, chat_id: int) -> int:
+        urgent_until = self._urgent_until.get(chat_id)
+        if urgent_until is not None:
+            if urgent_until > time.monotonic():
+                return URGENT
+            del self._urgent_until[chat_id]
+        # Telegram uses positive ids for users and negative ids for groups and channels
+        return PRIVATE if chat_id > 0 else GROUP
+
+    def _chat(self, chat_id: int) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            if chat_id > 0:
+                bucket = TokenBucket(self.private_rate, PRIVATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(self.group_rate, GROUP_CHAT_BURST)
+            state = self._chats[chat_id] = _ChatState(bucket)
+        return state
+
+    async def send(self, chat_id, message: str, priority: Optional[int] = None):
+        """Queue a message and wait until it has been sent.
+
+        Args:
+            chat_id: Chat to send to
+            message: Text of the message
+            priority: URGENT, PRIVATE or GROUP, derived from the chat if not given
+
+        Returns:
+            The sent Telegram message
+        """
+        chat_id = int(chat_id)
+        if priority is None:
+            priority = self._priority(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        self._chat(chat_id).pending.append(_Outgoing(message, priority, next(self._seq), future))
+        self._wakeup.set()
+        return await future
+
+    async def send_message(self, chat_id, message: str):
+        """Same as send, with the signature of TelegramClient.send_message."""
+        return await self.send(chat_id, message)
+
+    async def run(self):
+        """Send queued messages until cancelled."""
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = self._dispatch_ready()
+            except Exception as e:
+                logger.error(f"Error in send scheduler: {e}")
+                delay = 1
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready(self) -> Optional[float]:
+        """Start the sends that are allowed now.
+
+        Returns:
+            Seconds until the next send could be allowed, None if nothing is waiting
+        """
+        now = time.monotonic()
+        ready = []
+        next_delay = None
+        for chat_id, state in list(self._chats.items()):
+            if state.in_flight:
+                continue
+            # Senders that gave up (e.g. a cancelled turn) no longer need their message sent
+            while state.pending and state.pending[0].future.done():
+                state.pending.popleft()
+            if not state.pending:
+                if state.not_before < now - IDLE_CHAT_SECONDS:
+                    del self._chats[chat_id]
+                continue
+            wait = max(state.not_before - now, state.bucket.wait_time(now))
+            if wait > 0:
+                next_delay = wait if next_delay is None else min(next_delay, wait)
+                continue
+            ready.append((state.pending[0].priority, state.pending[0].seq, chat_id, state))
+
+        for _, _, chat_id, state in sorted(ready):
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait > 0:
+                return global_wait if next_delay is None else min(next_delay, global_wait)
+            self.global_bucket.take(now)
+            state.bucket.take(now)
+            state.in_flight = True
+            task = asyncio.create_task(self._deliver(chat_id, state))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        return next_delay
+
+    async def _deliver(self, chat_id: int, state: _ChatState):
+        item = state.pending[0]
+        try:
+            result = await self.client.send_message(chat_id, item.message)
+        except FloodWaitError as e:
+            # The message stays at the head of the chat's queue and is sent after the wait
+            logger.warning(f"Flood wait of {e.seconds} seconds for chat {chat_id}, rescheduling message")
+            state.not_before = time.monotonic() + e.seconds
+            self.global_bucket.pause(time.monotonic(), e.seconds)
+        except Exception as e:
+            state.pending.popleft()
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            state.pending.popleft()
+            state.not_before = time.monotonic() + random.triangular(*HUMAN_SPACING)
+            if not item.future.done():
+                item.future.set_result(result)
+            if self.on_sent is not None:
+                try:
+                    self.on_sent(chat_id, result)
+                except Exception as e:
+                    logger.error(f"Error in send callback for chat {chat_id}: {e}")
+        finally:
+            state.in_flight = False
+            self._wakeup.set()
@@ -0,0 +1,114 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+from bot.config.settings import SENDER_CACHE_SIZE, SENDER_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class SenderProfile:
+    """What the message queue shows of a sender."""
+    first_name: Optional[str]
+    username: Optional[str]
+
+    @classmethod
+    def from_entity(cls, entity) -> "SenderProfile":
+        # Anonymous group admins and channels send as a channel, which has a title instead
+        return cls(getattr(entity, 'first_name', None) or getattr(entity, 'title', None), getattr(entity, 'username', None))
+
+UNKNOWN_SENDER = SenderProfile("Unknown User", "Unknown Username")
+
+class SenderCache:
+    """LRU cache of sender profiles by sender id, entries older than the TTL are refreshed.
+
+    Most updates carry the sender, which is cached as is without an API call. Only senders
+    the update leaves out, or only has the minimal version of, are fetched, and concurrent
+    lookups of the same sender share one fetch. An expired profile is still returned while
+    a fresh one is fetched in the background, so a busy group never waits on a refresh.
+    """
+
+    def __init__(self, max_size: int = SENDER_CACHE_SIZE, ttl: float = SENDER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._profiles: "OrderedDict[int, Tuple[SenderProfile, float]]" = OrderedDict()
+        self._fetches: Dict[int, asyncio.Future] = {}
+        self._refreshes: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, sender_id: int, profile: SenderProfile, fetched_at: Optional[float] = None):
+        self._profiles[sender_id] = (profile, time.monotonic() if fetched_at is None else fetched_at)
+        self._profiles.move_to_end(sender_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    async def get(self, event) -> SenderProfile:
+        """Get the profile of the sender of a Telethon message event."""
+        sender_id = event.sender_id
+        if sender_id is None:
+            return UNKNOWN_SENDER
+        sender = event.sender
+        if sender is not None and not getattr(sender, 'min', False):
+            self.hits += 1
+            profile = SenderProfile.from_entity(sender)
+            self.put(sender_id, profile)
+            return profile
+
+        cached = self._profiles.get(sender_id)
+        if cached is None and sender is not None:
+            # A min sender has the name but may lack the username, use it until the full one is fetched
+            cached = (SenderProfile.from_entity(sender), 0.0)
+            self.put(sender_id, *cached)
+        if cached is not None:
+            self.hits += 1
+            self._profiles.move_to_end(sender_id)
+            profile, fetched_at = cached
+            if time.monotonic() - fetched_at > self.ttl and sender_id not in self._fetches:
+                task = asyncio.create_task(self._fetch(sender_id, event))
+                self._refreshes.add(task)
+                task.add_done_callback(self._refreshes.discard)
+            return profile
+
+        self.misses += 1
+        return await self._fetch(sender_id, event)
+
+    async def _fetch(self, sender_id: int, event) -> SenderProfile:
+        """Fetch a sender, joining the fetch of the same sender that is already running."""
+        fetch = self._fetches.get(sender_id)
+        if fetch is None:
+            fetch = self._fetches[sender_id] = asyncio.ensure_future(self._load(sender_id, event))
+            fetch.add_done_callback(lambda _: self._fetches.pop(sender_id, None))
+        # Shielded so a cancelled message handler doesn't cancel the fetch others are waiting on
+        return await asyncio.shield(fetch)
+
+    async def _load(self, sender_id: int, event) -> SenderProfile:
+        started = time.perf_counter()
+        try:
+            # Asks Telegram when the event has no sender or only the min one
+            sender = await event.get_sender()
+        except Exception as e:
+            logger.warning(f"Could not fetch sender {sender_id}: {e}")
+            cached = self._profiles.get(sender_id)
+            if cached is None:
+                return UNKNOWN_SENDER
+            # Keep the old profile another TTL rather than retrying on every message
+            self.put(sender_id, cached[0])
+            return cached[0]
+        if sender is None:
+            return UNKNOWN_SENDER
+        profile = SenderProfile.from_entity(sender)
+        self.put(sender_id, profile)
+        logger.debug(
+            f"Fetched sender {sender_id} in {(time.perf_counter() - started) * 1000:.1f}ms",
+            extra={"extra_data": {
+                "metric": "sender_fetch",
+                "sender_id": sender_id,
+                "milliseconds": round((time.perf_counter() - started) * 1000, 3),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+            }}
+        )
+        return profile
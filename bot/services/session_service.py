@@ -0,0 +1,422 @@
+import copy
+import json
+import uuid
+import zlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+from sqlalchemy import JSON, Column, String, Integer, Float, Boolean, LargeBinary, bindparam, update, delete, exists, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
+from google.adk.sessions.state import State
+from bot.config.settings import SESSION_CACHE_SIZE
+from bot.utils.db_engine import get_engine, ensure_tables, is_sqlite
+from bot.utils.time_utils import now
+from bot.utils.token_estimator import SessionTokenCounter, TokenEstimator
+from bot.utils.db_types import TZDateTime
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+class AgentSession(Base):
+    __tablename__ = 'agent_sessions'
+
+    app_name = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    id = Column(String, primary_key=True)
+    state = Column(JSON().with_variant(JSONB(), 'postgresql'), nullable=False, default=dict)
+    # Events before first_seq were reset away, next_seq is the sequence number of the next event
+    first_seq = Column(Integer, nullable=False, default=1)
+    next_seq = Column(Integer, nullable=False, default=1)
+    created_at = Column(TZDateTime, default=now)
+    update_time = Column(TZDateTime, default=now)
+
+class AgentSessionEvent(Base):
+    __tablename__ = 'agent_session_events'
+
+    # Append-only, an event is never changed once written
+    app_name = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    session_id = Column(String, primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    event_id = Column(String, nullable=False)
+    author = Column(String, nullable=True)
+    timestamp = Column(Float, nullable=False)
+    # Characters of the event's content as JSON, to size sessions without reading the payloads
+    size = Column(Integer, nullable=False, default=0)
+    # The event as JSON, zlib compressed unless it was migrated from the ADK events table
+    compressed = Column(Boolean, nullable=False, default=True)
+    payload = Column(LargeBinary, nullable=False)
+
+def _encode_event(event: Event) -> bytes:
+    return zlib.compress(event.model_dump_json(exclude_none=True).encode())
+
+def _decode_event(payload: bytes, compressed: bool) -> Event:
+    return Event.model_validate_json(zlib.decompress(payload) if compressed else payload)
+
+def _session_state(state: Optional[dict[str, Any]]) -> dict[str, Any]:
+    """Drop the temp: keys of a state, which only live for one invocation."""
+    return {key: value for key, value in (state or {}).items() if not key.startswith(State.TEMP_PREFIX)}
+
+@dataclass
+class _CachedSession:
+    """A session's state and its events since the last reset, as of next_seq."""
+    state: dict[str, Any]
+    first_seq: int
+    next_seq: int
+    update_time: float
+    events: List[Event] = field(default_factory=list)
+
+def _sqlite_json_merge(column, delta: dict[str, Any]):
+    """SQLite version of jsonb ||. json_patch would remove the keys set to None, so each key
+    is set with json_set instead, at most 50 per call to stay under SQLite's argument limit."""
+    merged = column
+    items = list(delta.items())
+    for start in range(0, len(items), 50):
+        arguments = []
+        for key, value in items[start:start + 50]:
+            arguments.extend([f'$."{key}"', func.json(json.dumps(value))])
+        merged = func.json_set(merged, *arguments)
+    return merged
+
+class EventLogSessionService(BaseSessionService):
+    """Session service keeping each session's events in an append-only table.
+
+    Every event gets the next sequence number of its session and is stored zlib compressed,
+    appending it takes a single transaction. A session's events can be read from the tail
+    (the last N, or those after a time) without loading the rest, and recently active
+    sessions are kept in an LRU so reading them again only fetches the newer events.
+
+    `reset_events` replaces delete and create: it moves the session's start past its events
+    and sets the new state in one update, the old events are purged later by
+    `purge_reset_events`. The app: and user: state prefixes are not shared between sessions,
+    they are kept in each session's state like any other key.
+    """
+
+    def __init__(self, db_url: str, cache_size: int = SESSION_CACHE_SIZE):
+        self.engine = get_engine(db_url)
+        self.Session = sessionmaker(bind=self.engine)
+        ensure_tables(Base.metadata, self.engine)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple[str, str, str], _CachedSession]" = OrderedDict()
+
+    def _cache_put(self, key: tuple[str, str, str], cached: _CachedSession):
+        self._cache[key] = cached
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _to_session(self, app_name: str, user_id: str, session_id: str, state: dict[str, Any],
+                    update_time: float, events: List[Event]) -> Session:
+        # The runner changes the state and events of the session it is given, so it gets its own copies
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=copy.deepcopy(state),
+                       events=list(events), last_update_time=update_time)
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None,
+                             session_id: Optional[str] = None) -> Session:
+        session_id = session_id or str(uuid.uuid4())
+        state = _session_state(state)
+        created = now()
+        db_session = self.Session()
+        try:
+            db_session.add(AgentSession(app_name=app_name, user_id=user_id, id=session_id, state=state,
+                                        first_seq=1, next_seq=1, created_at=created, update_time=created))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error creating session {session_id}: {e}")
+            raise
+        finally:
+            db_session.close()
+        self._cache_put((app_name, user_id, session_id), _CachedSession(copy.deepcopy(state), 1, 1, created.timestamp()))
+        return self._to_session(app_name, user_id, session_id, state, created.timestamp(), [])
+
+    async def get_session(self, *, app_name: str, user_id: str, session_id: str,
+                          config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        key = (app_name, user_id, session_id)
+        db_session = self.Session()
+        try:
+            row = db_session.get(AgentSession, key)
+            if row is None:
+                self._cache.pop(key, None)
+                return None
+            cached = self._cache.get(key)
+            if cached is not None and cached.first_seq == row.first_seq and cached.next_seq <= row.next_seq:
+                # Only the events appended since the session was cached are read
+                if cached.next_seq < row.next_seq:
+                    cached.events.extend(self._read_events(db_session, key, after_seq=cached.next_seq - 1))
+                cached.state = dict(row.state)
+                cached.next_seq = row.next_seq
+                cached.update_time = row.update_time.timestamp()
+                self._cache.move_to_end(key)
+                events = cached.events
+            elif config is not None and (config.num_recent_events or config.after_timestamp):
+                # A tail read of a session that is not cached is not worth caching
+                events = self._read_events(db_session, key, after_seq=row.first_seq - 1,
+                                           limit=config.num_recent_events, after_timestamp=config.after_timestamp)
+                return self._to_session(app_name, user_id, session_id, row.state, row.update_time.timestamp(), events)
+            else:
+                events = self._read_events(db_session, key, after_seq=row.first_seq - 1)
+                self._cache_put(key, _CachedSession(dict(row.state), row.first_seq, row.next_seq,
+                                                    row.update_time.timestamp(), list(events)))
+        finally:
+            db_session.close()
+
+        if config is not None and config.after_timestamp:
+            events = [event for event in events if event.timestamp >= config.after_timestamp]
+        if config is not None and config.num_recent_events:
+            events = events[-config.num_recent_events:]
+        return self._to_session(app_name, user_id, session_id, row.state, row.update_time.timestamp(), events)
+
+    @staticmethod
+    def _read_events(db_session, key: tuple[str, str, str], after_seq: int, limit: Optional[int] = None,
+                     after_timestamp: Optional[float] = None) -> List[Event]:
+        """Read the events of a session after a sequence number, oldest first, or only the last `limit` of them."""
+        app_name, user_id, session_id = key
+        query = db_session.query(AgentSessionEvent.payload, AgentSessionEvent.compressed).filter(
+            AgentSessionEvent.app_name == app_name,
+            AgentSessionEvent.user_id == user_id,
+            AgentSessionEvent.session_id == session_id,
+            AgentSessionEvent.seq > after_seq,
+        )
+        if after_timestamp:
+            query = query.filter(AgentSessionEvent.timestamp >= after_timestamp)
+        if limit:
+            rows = list(reversed(query.order_by(AgentSessionEvent.seq.desc()).limit(limit).all()))
+        else:
+            rows = query.order_by(AgentSessionEvent.seq).all()
+        return [_decode_event(row.payload, row.compressed) for row in rows]
+
+    async def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        """List the sessions of a user, without their state and events like the ADK services."""
+        db_session = self.Session()
+        try:
+            rows = db_session.query(AgentSession.id, AgentSession.update_time).filter(
+                AgentSession.app_name == app_name,
+                AgentSession.user_id == user_id,
+            ).order_by(AgentSession.created_at).all()
+            return ListSessionsResponse(sessions=[
+                Session(app_name=app_name, user_id=user_id, id=row.id, state={}, last_update_time=row.update_time.timestamp())
+                for row in rows
+            ])
+        finally:
+            db_session.close()
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        db_session = self.Session()
+        try:
+            db_session.execute(delete(AgentSessionEvent).where(
+                AgentSessionEvent.app_name == app_name,
+                AgentSessionEvent.user_id == user_id,
+                AgentSessionEvent.session_id == session_id,
+            ))
+            db_session.execute(delete(AgentSession).where(
+                AgentSession.app_name == app_name,
+                AgentSession.user_id == user_id,
+                AgentSession.id == session_id,
+            ))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error deleting session {session_id}: {e}")
+            raise
+        finally:
+            db_session.close()
+        self._cache.pop((app_name, user_id, session_id), None)
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
+        key = (session.app_name, session.user_id, session.id)
+        state_delta = _session_state(event.actions.state_delta if event.actions else None)
+        updated = now()
+        values = {"next_seq": AgentSession.next_seq + 1, "update_time": updated}
+        if state_delta and is_sqlite(self.engine):
+            values["state"] = _sqlite_json_merge(AgentSession.state, state_delta)
+        elif state_delta:
+            # Merged in the database, so keys set by another process in the meantime are kept
+            values["state"] = AgentSession.state.op("||")(bindparam("state_delta", state_delta, type_=JSONB))
+        db_session = self.Session()
+        try:
+            seq = db_session.execute(
+                update(AgentSession).where(
+                    AgentSession.app_name == session.app_name,
+                    AgentSession.user_id == session.user_id,
+                    AgentSession.id == session.id,
+                ).values(**values).returning(AgentSession.next_seq - 1)
+            ).scalar()
+            if seq is None:
+                raise ValueError(f"Session {session.id} not found")
+            db_session.add(AgentSessionEvent(
+                app_name=session.app_name,
+                user_id=session.user_id,
+                session_id=session.id,
+                seq=seq,
+                event_id=event.id,
+                author=event.author,
+                timestamp=event.timestamp,
+                size=len(event.content.model_dump_json(exclude_none=True)) if event.content else 0,
+                compressed=True,
+                payload=_encode_event(event),
+            ))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error appending event to session {session.id}: {e}")
+            raise
+        finally:
+            db_session.close()
+
+        await super().append_event(session=session, event=event)
+        session.last_update_time = updated.timestamp()
+        self._event_appended(key, seq, event, state_delta, updated.timestamp())
+        return event
+
+    def _event_appended(self, key: tuple[str, str, str], seq: int, event: Event, state_delta: dict[str, Any],
+                        update_time: float):
+        """Bring the cached session up to date with an event appended as sequence number `seq`."""
+        cached = self._cache.get(key)
+        if cached is not None and cached.next_seq == seq:
+            cached.events.append(event)
+            cached.state.update(state_delta)
+            cached.next_seq = seq + 1
+            cached.update_time = update_time
+        else:
+            # Another process appended in between, the next read loads the session again
+            self._cache.pop(key, None)
+
+    def _sequence_numbers(self, key: tuple[str, str, str]) -> Optional[tuple[int, int]]:
+        """Get the first_seq and next_seq of a session, None if it does not exist."""
+        app_name, user_id, session_id = key
+        db_session = self.Session()
+        try:
+            row = db_session.query(AgentSession.first_seq, AgentSession.next_seq).filter(
+                AgentSession.app_name == app_name,
+                AgentSession.user_id == user_id,
+                AgentSession.id == session_id,
+            ).first()
+            return (row.first_seq, row.next_seq) if row is not None else None
+        finally:
+            db_session.close()
+
+    async def reset_events(self, *, app_name: str, user_id: str, session_id: str,
+                           state: Optional[dict[str, Any]] = None) -> Optional[Session]:
+        """Start a session over without its events, keeping or replacing its state.
+
+        Args:
+            state: The new state of the session, None keeps the current one
+
+        Returns:
+            The session without events, None if it does not exist
+        """
+        key = (app_name, user_id, session_id)
+        updated = now()
+        values = {"first_seq": AgentSession.next_seq, "update_time": updated}
+        if state is not None:
+            values["state"] = _session_state(state)
+        db_session = self.Session()
+        try:
+            row = db_session.execute(
+                update(AgentSession).where(
+                    AgentSession.app_name == app_name,
+                    AgentSession.user_id == user_id,
+                    AgentSession.id == session_id,
+                ).values(**values).returning(AgentSession.state, AgentSession.next_seq)
+            ).first()
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error resetting session {session_id}: {e}")
+            raise
+        finally:
+            db_session.close()
+        if row is None:
+            self._cache.pop(key, None)
+            return None
+        self._cache_put(key, _CachedSession(dict(row.state), row.next_seq, row.next_seq, updated.timestamp()))
+        return self._to_session(app_name, user_id, session_id, row.state, updated.timestamp(), [])
+
+    def purge_reset_events(self) -> int:
+        """Delete the events that sessions were reset past."""
+        db_session = self.Session()
+        try:
+            # A correlated subquery rather than DELETE ... USING, which SQLite does not have
+            deleted = db_session.execute(delete(AgentSessionEvent).where(exists().where(
+                AgentSession.app_name == AgentSessionEvent.app_name,
+                AgentSession.user_id == AgentSessionEvent.user_id,
+                AgentSession.id == AgentSessionEvent.session_id,
+                AgentSessionEvent.seq < AgentSession.first_seq,
+            ))).rowcount
+            db_session.commit()
+            return deleted
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error purging reset session events: {e}")
+            raise
+        finally:
+            db_session.close()
+
+class TokenCountingSessionService(EventLogSessionService):
+    """EventLogSessionService that keeps a running token count of the sessions it manages.
+
+    The counts let the bot see how large the next prompt will be before making the model
+    call, instead of finding out from the usage the model reports afterwards. A count is
+    checked against the session's first_seq and next_seq before it is used, so sessions
+    changed by another process are counted again.
+    """
+
+    def __init__(self, db_url: str, **kwargs: Any):
+        super().__init__(db_url=db_url, **kwargs)
+        self.token_counter = SessionTokenCounter(TokenEstimator())
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None,
+                             session_id: Optional[str] = None) -> Session:
+        session = await super().create_session(app_name=app_name, user_id=user_id, state=state, session_id=session_id)
+        self.token_counter.start(session.id, 1)
+        return session
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        self.token_counter.forget(session_id)
+
+    async def reset_events(self, *, app_name: str, user_id: str, session_id: str,
+                           state: Optional[dict[str, Any]] = None) -> Optional[Session]:
+        session = await super().reset_events(app_name=app_name, user_id=user_id, session_id=session_id, state=state)
+        # The reset session starts at the next_seq it had, which the cache was just given
+        cached = self._cache.get((app_name, user_id, session_id))
+        if session is not None and cached is not None:
+            self.token_counter.start(session_id, cached.first_seq)
+        else:
+            self.token_counter.forget(session_id)
+        return session
+
+    def _event_appended(self, key: tuple[str, str, str], seq: int, event: Event, state_delta: dict[str, Any],
+                        update_time: float):
+        super()._event_appended(key, seq, event, state_delta, update_time)
+        self.token_counter.add_event(key[2], event, seq)
+
+    async def get_token_count(self, app_name: str, user_id: str, session_id: str) -> int:
+        """Get the local token count of a session, counting it again if it changed since it was counted."""
+        key = (app_name, user_id, session_id)
+        sequence_numbers = self._sequence_numbers(key)
+        if sequence_numbers is None:
+            self.token_counter.forget(session_id)
+            return 0
+        count = self.token_counter.get(session_id, *sequence_numbers)
+        if count is not None:
+            return count
+        session = await self.get_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        if session is None:
+            return 0
+        # The session may have changed again since its sequence numbers were read
+        cached = self._cache.get(key)
+        if cached is not None:
+            sequence_numbers = (cached.first_seq, cached.next_seq)
+        count = self.token_counter.load(session, *sequence_numbers)
+        logger.debug(f"Counted {count} tokens in session {session_id}")
+        return count
@@ -0,0 +1,256 @@
+import json
+import asyncio
+import logging
+from google.adk.runners import Runner
+from google.adk.sessions import InMemorySessionService
+from google.genai import types
+from agentSummariser import get_summarising_agent
+from bot.config.settings import (
+    SUMMARISATION_SOFT_THRESHOLD,
+    SUMMARISATION_BATCH_CONCURRENCY,
+    MEMORY_RETRIEVAL,
+)
+from bot.utils.bot_state import BotState
+from bot.services.memory_store import MemoryStore
+from bot.services.session_service import EventLogSessionService
+from bot.utils.token_estimator import estimate_tokens_from_chars
+from bot.utils.user_profiles import parse_legacy_profile, profile_from_summary, render_profiles_for_summariser
+
+logger = logging.getLogger(__name__)
+
+class SummarisationService:
+    """Summarises chat sessions into their state with the summarising agent.
+
+    One runner is shared by every summarisation. Its sessions only live for a single run, so
+    they are kept in memory instead of being created and deleted in the database.
+
+    With MEMORY_RETRIEVAL the summary only covers the gist of the recent conversation, and
+    the facts the agent picks out are kept in the chat's long-term memories instead.
+    """
+
+    def __init__(self, bot_state: BotState, session_service: EventLogSessionService,
+                 concurrency: int = SUMMARISATION_BATCH_CONCURRENCY):
+        self.bot_state = bot_state
+        self.session_service = session_service
+        self.runner = Runner(
+            agent=get_summarising_agent(),
+            app_name="summarising_agent",
+            session_service=InMemorySessionService(),
+        )
+        self.concurrency = concurrency
+        self.memory_store = MemoryStore(bot_state.db)
+
+    async def _run_summariser(self, chat_id: str, history_string: str) -> dict:
+        """Run the summarising agent over a history string and parse its output."""
+        session = await self.runner.session_service.create_session(
+            app_name="summarising_agent",
+            user_id=chat_id,
+        )
+        try:
+            async for event_response in self.runner.run_async(
+                user_id=chat_id,
+                session_id=session.id,
+                new_message=types.Content(role="user", parts=[types.Part(text=history_string)]),
+            ):
+                if event_response.is_final_response():
+                    # This is a json string, we need to parse it according to the pydantic model defined in the agent
+                    return json.loads(event_response.content.parts[0].text)
+        finally:
+            await self.runner.session_service.delete_session(
+                app_name="summarising_agent",
+                user_id=chat_id,
+                session_id=session.id,
+            )
+        raise Exception(f"No summary received from summarising agent for chat {chat_id}")
+
+    async def summarise_session(self, chat_id: str, session_id: str):
+        """Reset a chat's session to a state holding the summary of its history, without its events.
+        
+        The caller must hold the chat's summarization lock.
+        
+        Args:
+            chat_id: The chat ID
+            session_id: The session ID to summarize
+        """
+        logger.info(f"Starting session summarization for chat {chat_id}")
+
+        # Get the history
+        history = await self.session_service.get_session(
+            app_name="dom",
+            user_id=chat_id,
+            session_id=session_id,
+        )
+        # Build the history string
+        # Store state in a temporary variable
+        temp_state = history.state
+        # Get the summary
+        summary = temp_state["summary"]
+        # Get the profiles of every user of the chat, moving any that are still kept in the state
+        individualisation_prompts = temp_state.get("individualisation_prompts")
+        if isinstance(individualisation_prompts, list) and individualisation_prompts:
+            self.import_legacy_profiles(chat_id, individualisation_prompts)
+        user_profiles = self.bot_state.get_user_profiles(chat_id)
+        # Get the sarcasm level
+        sarcasm_level = temp_state["sarcasm_level"]
+        # Get the playfulness level
+        playfulness_level = temp_state["playfulness_level"]
+        # Get the humor level
+        humor_level = temp_state["humor_level"]
+        # Get the formality level
+        formality_level = temp_state["formality_level"]
+        # Get the empathy level
+        empathy_level = temp_state["empathy_level"]
+        # Get the enthusiasm level
+        enthusiasm_level = temp_state["enthusiasm_level"]
+        # Get the singlish level
+        singlish_level = temp_state["singlish_level"]
+        # Get the emoji level
+        emoji_level = temp_state["emoji_level"]
+
+        # Build the history string
+        history_string = "This section is the current state of the agent:\n"
+        history_string += f"Summary: {summary}\n\n"
+        history_string += f"User information (one JSON object per user):\n{render_profiles_for_summariser(user_profiles)}\n\n"
+        history_string += f"Sarcasm level: {sarcasm_level}\n"
+        history_string += f"Playfulness level: {playfulness_level}\n"
+        history_string += f"Humor level: {humor_level}\n"
+        history_string += f"Formality level: {formality_level}\n"
+        history_string += f"Empathy level: {empathy_level}\n"
+        history_string += f"Enthusiasm level: {enthusiasm_level}\n"
+        history_string += f"Singlish level: {singlish_level}\n"
+        history_string += f"Emoji level: {emoji_level}\n"
+        if MEMORY_RETRIEVAL:
+            history_string += "\nOlder details are kept as memories, so keep the summary to the gist of the recent conversation in at most 150 words.\n"
+
+        history_string += "\n\nThis section is the history of the conversation:\n"
+        for historyEvent in history.events:
+            if historyEvent.author == "user":
+                # Check if it is a function call
+                if historyEvent.content.parts[0].function_call:
+                    history_string += f"Function called: {historyEvent.content.parts[0].function_call.name}\n"
+                    history_string += f"Function response: {historyEvent.content.parts[0].function_call.response}\n"
+                    continue
+                # Extract just the text portion from the content
+                content_text = historyEvent.content.parts[0].text if hasattr(historyEvent.content, 'parts') else historyEvent.content
+                history_string += f"User(s): {content_text}\n"
+            elif historyEvent.author == "dom":
+                # Handle multiple parts if they exist
+                if hasattr(historyEvent.content, 'parts'):
+                    content_texts = []
+                    for part in historyEvent.content.parts:
+                        if part.function_call != None:
+                            content_texts.append(f"Function called: {part.function_call.name}\n")
+                            content_texts.append(f"Function arguments: {part.function_call.args}\n")
+                            continue
+                        if part.function_response != None:
+                            content_texts.append(f"Function called: {part.function_response.name}\n")
+                            content_texts.append(f"Function response: {part.function_response.response}\n")
+                            continue
+                        if hasattr(part, 'text'):
+                            if part.text == None:
+                                logger.debug(f"Skipping history part without text: {part}")
+                                continue  # Skip this part if text is None
+                            content_texts.append(part.text)
+                    content_text = "\n".join(content_texts)
+                else:
+                    content_text = historyEvent.content
+
+                # Ensure content_text is not None before calling replace
+                if content_text is not None:
+                    history_string += f"Dom: {content_text.replace('%next_message%', '\n').replace('%no_response%', '')}\n"
+                else:
+                    history_string += f"Dom: [No content]\n"
+
+        # Send the history to an agent to summarise and generate the individualisation prompts
+        summary = await self._run_summariser(chat_id, history_string)
+        logger.info(f"Summary: {summary['summary']}")
+        logger.info(f"User information: {summary['user_information']}")
+        logger.info(f"Chat parameters: {summary['chat_parameters']}")
+        
+        # Save the new and changed profiles, users the summary leaves out keep their profile
+        profiles = [profile_from_summary(user_information) for user_information in summary['user_information']]
+        saved = self.bot_state.save_user_profiles(chat_id, [profile for profile in profiles if profile is not None])
+        logger.info(f"Saved {saved} user profiles for chat {chat_id}")
+
+        if MEMORY_RETRIEVAL:
+            try:
+                added = self.memory_store.add(chat_id, summary.get('memories', []), summary['summary'])
+                logger.info(f"Added {added} memories for chat {chat_id}")
+            except Exception as e:
+                logger.error(f"Error adding memories for chat {chat_id}: {e}")
+
+        chat_parameters = summary.get('chat_parameters', {'sarcasm_level': 0.5, 'playfulness_level': 0.5, 'humor_level': 0.5, 'formality_level': 0.5, 'empathy_level': 0.5, 'enthusiasm_level': 0.5, 'singlish_level': 0.5, 'emoji_level': 0.5})
+
+        # Update history state with the new summary, the profiles of the users in each batch are set by the turn
+        temp_state["summary"] = summary['summary']
+        temp_state["individualisation_prompts"] = ""
+        temp_state["sarcasm_level"] = chat_parameters['sarcasm_level']
+        temp_state["playfulness_level"] = chat_parameters['playfulness_level']
+        temp_state["humor_level"] = chat_parameters['humor_level']
+        temp_state["formality_level"] = chat_parameters['formality_level']
+        temp_state["empathy_level"] = chat_parameters['empathy_level']
+        temp_state["enthusiasm_level"] = chat_parameters['enthusiasm_level']
+        temp_state["singlish_level"] = chat_parameters['singlish_level']
+        temp_state["emoji_level"] = chat_parameters['emoji_level']
+
+        # Drop the summarised events and set the updated state in one step
+        await self.session_service.reset_events(
+            app_name="dom",
+            user_id=chat_id,
+            session_id=session_id,
+            state=temp_state,
+        )
+
+        logger.info(f"Session summarization completed for chat {chat_id}")
+
+    def import_legacy_profiles(self, chat_id: str, individualisation_prompts: list):
+        """Save the profiles of a session state that still holds them as strings."""
+        profiles = [parse_legacy_profile(text) for text in individualisation_prompts if isinstance(text, str)]
+        saved = self.bot_state.save_user_profiles(chat_id, [profile for profile in profiles if profile is not None])
+        logger.info(f"Imported {saved} user profiles from the session state of chat {chat_id}")
+
+    def find_due_sessions(self, threshold: int = SUMMARISATION_SOFT_THRESHOLD) -> list[tuple[str, str, int]]:
+        """Find chat sessions whose estimated size exceeds the threshold.
+        
+        Returns:
+            (chat_id, session_id, estimated tokens) rows, largest first
+        """
+        due = []
+        for chat_id, session_id, characters in self.bot_state.db.get_session_content_sizes("dom"):
+            tokens = estimate_tokens_from_chars(characters)
+            if tokens > threshold:
+                due.append((chat_id, session_id, tokens))
+        return sorted(due, key=lambda row: row[2], reverse=True)
+
+    async def summarise_due_chats(self, threshold: int = SUMMARISATION_SOFT_THRESHOLD) -> int:
+        """Summarise every session over the threshold, a few at a time.
+        
+        Chats with a turn in progress or about to start are left for the next pass.
+        
+        Returns:
+            Number of sessions summarised
+        """
+        due = self.find_due_sessions(threshold)
+        if not due:
+            return 0
+        logger.info(f"Batch summarising {len(due)} sessions over {threshold} estimated tokens")
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def summarise(chat_id: str, session_id: str) -> bool:
+            async with semaphore:
+                if self.bot_state.get_processing_delay(chat_id) is not None or self.bot_state.get_queued_messages(chat_id)["number_of_messages"]:
+                    logger.info(f"Chat {chat_id} has messages waiting, leaving its summarization for later")
+                    return False
+                if not self.bot_state.set_summarization_lock(chat_id):
+                    return False
+                try:
+                    await self.summarise_session(chat_id, session_id)
+                    return True
+                except Exception as e:
+                    logger.error(f"Error summarising session for chat {chat_id}: {e}")
+                    return False
+                finally:
+                    self.bot_state.clear_summarization_lock(chat_id)
+
+        results = await asyncio.gather(*(summarise(chat_id, session_id) for chat_id, session_id, _ in due))
+        return sum(results)
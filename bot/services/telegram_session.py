@@ -0,0 +1,324 @@
+import os
+import time
+import logging
+from typing import Dict, Optional, Tuple
+from sqlalchemy import Column, String, Integer, BigInteger, LargeBinary, delete
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, SQLiteSession
+from telethon.sessions.memory import _SentFileType
+from telethon.tl import types
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from bot.config.settings import DB_URL
+from bot.utils.db_engine import get_engine, ensure_tables, dialect_insert
+from bot.utils.time_utils import now
+from bot.utils.db_types import TZDateTime
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+class TelegramSessionRow(Base):
+    __tablename__ = 'telegram_sessions'
+
+    name = Column(String, primary_key=True)
+    dc_id = Column(Integer, nullable=False, default=0)
+    server_address = Column(String, nullable=True)
+    port = Column(Integer, nullable=True)
+    auth_key = Column(LargeBinary, nullable=True)
+    takeout_id = Column(BigInteger, nullable=True)
+    updated_at = Column(TZDateTime, default=now)
+
+class TelegramEntity(Base):
+    __tablename__ = 'telegram_entities'
+
+    session_name = Column(String, primary_key=True)
+    # Marked peer id, negative for chats and channels
+    id = Column(BigInteger, primary_key=True)
+    hash = Column(BigInteger, nullable=False)
+    username = Column(String, nullable=True)
+    phone = Column(String, nullable=True)
+    name = Column(String, nullable=True)
+
+class TelegramUpdateState(Base):
+    __tablename__ = 'telegram_update_states'
+
+    session_name = Column(String, primary_key=True)
+    # 0 for the account's common update state, otherwise a channel id
+    entity_id = Column(BigInteger, primary_key=True)
+    pts = Column(Integer, nullable=False)
+    qts = Column(Integer, nullable=False)
+    date = Column(TZDateTime, nullable=False)
+    seq = Column(Integer, nullable=False)
+
+class TelegramSentFile(Base):
+    __tablename__ = 'telegram_sent_files'
+
+    session_name = Column(String, primary_key=True)
+    md5_digest = Column(LargeBinary, primary_key=True)
+    file_size = Column(BigInteger, primary_key=True)
+    type = Column(Integer, primary_key=True)
+    id = Column(BigInteger, nullable=False)
+    hash = Column(BigInteger, nullable=False)
+
+EntityRow = Tuple[int, int, Optional[str], Optional[str], Optional[str]]
+
+class DatabaseTelegramSession(MemorySession):
+    """Telethon session kept in memory and stored in the bot's database.
+
+    Telethon's default session is a SQLite file that is written every time entities or
+    update states arrive. This session only changes memory on the update path, with the
+    entities indexed by id, username, phone and name so lookups don't scan them all.
+    Changes are written to the database in one transaction when Telethon saves the session,
+    which it does every minute, after the auth key changes and on disconnect.
+
+    The first time a session name is used, the Telethon session file of the same name is
+    imported if there is one, so switching from the file keeps the login and update state.
+    """
+
+    def __init__(self, name: str, engine=None):
+        super().__init__()
+        self.name = name
+        self.engine = engine if engine is not None else get_engine(DB_URL)
+        self.Session = sessionmaker(bind=self.engine)
+        self.insert = dialect_insert(self.engine)
+        ensure_tables(Base.metadata, self.engine)
+
+        self._entities: Dict[int, EntityRow] = {}
+        self._by_username: Dict[str, int] = {}
+        self._by_phone: Dict[str, int] = {}
+        self._by_name: Dict[str, int] = {}
+
+        # Changed since the last save
+        self._session_changed = False
+        self._changed_entities: Dict[int, EntityRow] = {}
+        self._changed_states: Dict[int, types.updates.State] = {}
+        self._changed_files: Dict[tuple, Tuple[int, int]] = {}
+
+        if not self._load():
+            # New session, its row is written with the first save
+            self._session_changed = True
+            self._import_file(f"{name}.session")
+
+    def _load(self) -> bool:
+        """Load the session from the database.
+
+        Returns:
+            Whether the database had the session
+        """
+        session = self.Session()
+        try:
+            row = session.get(TelegramSessionRow, self.name)
+            if row is None:
+                return False
+            self._dc_id = row.dc_id
+            self._server_address = row.server_address
+            self._port = row.port
+            self._auth_key = AuthKey(data=bytes(row.auth_key)) if row.auth_key else None
+            self._takeout_id = row.takeout_id
+            for entity in session.query(TelegramEntity).filter(TelegramEntity.session_name == self.name):
+                self._index_entity((entity.id, entity.hash, entity.username, entity.phone, entity.name))
+            for state in session.query(TelegramUpdateState).filter(TelegramUpdateState.session_name == self.name):
+                self._update_states[state.entity_id] = types.updates.State(
+                    state.pts, state.qts, state.date, state.seq, unread_count=0)
+            for file in session.query(TelegramSentFile).filter(TelegramSentFile.session_name == self.name):
+                self._files[(bytes(file.md5_digest), file.file_size, _SentFileType(file.type))] = (file.id, file.hash)
+            logger.info(f"Loaded Telegram session {self.name} with {len(self._entities)} entities")
+            return True
+        finally:
+            session.close()
+
+    def _import_file(self, path: str):
+        """Copy a Telethon session file into the database."""
+        if not os.path.isfile(path):
+            return
+        file_session = SQLiteSession(path)
+        try:
+            self.set_dc(file_session.dc_id, file_session.server_address, file_session.port)
+            self._auth_key = file_session.auth_key
+            self._takeout_id = file_session.takeout_id
+            for entity_id, state in file_session.get_update_states():
+                self.set_update_state(entity_id, state)
+            cursor = file_session._cursor()
+            try:
+                for row in cursor.execute("select id, hash, username, phone, name from entities"):
+                    self._add_entity(tuple(row))
+                for md5_digest, file_size, file_type, file_id, file_hash in cursor.execute(
+                        "select md5_digest, file_size, type, id, hash from sent_files"):
+                    key = (md5_digest, file_size, _SentFileType(file_type))
+                    self._files[key] = self._changed_files[key] = (file_id, file_hash)
+            finally:
+                cursor.close()
+        finally:
+            file_session.close()
+        self.save()
+        logger.info(f"Imported Telegram session file {path} with {len(self._entities)} entities")
+
+    # Connection details, saved right away by Telethon calling save()
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._session_changed = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._session_changed = True
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._session_changed = True
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._changed_states[entity_id] = state
+
+    # Entities
+
+    def _index_entity(self, row: EntityRow):
+        entity_id, _, username, phone, name = row
+        previous = self._entities.get(entity_id)
+        if previous is not None:
+            # Drop the old keys so a renamed entity can't be found by its old name
+            for index, key in ((self._by_username, previous[2]), (self._by_phone, previous[3]), (self._by_name, previous[4])):
+                if key is not None and index.get(key) == entity_id:
+                    del index[key]
+        self._entities[entity_id] = row
+        if username is not None:
+            self._by_username[username] = entity_id
+        if phone is not None:
+            self._by_phone[phone] = entity_id
+        if name is not None:
+            self._by_name[name] = entity_id
+
+    def _add_entity(self, row: EntityRow):
+        if self._entities.get(row[0]) == row:
+            return
+        self._index_entity(row)
+        self._changed_entities[row[0]] = row
+
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            self._add_entity(row)
+
+    def _id_and_hash(self, entity_id: Optional[int]):
+        if entity_id is None or entity_id not in self._entities:
+            return None
+        return entity_id, self._entities[entity_id][1]
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._id_and_hash(self._by_phone.get(phone))
+
+    def get_entity_rows_by_username(self, username):
+        return self._id_and_hash(self._by_username.get(username))
+
+    def get_entity_rows_by_name(self, name):
+        return self._id_and_hash(self._by_name.get(name))
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            return self._id_and_hash(id)
+        for peer in (PeerUser(id), PeerChat(id), PeerChannel(id)):
+            found = self._id_and_hash(utils.get_peer_id(peer))
+            if found:
+                return found
+        return None
+
+    def cache_file(self, md5_digest, file_size, instance):
+        super().cache_file(md5_digest, file_size, instance)
+        key = (md5_digest, file_size, _SentFileType.from_type(type(instance)))
+        self._changed_files[key] = self._files[key]
+
+    # Storage
+
+    def _upsert(self, db_session, model, rows: list, keys: list):
+        if not rows:
+            return
+        statement = self.insert(model)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={column.name: statement.excluded[column.name]
+                  for column in model.__table__.columns if column.name not in keys},
+        )
+        # Executed as a batch of rows, so the statement is only compiled once
+        db_session.execute(statement, rows)
+
+    def save(self):
+        """Write the changes since the last save to the database in one transaction."""
+        if not (self._session_changed or self._changed_entities or self._changed_states or self._changed_files):
+            return
+        started = time.perf_counter()
+        session_changed, self._session_changed = self._session_changed, False
+        entities, self._changed_entities = self._changed_entities, {}
+        states, self._changed_states = self._changed_states, {}
+        files, self._changed_files = self._changed_files, {}
+        db_session = self.Session()
+        try:
+            if session_changed:
+                self._upsert(db_session, TelegramSessionRow, [{
+                    "name": self.name,
+                    "dc_id": self._dc_id,
+                    "server_address": self._server_address,
+                    "port": self._port,
+                    "auth_key": self._auth_key.key if self._auth_key else None,
+                    "takeout_id": self._takeout_id,
+                    "updated_at": now(),
+                }], ["name"])
+            self._upsert(db_session, TelegramEntity, [
+                {"session_name": self.name, "id": entity_id, "hash": entity_hash,
+                 "username": username, "phone": phone, "name": name}
+                for entity_id, entity_hash, username, phone, name in entities.values()
+            ], ["session_name", "id"])
+            self._upsert(db_session, TelegramUpdateState, [
+                {"session_name": self.name, "entity_id": entity_id, "pts": state.pts, "qts": state.qts,
+                 # Telethon gives channel states a naive local date
+                 "date": state.date.astimezone(), "seq": state.seq}
+                for entity_id, state in states.items()
+            ], ["session_name", "entity_id"])
+            self._upsert(db_session, TelegramSentFile, [
+                {"session_name": self.name, "md5_digest": md5_digest, "file_size": file_size,
+                 "type": file_type.value, "id": file_id, "hash": file_hash}
+                for (md5_digest, file_size, file_type), (file_id, file_hash) in files.items()
+            ], ["session_name", "md5_digest", "file_size", "type"])
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            # Keep the changes for the next save, newer changes win
+            self._session_changed = self._session_changed or session_changed
+            self._changed_entities = {**entities, **self._changed_entities}
+            self._changed_states = {**states, **self._changed_states}
+            self._changed_files = {**files, **self._changed_files}
+            logger.error(f"Error saving Telegram session {self.name}: {e}")
+            return
+        finally:
+            db_session.close()
+        logger.debug(
+            f"Saved Telegram session {self.name}: {len(entities)} entities and {len(states)} update states",
+            extra={"extra_data": {
+                "metric": "telegram_session_save",
+                "entities": len(entities),
+                "update_states": len(states),
+                "files": len(files),
+                "milliseconds": round((time.perf_counter() - started) * 1000, 3),
+            }}
+        )
+
+    def close(self):
+        self.save()
+
+    def delete(self):
+        """Delete the session from the database, Telethon calls this on log out."""
+        db_session = self.Session()
+        try:
+            for model in (TelegramEntity, TelegramUpdateState, TelegramSentFile):
+                db_session.execute(delete(model).where(model.session_name == self.name))
+            db_session.execute(delete(TelegramSessionRow).where(TelegramSessionRow.name == self.name))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"Error deleting Telegram session {self.name}: {e}")
+            raise
+        finally:
+            db_session.close()
@@ -0,0 +1,149 @@
+import heapq
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional
+from bot.config.settings import (
+    WAKE_UP_TIME,
+    MAX_OFFLINE_TIME,
+    WAKEUP_CONCURRENCY,
+    WAKEUP_TURN_SECONDS,
+    WAKEUP_TOKENS_PER_SECOND,
+    WAKEUP_PLAN_LEAD,
+)
+from bot.services.database_service import DatabaseService
+from bot.utils.time_utils import next_time_of_day, now
+from bot.utils.token_estimator import estimate_tokens_from_chars
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WakeUp:
+    chat_id: str
+    pending_messages: int
+    estimated_tokens: int
+    turn_seconds: float
+    # When the chat would come back without the scheduler and when it is planned to
+    current_wake_at: datetime
+    wake_at: datetime
+
+@dataclass
+class LoadBucket:
+    start: datetime
+    turns: int
+    tokens: int
+    # Share of the backend's capacity the turns starting around this time keep busy, 1 is full
+    utilisation: float
+
+class WakeUpScheduler:
+    """Spreads the return of chats that went offline overnight over the backend's capacity.
+
+    Chats that go offline during the night come back shortly after WAKE_UP_TIME, and each
+    sends its whole overnight backlog to the model. Shortly before WAKE_UP_TIME the chats
+    with queued messages are given return times that let `concurrency` turns run at once,
+    largest backlog first, each turn taking WAKEUP_TURN_SECONDS plus the time to read its
+    backlog. Chats without queued messages keep their random return time.
+    """
+
+    def __init__(self, db: DatabaseService, concurrency: int = WAKEUP_CONCURRENCY,
+                 turn_seconds: float = WAKEUP_TURN_SECONDS, tokens_per_second: float = WAKEUP_TOKENS_PER_SECOND,
+                 plan_lead: int = WAKEUP_PLAN_LEAD):
+        self.db = db
+        self.concurrency = max(concurrency, 1)
+        self.turn_seconds = turn_seconds
+        self.tokens_per_second = tokens_per_second
+        self.plan_lead = plan_lead
+
+    def plan(self, wake_up: Optional[datetime] = None) -> List[WakeUp]:
+        """Plan the return of the chats that come back after a wake-up time.
+
+        Args:
+            wake_up: The wake-up time to plan for, the next WAKE_UP_TIME if not given
+
+        Returns:
+            Every chat that comes back within MAX_OFFLINE_TIME of the wake-up, in planned order
+        """
+        wake_up = wake_up or next_time_of_day(WAKE_UP_TIME)
+        backlogs = self.db.get_offline_backlogs(wake_up, wake_up + timedelta(seconds=MAX_OFFLINE_TIME))
+
+        wake_ups = []
+        for chat_id, offline_until, pending_messages, characters in backlogs:
+            tokens = estimate_tokens_from_chars(characters)
+            offline_until = offline_until.astimezone()
+            wake_ups.append(WakeUp(
+                chat_id=chat_id,
+                pending_messages=pending_messages,
+                estimated_tokens=tokens,
+                turn_seconds=self.turn_seconds + tokens / self.tokens_per_second if pending_messages else 0,
+                current_wake_at=offline_until,
+                wake_at=offline_until,
+            ))
+
+        # Each lane is one turn the backend can run at once, the next chat starts on the lane that frees up first
+        lanes = [0.0] * self.concurrency
+        for wake in sorted(wake_ups, key=lambda wake: (-wake.pending_messages, -wake.estimated_tokens, wake.chat_id)):
+            if not wake.pending_messages:
+                continue
+            offset = heapq.heappop(lanes)
+            wake.wake_at = wake_up + timedelta(seconds=offset)
+            heapq.heappush(lanes, offset + wake.turn_seconds)
+        return sorted(wake_ups, key=lambda wake: (wake.wake_at, wake.chat_id))
+
+    def apply(self, wake_ups: List[WakeUp]) -> int:
+        """Save the planned return times of the chats with queued messages."""
+        return self.db.reschedule_offline_chats({
+            wake.chat_id: wake.wake_at for wake in wake_ups if wake.pending_messages and wake.wake_at != wake.current_wake_at
+        })
+
+    def projected_load(self, wake_ups: List[WakeUp], bucket_seconds: int = 600, planned: bool = True) -> List[LoadBucket]:
+        """Project the model load of the chats' returns in buckets of time.
+
+        Args:
+            wake_ups: The chats, from `plan`
+            bucket_seconds: Length of each bucket
+            planned: Use the planned return times, or the ones the chats have without the scheduler
+        """
+        busy = [wake for wake in wake_ups if wake.pending_messages]
+        if not busy:
+            return []
+        starts = [wake.wake_at if planned else wake.current_wake_at for wake in busy]
+        first = min(starts)
+        buckets: List[LoadBucket] = []
+        for wake, start in sorted(zip(busy, starts), key=lambda item: item[1]):
+            index = int((start - first).total_seconds() // bucket_seconds)
+            while len(buckets) <= index:
+                buckets.append(LoadBucket(first + timedelta(seconds=len(buckets) * bucket_seconds), 0, 0, 0.0))
+            buckets[index].turns += 1
+            buckets[index].tokens += wake.estimated_tokens
+            buckets[index].utilisation += wake.turn_seconds / (self.concurrency * bucket_seconds)
+        return buckets
+
+    async def run(self):
+        """Plan and apply the wake-ups before every WAKE_UP_TIME until cancelled."""
+        while True:
+            try:
+                wake_up = next_time_of_day(WAKE_UP_TIME)
+                until_plan = (wake_up - now()).total_seconds() - self.plan_lead
+                if until_plan > 0:
+                    await asyncio.sleep(until_plan)
+                wake_ups = self.plan(wake_up)
+                rescheduled = self.apply(wake_ups)
+                pending = [wake for wake in wake_ups if wake.pending_messages]
+                last = max((wake.wake_at + timedelta(seconds=wake.turn_seconds) for wake in pending), default=wake_up)
+                logger.info(
+                    f"Planned the return of {len(pending)} chats with backlogs after {wake_up:%H:%M:%S}, "
+                    f"rescheduled {rescheduled}, last turn expected to end at {last:%H:%M:%S}",
+                    extra={"extra_data": {
+                        "metric": "wakeup_plan",
+                        "chats": len(pending),
+                        "rescheduled": rescheduled,
+                        "tokens": sum(wake.estimated_tokens for wake in pending),
+                        "spread_seconds": round((last - wake_up).total_seconds()),
+                    }}
+                )
+                # Wait for the wake-up to pass so it is only planned once
+                await asyncio.sleep(max((wake_up - now()).total_seconds(), 0) + 1)
+            except Exception as e:
+                logger.error(f"Error planning wake-ups: {e}")
+                await asyncio.sleep(300)  # Wait a bit before retrying
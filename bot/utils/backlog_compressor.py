@@ -0,0 +1,252 @@
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Protocol, Sequence
+import numpy as np
+from bot.utils.token_estimator import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Compression modes
+VERBATIM = "off"
+COLLAPSE = "collapse"  # collapse media runs and repeats only
+BUDGET = "budget"  # collapse, then cut down to the token budget
+THREADS = "threads"  # in group chats only keep the reply threads with the bot and the latest messages, then as BUDGET
+COMPRESSION_MODES = (VERBATIM, COLLAPSE, BUDGET, THREADS)
+
+# Header of a queued message, "[time] Name (@handle) [msg_id:N reply_to:M]: text"
+MESSAGE_HEADER = re.compile(r"^\[(?P<time>[^\]]*)\] (?P<sender>.*?) \(@(?P<handle>[^)]*)\) \[msg_id:(?P<id>\d+)(?: reply_to:(?P<reply_to>\d+))?\]: ?(?P<text>.*)$")
+# Messages that are only a media placeholder such as "[MessageMediaPhoto]", or only emoji and punctuation
+PLACEHOLDER = re.compile(r"^\[[A-Za-z ]+\]$")
+WORD = re.compile(r"[^\W_]+", re.UNICODE)
+# The most recent messages are what the reply is about, so they are always kept
+KEEP_RECENT = 5
+
+class ReplyLookup(Protocol):
+    def touches_bot(self, message_id: int) -> bool: ...
+
+@dataclass
+class BacklogMessage:
+    header: str
+    sender: str
+    message_id: int
+    reply_to: Optional[int]
+    text: str
+    repeats: int = 1
+    media_run: int = 0
+    pinned: bool = False
+    # Number of messages left out in place of this one, for the note that replaces them
+    omitted: int = 0
+    words: List[str] = field(default_factory=list)
+
+    def render(self) -> str:
+        if self.omitted:
+            return f"[... {self.omitted} less relevant message{'s' if self.omitted != 1 else ''} left out ...]"
+        if self.media_run > 1:
+            return f"{self.header}: [{self.media_run} media messages or stickers]"
+        suffix = f" (sent {self.repeats} times)" if self.repeats > 1 else ""
+        return f"{self.header}: {self.text}{suffix}"
+
+def _is_media(text: str) -> bool:
+    stripped = text.strip()
+    return not stripped or PLACEHOLDER.match(stripped) is not None or not WORD.search(stripped)
+
+def parse_backlog(messages: str) -> List[BacklogMessage]:
+    """Split queued messages into messages, joining the continuation lines of multi-line messages."""
+    parsed: List[BacklogMessage] = []
+    for line in messages.splitlines():
+        match = MESSAGE_HEADER.match(line)
+        if match is None:
+            if parsed:
+                parsed[-1].text += f"\n{line}"
+            continue
+        header = line[:match.start("text")].rstrip().removesuffix(":")
+        parsed.append(BacklogMessage(
+            header=header,
+            sender=match.group("handle").lower(),
+            message_id=int(match.group("id")),
+            reply_to=int(match.group("reply_to")) if match.group("reply_to") else None,
+            text=match.group("text"),
+        ))
+    return parsed
+
+def _collapse(messages: List[BacklogMessage]) -> List[BacklogMessage]:
+    """Collapse runs of media placeholders into one line and drop repeats of the same text by the same sender."""
+    collapsed: List[BacklogMessage] = []
+    seen = {}
+    for message in messages:
+        if message.omitted:
+            collapsed.append(message)
+            continue
+        if _is_media(message.text):
+            previous = collapsed[-1] if collapsed else None
+            if previous is not None and previous.media_run > 0:
+                previous.media_run += 1
+                continue
+            message.media_run = 1
+            collapsed.append(message)
+            continue
+        key = (message.sender, " ".join(message.text.lower().split()))
+        if key in seen and not message.pinned:
+            seen[key].repeats += 1
+            continue
+        seen[key] = message
+        collapsed.append(message)
+    return collapsed
+
+def _score(messages: Sequence[BacklogMessage]) -> np.ndarray:
+    """Score messages by how informative they are, the summed TF-IDF weight of their words
+    normalised by length, with a bonus for questions and for recency."""
+    vocabulary = {}
+    rows, columns = [], []
+    for row, message in enumerate(messages):
+        for word in message.words:
+            rows.append(row)
+            columns.append(vocabulary.setdefault(word, len(vocabulary)))
+    if not vocabulary:
+        return np.zeros(len(messages))
+    counts = np.zeros((len(messages), len(vocabulary)))
+    np.add.at(counts, (np.array(rows), np.array(columns)), 1)
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(messages)) / (1 + document_frequency)) + 1
+    lengths = np.maximum(counts.sum(axis=1), 1)
+    scores = (counts * idf).sum(axis=1) / np.sqrt(lengths)
+    questions = np.array([1.0 if "?" in message.text else 0.0 for message in messages])
+    recency = np.linspace(0, 1, len(messages))
+    return scores * (1 + 0.5 * questions) * (1 + 0.5 * recency)
+
+class BacklogCompressor:
+    """Shrinks a backlog of queued messages before it is sent to the agent.
+
+    Runs of stickers and media are collapsed into one line and a sender repeating the same
+    text is only kept once. In BUDGET mode, when the backlog is still over the token budget,
+    messages are dropped by a TF-IDF score until it fits. Messages that mention the bot, that
+    reply to a message outside the backlog (usually the bot's) and the most recent messages
+    are always kept. Dropped stretches are replaced by a note with the number of messages left out.
+
+    In THREADS mode group chat backlogs are first cut down to the messages in reply threads
+    with the bot, the messages those reply to and the `recent` latest messages. Private chats
+    are all addressed to the bot, so they are compressed as in BUDGET mode.
+    """
+
+    def __init__(self, mode: str, token_budget: int, bot_names: Sequence[str],
+                 count_tokens: Callable[[str], int] = estimate_tokens, recent: int = KEEP_RECENT):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(f"Invalid backlog compression mode: {mode}. Use one of {', '.join(COMPRESSION_MODES)}")
+        if recent < 0:
+            raise ValueError(f"Invalid number of recent messages to keep: {recent}. Use 0 or more")
+        self.mode = mode
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.recent = recent
+        names = [re.escape(name.strip().lstrip("@")) for name in bot_names if name.strip()]
+        self._mention = re.compile(rf"(?<![\w@])@?(?:{'|'.join(names)})\b", re.IGNORECASE) if names else None
+
+    def compress(self, messages: str, reply_graph: Optional[ReplyLookup] = None, group_chat: bool = False) -> str:
+        """Compress the text of a batch of queued messages, returned unchanged in VERBATIM mode.
+
+        Args:
+            messages: The queued messages, one header line per message
+            reply_graph: The chat's reply graph, without it a reply to a message outside the
+                backlog is assumed to be a reply to the bot
+            group_chat: Whether the messages are from a group chat
+        """
+        if self.mode == VERBATIM or not messages:
+            return messages
+        parsed = parse_backlog(messages)
+        if not parsed:
+            return messages
+
+        message_ids = {message.message_id for message in parsed}
+        for message in parsed:
+            mentions_bot = self._mention is not None and self._mention.search(message.text) is not None
+            if reply_graph is not None:
+                replies_to_bot = message.reply_to is not None and reply_graph.touches_bot(message.reply_to)
+            else:
+                replies_to_bot = message.reply_to is not None and message.reply_to not in message_ids
+            message.pinned = mentions_bot or replies_to_bot
+        if self.mode == THREADS and group_chat:
+            parsed = self._bot_threads(parsed)
+        compressed = _collapse(parsed)
+
+        if self.mode in (BUDGET, THREADS):
+            compressed = self._fit_budget(compressed)
+        result = "".join(f"{message.render()}\n" for message in compressed)
+        logger.info(f"Compressed a backlog of {len(parsed)} messages from {len(messages)} to {len(result)} characters")
+        return result
+
+    def _bot_threads(self, messages: List[BacklogMessage]) -> List[BacklogMessage]:
+        """Keep the messages in reply threads with the bot, what they reply to and the latest messages."""
+        by_id = {message.message_id: message for message in messages}
+        keep = set()
+        for message in messages:
+            if not message.pinned:
+                continue
+            # Follow the thread up within the backlog so the model sees what is being replied to
+            current: Optional[BacklogMessage] = message
+            while current is not None and current.message_id not in keep:
+                keep.add(current.message_id)
+                current = by_id.get(current.reply_to) if current.reply_to is not None else None
+        # Replies to kept messages belong to the same thread
+        for message in messages:
+            if message.reply_to in keep:
+                keep.add(message.message_id)
+        if self.recent > 0:
+            keep.update(message.message_id for message in messages[-self.recent:])
+
+        threads: List[BacklogMessage] = []
+        omitted = 0
+        for message in messages:
+            if message.message_id in keep:
+                if omitted:
+                    threads.append(_omitted(omitted))
+                    omitted = 0
+                threads.append(message)
+            else:
+                omitted += 1
+        if omitted:
+            threads.append(_omitted(omitted))
+        return threads
+
+    def _fit_budget(self, messages: List[BacklogMessage]) -> List[BacklogMessage]:
+        """Drop the lowest scoring messages until the backlog fits the token budget.
+
+        Returns:
+            The messages in order, with a note in place of each stretch that was left out
+        """
+        tokens = np.array([self.count_tokens(message.render()) for message in messages])
+        if tokens.sum() <= self.token_budget:
+            return messages
+
+        for message in messages:
+            message.words = [word.lower() for word in WORD.findall(message.text)]
+        keep = np.zeros(len(messages), dtype=bool)
+        keep[[index for index, message in enumerate(messages) if message.pinned]] = True
+        if self.recent > 0:
+            keep[-self.recent:] = True
+        remaining = self.token_budget - tokens[keep].sum()
+        for index in np.argsort(-_score(messages), kind="stable"):
+            if keep[index] or messages[index].omitted:
+                continue
+            if tokens[index] <= remaining:
+                keep[index] = True
+                remaining -= tokens[index]
+
+        fitted: List[BacklogMessage] = []
+        omitted = 0
+        for message, kept in zip(messages, keep):
+            # Notes are merged with the messages left out next to them
+            if kept and not message.omitted:
+                if omitted:
+                    fitted.append(_omitted(omitted))
+                    omitted = 0
+                fitted.append(message)
+            else:
+                omitted += message.omitted or message.repeats + max(message.media_run - 1, 0)
+        if omitted:
+            fitted.append(_omitted(omitted))
+        return fitted
+
+def _omitted(count: int) -> BacklogMessage:
+    """Note in place of a stretch of messages left out of the backlog."""
+    return BacklogMessage(header="", sender="", message_id=0, reply_to=None, text="", omitted=count)
@@ -1,8 +1,9 @@
 import random
-from datetime import datetime, timedelta
+from datetime import timedelta
 import logging
 from bot.config.settings import MAX_ONLINE_TIME, MIN_ONLINE_TIME, DEV_MODE, DEV_CHAT_ID
 from bot.services.database_service import DatabaseService
+from bot.utils.time_utils import now
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +34,7 @@ class BotState:
 
     def set_processing_delay(self, chat_id: str, delay_seconds: int):
         """Set a processing delay for a specific chat."""
-        delay_until = datetime.now() + timedelta(seconds=delay_seconds)
+        delay_until = now() + timedelta(seconds=delay_seconds)
         self.db.set_processing_delay(str(chat_id), delay_until)
         logger.info(f"Set processing delay for chat {chat_id} until {delay_until}")
         return delay_until
@@ -43,7 +44,7 @@ class BotState:
         delay_until = self.db.get_processing_delay(str(chat_id))
         if not delay_until:
             return False
-        return datetime.now() < delay_until
+        return now() < delay_until
 
     def clear_processing_delay(self, chat_id: str):
         """Clear the processing delay for a specific chat."""
@@ -65,9 +66,57 @@ class BotState:
         self.db.clear_message_queue(str(chat_id))
         logger.info(f"Cleared queued messages for chat {chat_id}")
 
+    def claim_queued_messages(self, chat_id: str):
+        """Claim the queued messages for a specific chat for one agent turn, None if there are none."""
+        return self.db.claim_message_batch(str(chat_id))
+
+    def ack_queued_messages(self, token: str):
+        """Remove a claimed batch of messages once the agent's reply has been sent."""
+        self.db.ack_message_batch(token)
+
+    def release_queued_messages(self, token: str, failed: bool = True, retry_after_seconds: float = 0):
+        """Return a claimed batch of messages to the queue after a failed or interrupted turn."""
+        self.db.release_message_batch(token, failed=failed, retry_after_seconds=retry_after_seconds)
+
+    def get_stranded_chats(self, older_than_seconds: int = 0) -> list:
+        """Get chats whose queued messages are not being processed by any turn."""
+        return self.db.get_stranded_chats(older_than_seconds)
+
+    def acquire_chat_lease(self, chat_id: str, owner: str) -> bool:
+        """Take ownership of a chat for a worker process. Returns False if another worker owns it."""
+        return self.db.acquire_chat_lease(str(chat_id), owner)
+
+    def release_chat_lease(self, chat_id: str, owner: str):
+        """Give up a worker's ownership of a chat."""
+        self.db.release_chat_lease(str(chat_id), owner)
+
+    def get_user_profiles(self, chat_id: str, handles: list = None) -> list:
+        """Get the user profiles of a chat, only the given handles if any are passed."""
+        return self.db.get_user_profiles(str(chat_id), handles)
+
+    def save_user_profiles(self, chat_id: str, profiles: list) -> int:
+        """Insert or replace user profiles of a chat."""
+        return self.db.save_user_profiles(str(chat_id), profiles)
+
+    def get_processing_delay(self, chat_id: str):
+        """Get the time a chat's processing delay ends, None if no reply is scheduled."""
+        return self.db.get_processing_delay(str(chat_id))
+
+    def recover_after_restart(self) -> list:
+        """Drop in-flight state left by a previous process and return chats with pending messages.
+        
+        Only one bot process drains the queue, so any lease or processing delay found at
+        start-up belongs to a turn that died with the previous process.
+        """
+        released = self.db.release_all_message_leases()
+        cleared = self.db.clear_all_processing_delays()
+        if released or cleared:
+            logger.info(f"Recovered {released} claimed messages and cleared {cleared} processing delays from the previous run")
+        return self.db.get_stranded_chats()
+
     def set_sleep(self, chat_id: str, duration_seconds: int):
         """Set the bot to sleep mode for the specified duration for a specific chat."""
-        sleep_until = datetime.now() + timedelta(seconds=duration_seconds)
+        sleep_until = now() + timedelta(seconds=duration_seconds)
         self.db.set_chat_state(
             str(chat_id),
             is_sleeping=True,
@@ -78,7 +127,7 @@ class BotState:
 
     def force_online(self, chat_id: str):
         """Force the bot back online for a specific chat."""
-        current_time = datetime.now()
+        current_time = now()
         online_time = int(random.triangular(MIN_ONLINE_TIME, MAX_ONLINE_TIME, MAX_ONLINE_TIME - (MAX_ONLINE_TIME - MIN_ONLINE_TIME) * 0.2))
         self.db.set_chat_state(
             str(chat_id),
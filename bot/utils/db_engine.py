@@ -0,0 +1,83 @@
+import os
+import threading
+from typing import Dict, Set, Tuple
+from sqlalchemy import MetaData, create_engine, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from bot.config.settings import DB_URL, SQLITE_BUSY_TIMEOUT
+
+_lock = threading.Lock()
+_engines: Dict[str, Engine] = {}
+_created: Set[Tuple[str, int]] = set()
+
+# Set on every SQLite connection. WAL lets readers carry on while the one writer commits, and
+# NORMAL synchronous is still crash safe in WAL mode while only syncing at checkpoints.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MiB
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}",
+)
+
+def _create_sqlite_engine(url) -> Engine:
+    if url.database and url.database != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+    # The bot's background threads (the log writer) use connections from the same pool
+    engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT})
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+def get_engine(url: str = DB_URL) -> Engine:
+    """Get the process wide engine of a database, so every service shares one connection pool."""
+    with _lock:
+        engine = _engines.get(url)
+        if engine is None:
+            if make_url(url).get_backend_name() == "sqlite":
+                engine = _create_sqlite_engine(make_url(url))
+            else:
+                engine = create_engine(url)
+            _engines[url] = engine
+        return engine
+
+def is_sqlite(engine: Engine) -> bool:
+    return engine.dialect.name == "sqlite"
+
+def dialect_insert(engine: Engine):
+    """Get the insert construct of an engine's dialect, both support on_conflict_do_update and on_conflict_do_nothing."""
+    return sqlite_insert if is_sqlite(engine) else pg_insert
+
+def _without_composite_autoincrement(metadata: MetaData) -> MetaData:
+    """SQLite only generates ids for a single column primary key, so ids in composite keys
+    (log_entries' id, timestamp) are assigned by whatever writes the rows. The tables are
+    created from a copy, so the models keep their autoincrement for Postgres engines."""
+    sqlite_metadata = MetaData()
+    for table in metadata.tables.values():
+        table = table.to_metadata(sqlite_metadata)
+        if len(table.primary_key.columns) > 1:
+            for column in table.primary_key.columns:
+                if column.autoincrement is True:
+                    column.autoincrement = "auto"
+    return sqlite_metadata
+
+def ensure_tables(metadata: MetaData, engine: Engine) -> None:
+    """Create the missing tables of a metadata, at most once per process and database."""
+    key = (str(engine.url), id(metadata))
+    with _lock:
+        if key in _created:
+            return
+        if is_sqlite(engine):
+            _without_composite_autoincrement(metadata).create_all(engine)
+        else:
+            metadata.create_all(engine)
+        _created.add(key)
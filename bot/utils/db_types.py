@@ -0,0 +1,28 @@
+from datetime import datetime, timezone
+from typing import Optional
+from sqlalchemy import DateTime
+from sqlalchemy.types import TypeDecorator
+
+class TZDateTime(TypeDecorator):
+    """Timezone-aware timestamp on every backend.
+
+    Postgres stores it as TIMESTAMPTZ. SQLite has no timezone support, so values are stored
+    as naive UTC and come back aware in local time, like they do from Postgres. Storing them
+    all in UTC keeps SQLite's text comparisons in time order.
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[datetime], dialect) -> Optional[datetime]:
+        if value is None or dialect.name != 'sqlite':
+            return value
+        if value.tzinfo is None:
+            # Naive values are taken to be local time, like Postgres does with the session time zone
+            value = value.astimezone()
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def process_result_value(self, value: Optional[datetime], dialect) -> Optional[datetime]:
+        if value is None or dialect.name != 'sqlite':
+            return value
+        return value.replace(tzinfo=timezone.utc).astimezone()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from google.adk.events import Event
+
+# Telegram allows 4096 characters per message, leave some room to be safe
+MAX_CHUNK_LENGTH = 4000
+CONTINUED_PREFIX = "...(continued)\n"
+
+def render_event(event: Event) -> Optional[str]:
+    """Render a session event as a single history entry.
+
+    Returns:
+        The rendered entry, or None if the event has nothing to show
+    """
+    if not event.content or not event.content.parts:
+        return None
+
+    lines = []
+    for part in event.content.parts:
+        if part.function_call is not None:
+            lines.append(f"Function called: {part.function_call.name}")
+            lines.append(f"Function arguments: {part.function_call.args}")
+        elif part.function_response is not None:
+            lines.append(f"Function called: {part.function_response.name}")
+            lines.append(f"Function response: {part.function_response.response}")
+        elif part.text:
+            lines.append(part.text)
+    if not lines:
+        return None
+
+    content_text = "\n".join(lines)
+    if event.author == "user":
+        return f"User: {content_text}"
+    if event.author == "dom":
+        content_text = content_text.replace("%next_message%", "\n").replace("%no_response%", "")
+        return f"Dom: {content_text}"
+    return None
+
+def chunk_entries(entries: List[str], header: str = "", max_length: int = MAX_CHUNK_LENGTH) -> List[str]:
+    """Join entries into Telegram-sized messages without splitting an entry across messages.
+
+    Entries longer than `max_length` on their own are split on line boundaries, and only
+    cut mid-line as a last resort.
+    """
+    # Every chunk after the first starts with the continuation prefix
+    max_length -= len(CONTINUED_PREFIX)
+    pieces = []
+    for entry in entries:
+        if len(entry) <= max_length:
+            pieces.append(entry)
+            continue
+        current = ""
+        for line in entry.split("\n"):
+            while len(line) > max_length:
+                if current:
+                    pieces.append(current)
+                    current = ""
+                pieces.append(line[:max_length])
+                line = line[max_length:]
+            if current and len(current) + 1 + len(line) > max_length:
+                pieces.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            pieces.append(current)
+
+    chunks = []
+    current = header
+    for piece in pieces:
+        separator = "\n" if current else ""
+        if current and len(current) + len(separator) + len(piece) > max_length:
+            chunks.append(current)
+            current = f"{CONTINUED_PREFIX}{piece}"
+        else:
+            current = f"{current}{separator}{piece}"
+    if current:
+        chunks.append(current)
+    return chunks
+
+class HistoryPageCache:
+    """Caches rendered /history pages until the session changes.
+
+    Entries are keyed by session and page and hold the session's `last_update_time`, which
+    ADK bumps on every appended event, so a stale page is simply re-rendered.
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._pages: "OrderedDict[Tuple[str, int], Tuple[float, List[str]]]" = OrderedDict()
+
+    def get(self, session_id: str, page: int, last_update_time: float) -> Optional[List[str]]:
+        """Get the cached chunks of a page, None if missing or rendered from an older session."""
+        cached = self._pages.get((session_id, page))
+        if cached is None or cached[0] != last_update_time:
+            return None
+        self._pages.move_to_end((session_id, page))
+        return cached[1]
+
+    def put(self, session_id: str, page: int, last_update_time: float, chunks: List[str]) -> None:
+        """Store the rendered chunks of a page, evicting the least recently used pages."""
+        self._pages[(session_id, page)] = (last_update_time, chunks)
+        self._pages.move_to_end((session_id, page))
+        while len(self._pages) > self.max_entries:
+            self._pages.popitem(last=False)
@@ -1,57 +1,170 @@
+import math
+import time
+import logging
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from sqlalchemy import create_engine, desc, and_
+from typing import Iterator, List, Optional, Dict, Any
+from sqlalchemy import desc, func, literal_column, text
 from sqlalchemy.orm import sessionmaker
 from bot.config.settings import DB_URL
 from bot.utils.postgres_logger import LogEntry, Base
+from bot.utils.log_partitions import LogPartitionManager
+from bot.utils.log_rollups import LogRollupManager
+from bot.utils.time_utils import now
+from bot.utils.db_engine import get_engine, is_sqlite
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip when streaming logs
+STREAM_CHUNK_SIZE = 500
+# How far back follow_logs looks for new rows, well above the time between a record and its insert
+FOLLOW_WINDOW_MINUTES = 10
+
+def _percentile(sorted_values: List[int], pct: float) -> int:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
 
 class LogManager:
-    """Utility class for managing and querying logs from PostgreSQL database."""
+    """Utility class for managing and querying logs from the database."""
     
     def __init__(self):
-        self.engine = create_engine(DB_URL)
+        self.engine = get_engine(DB_URL)
         self.Session = sessionmaker(bind=self.engine)
+        self.partitions = LogPartitionManager(self.engine)
+        self.rollups = LogRollupManager(self.engine)
+        self._has_search_index = None
+    
+    @staticmethod
+    def _log_to_dict(log: LogEntry) -> Dict[str, Any]:
+        return {
+            'id': log.id,
+            'timestamp': log.timestamp.isoformat(),
+            'level': log.level,
+            'logger_name': log.logger_name,
+            'message': log.message,
+            'module': log.module,
+            'function': log.function,
+            'line_number': log.line_number,
+            'exception_info': log.exception_info,
+            'extra_data': log.extra_data
+        }
+    
+    @staticmethod
+    def _filter_logs(query, since: Optional[datetime] = None, level: Optional[str] = None,
+                     logger_name: Optional[str] = None):
+        # Filter by time
+        if since is not None:
+            query = query.filter(LogEntry.timestamp >= since)
+        
+        # Filter by level if specified
+        if level:
+            query = query.filter(LogEntry.level == level.upper())
+        
+        # Filter by logger name if specified
+        if logger_name:
+            query = query.filter(LogEntry.logger_name == logger_name)
+        return query
     
     def get_recent_logs(self, hours: int = 24, level: Optional[str] = None, 
                        logger_name: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
         """Get recent logs with optional filtering."""
         session = self.Session()
         try:
-            query = session.query(LogEntry)
-            
-            # Filter by time
-            since = datetime.now() - timedelta(hours=hours)
-            query = query.filter(LogEntry.timestamp >= since)
-            
-            # Filter by level if specified
-            if level:
-                query = query.filter(LogEntry.level == level.upper())
-            
-            # Filter by logger name if specified
-            if logger_name:
-                query = query.filter(LogEntry.logger_name == logger_name)
+            since = now() - timedelta(hours=hours)
+            query = self._filter_logs(session.query(LogEntry), since, level, logger_name)
             
             # Order by timestamp descending and limit results
             logs = query.order_by(desc(LogEntry.timestamp)).limit(limit).all()
             
-            return [
-                {
-                    'id': log.id,
-                    'timestamp': log.timestamp.isoformat(),
-                    'level': log.level,
-                    'logger_name': log.logger_name,
-                    'message': log.message,
-                    'module': log.module,
-                    'function': log.function,
-                    'line_number': log.line_number,
-                    'exception_info': log.exception_info,
-                    'extra_data': log.extra_data
-                }
-                for log in logs
-            ]
+            return [self._log_to_dict(log) for log in logs]
         finally:
             session.close()
     
+    def get_latest_log_id(self) -> int:
+        """Get the id of the newest log row, 0 if there are none."""
+        session = self.Session()
+        try:
+            return session.query(func.max(LogEntry.id)).scalar() or 0
+        finally:
+            session.close()
+    
+    def iter_logs(self, hours: int = 24, level: Optional[str] = None, logger_name: Optional[str] = None,
+                  limit: Optional[int] = None, before_id: Optional[int] = None,
+                  page_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Stream logs newest first without loading the whole window into memory.
+        
+        Pages are fetched with keyset pagination on id, each in its own short-lived session,
+        and rows within a page are read from a server-side cursor.
+        
+        Args:
+            hours: Hours to look back
+            level: Only include this level
+            logger_name: Only include this logger
+            limit: Maximum number of logs, None for the whole window
+            before_id: Only include logs with a smaller id, e.g. the id returned by
+                `get_latest_log_id` to combine an export with `follow_logs`
+            page_size: Number of rows per page
+        
+        Yields:
+            Logs as dictionaries, in descending id order
+        """
+        since = now() - timedelta(hours=hours)
+        remaining = limit
+        while remaining is None or remaining > 0:
+            batch = page_size if remaining is None else min(page_size, remaining)
+            session = self.Session()
+            try:
+                query = self._filter_logs(session.query(LogEntry), since, level, logger_name)
+                if before_id is not None:
+                    query = query.filter(LogEntry.id < before_id)
+                fetched = 0
+                for log in query.order_by(desc(LogEntry.id)).limit(batch).yield_per(STREAM_CHUNK_SIZE):
+                    fetched += 1
+                    before_id = log.id
+                    yield self._log_to_dict(log)
+            finally:
+                session.close()
+            if remaining is not None:
+                remaining -= fetched
+            if fetched < batch:
+                return
+    
+    def follow_logs(self, level: Optional[str] = None, logger_name: Optional[str] = None,
+                    after_id: Optional[int] = None, poll_interval: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """Yield new logs as they are written, oldest first, until the caller stops iterating.
+        
+        Each bot process queues its log records and commits them in batches, at most
+        FLUSH_INTERVAL seconds (half a second) after they were logged, so a record shows up
+        here that long plus up to `poll_interval` after it was logged. Rows are polled by id,
+        and a batch from one process can commit after a batch with newer ids from another,
+        so its rows may be skipped if they are not committed by the next poll.
+        
+        Args:
+            level: Only include this level
+            logger_name: Only include this logger
+            after_id: Only include logs with a larger id, defaults to the newest log
+            poll_interval: Seconds to wait between polls when there are no new rows
+        """
+        if after_id is None:
+            after_id = self.get_latest_log_id()
+        while True:
+            session = self.Session()
+            try:
+                # New rows are recent, the time filter lets the planner skip older partitions
+                since = now() - timedelta(minutes=FOLLOW_WINDOW_MINUTES)
+                query = self._filter_logs(session.query(LogEntry), since, level, logger_name)
+                logs = query.filter(LogEntry.id > after_id).order_by(LogEntry.id).limit(STREAM_CHUNK_SIZE).all()
+            finally:
+                session.close()
+            for log in logs:
+                after_id = log.id
+                yield self._log_to_dict(log)
+            if len(logs) < STREAM_CHUNK_SIZE:
+                time.sleep(poll_interval)
+    
     def get_errors(self, hours: int = 24, limit: int = 50) -> List[Dict[str, Any]]:
         """Get error-level logs from the last N hours."""
         return self.get_recent_logs(hours=hours, level='ERROR', limit=limit)
@@ -60,74 +173,133 @@ class LogManager:
         """Get warning-level logs from the last N hours."""
         return self.get_recent_logs(hours=hours, level='WARNING', limit=limit)
     
-    def search_logs(self, search_term: str, hours: int = 24, limit: int = 50) -> List[Dict[str, Any]]:
-        """Search logs by message content."""
-        session = self.Session()
-        try:
-            since = datetime.now() - timedelta(hours=hours)
-            logs = session.query(LogEntry).filter(
-                and_(
-                    LogEntry.timestamp >= since,
-                    LogEntry.message.ilike(f'%{search_term}%')
-                )
-            ).order_by(desc(LogEntry.timestamp)).limit(limit).all()
-            
-            return [
-                {
-                    'id': log.id,
-                    'timestamp': log.timestamp.isoformat(),
-                    'level': log.level,
-                    'logger_name': log.logger_name,
-                    'message': log.message,
-                    'module': log.module,
-                    'function': log.function,
-                    'line_number': log.line_number,
-                    'exception_info': log.exception_info,
-                    'extra_data': log.extra_data
-                }
-                for log in logs
-            ]
-        finally:
-            session.close()
+    SEARCH_MODES = ('substring', 'fts', 'phrase')
+    
+    def has_search_index(self) -> bool:
+        """Check if the full-text search column from migration 3 exists, never on SQLite."""
+        if self._has_search_index is None and is_sqlite(self.engine):
+            self._has_search_index = False
+        if self._has_search_index is None:
+            with self.engine.connect() as connection:
+                self._has_search_index = bool(connection.execute(text("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'log_entries' AND column_name = 'message_tsv'
+                    )
+                """)).scalar())
+        return self._has_search_index
     
-    def get_log_statistics(self, hours: int = 24) -> Dict[str, Any]:
-        """Get statistics about logs in the last N hours."""
+    def search_logs(self, search_term: str, hours: int = 24, limit: int = 50,
+                    mode: str = 'substring') -> List[Dict[str, Any]]:
+        """Search logs by message content.
+        
+        Args:
+            search_term: Text to search for
+            hours: Hours to look back
+            limit: Maximum number of results
+            mode: 'substring' for ILIKE matching (indexed when pg_trgm is installed),
+                'fts' for ranked full-text search with web-style syntax (quotes, OR, -word),
+                'phrase' for ranked matching of the words in order
+        
+        Returns:
+            Matching logs, newest first for substring search and best match first otherwise.
+            Full-text modes fall back to substring search if the search column is missing.
+        """
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f"Invalid search mode: {mode}. Use one of {', '.join(self.SEARCH_MODES)}")
+        if mode != 'substring' and not self.has_search_index():
+            logger.warning("Full-text log search is unavailable, run the schema migrations. Falling back to substring search")
+            mode = 'substring'
+        
         session = self.Session()
         try:
-            since = datetime.now() - timedelta(hours=hours)
+            since = now() - timedelta(hours=hours)
+            query = session.query(LogEntry).filter(LogEntry.timestamp >= since)
             
-            # Total logs
-            total_logs = session.query(LogEntry).filter(LogEntry.timestamp >= since).count()
-            
-            # Logs by level
-            from sqlalchemy import func
-            level_counts = session.query(
-                LogEntry.level, 
-                func.count(LogEntry.id).label('count')
-            ).filter(LogEntry.timestamp >= since).group_by(LogEntry.level).all()
-            
-            # Logs by logger
-            logger_counts = session.query(
-                LogEntry.logger_name, 
-                func.count(LogEntry.id).label('count')
-            ).filter(LogEntry.timestamp >= since).group_by(LogEntry.logger_name).order_by(
-                func.count(LogEntry.id).desc()
-            ).limit(10).all()
+            if mode == 'substring':
+                logs = query.filter(
+                    LogEntry.message.ilike(f'%{search_term}%')
+                ).order_by(desc(LogEntry.timestamp)).limit(limit).all()
+                return [self._log_to_dict(log) for log in logs]
             
-            return {
-                'total_logs': total_logs,
-                'level_distribution': {level: count for level, count in level_counts},
-                'top_loggers': {logger: count for logger, count in logger_counts},
-                'time_period_hours': hours
-            }
+            to_tsquery = func.websearch_to_tsquery if mode == 'fts' else func.phraseto_tsquery
+            tsquery = to_tsquery('simple', search_term)
+            message_tsv = literal_column('log_entries.message_tsv')
+            rank = func.ts_rank_cd(message_tsv, tsquery).label('rank')
+            rows = query.add_columns(rank).filter(
+                message_tsv.op('@@')(tsquery)
+            ).order_by(desc(rank), desc(LogEntry.timestamp)).limit(limit).all()
+            return [{**self._log_to_dict(log), 'rank': round(float(score), 4)} for log, score in rows]
         finally:
             session.close()
     
+    def get_log_statistics(self, hours: int = 24, exact: bool = False) -> Dict[str, Any]:
+        """Get statistics about logs in the last N hours.
+        
+        Args:
+            hours: Hours to look back
+            exact: Aggregate log_entries directly instead of reading the per-minute rollups,
+                which count the first minute of the window whole
+        
+        Returns:
+            Totals by level and logger, errors per hour and percentiles of logs per minute
+        """
+        since = now() - timedelta(hours=hours)
+        if exact:
+            rows = self.rollups.get_exact_counts(since)
+        else:
+            rows = self.rollups.get_counts(since)
+        
+        level_counts = Counter()
+        logger_counts = Counter()
+        minute_counts = Counter()
+        errors_per_hour = Counter()
+        for minute, level, logger_name, count in rows:
+            minute = minute.astimezone()
+            level_counts[level] += count
+            logger_counts[logger_name] += count
+            minute_counts[minute] += count
+            if level in ('ERROR', 'CRITICAL'):
+                errors_per_hour[minute.replace(minute=0)] += count
+        
+        # Quiet minutes have no rows but still count towards the percentiles
+        window_minutes = int((now() - since.replace(second=0, microsecond=0)).total_seconds() // 60) + 1
+        per_minute = sorted(minute_counts.values())
+        per_minute = [0] * max(window_minutes - len(per_minute), 0) + per_minute
+        
+        hour = since.replace(minute=0, second=0, microsecond=0)
+        hours_trend = {}
+        while hour <= now():
+            hours_trend[hour.isoformat()] = errors_per_hour.get(hour, 0)
+            hour = (hour.replace(tzinfo=None) + timedelta(hours=1)).astimezone()
+        
+        return {
+            'total_logs': sum(level_counts.values()),
+            'level_distribution': dict(level_counts.most_common()),
+            'top_loggers': dict(logger_counts.most_common(10)),
+            'errors_per_hour': hours_trend,
+            'per_minute_percentiles': {
+                'p50': _percentile(per_minute, 50),
+                'p95': _percentile(per_minute, 95),
+                'p99': _percentile(per_minute, 99),
+                'max': per_minute[-1] if per_minute else 0,
+            },
+            'time_period_hours': hours
+        }
+    
     def cleanup_old_logs(self, days: int = 30) -> int:
-        """Delete logs older than specified days. Returns number of deleted records."""
+        """Delete logs older than specified days. Returns number of deleted records.
+        
+        On a partitioned table whole partitions are dropped instead, so the count is the
+        planner's row estimate and rows in the partition straddling the cutoff are kept.
+        """
+        cutoff_date = now() - timedelta(days=days)
+        if self.partitions.is_partitioned():
+            dropped = self.partitions.drop_partitions_before(cutoff_date)
+            return sum(partition['estimated_rows'] for partition in dropped)
+        
         session = self.Session()
         try:
-            cutoff_date = datetime.now() - timedelta(days=days)
             deleted_count = session.query(LogEntry).filter(LogEntry.timestamp < cutoff_date).delete()
             session.commit()
             return deleted_count
@@ -137,6 +309,23 @@ class LogManager:
         finally:
             session.close()
     
+    def count_logs_to_cleanup(self, days: int = 30) -> Dict[str, Any]:
+        """Get what `cleanup_old_logs` would remove without removing anything."""
+        cutoff_date = now() - timedelta(days=days)
+        if self.partitions.is_partitioned():
+            partitions = self.partitions.get_partitions_before(cutoff_date)
+            return {
+                'partitions': [partition['name'] for partition in partitions],
+                'count': sum(partition['estimated_rows'] for partition in partitions),
+            }
+        
+        session = self.Session()
+        try:
+            count = session.query(LogEntry).filter(LogEntry.timestamp < cutoff_date).count()
+            return {'partitions': [], 'count': count}
+        finally:
+            session.close()
+    
     def close(self):
         """Close the database connection."""
         if hasattr(self, 'engine'):
@@ -0,0 +1,185 @@
+import re
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Any
+from sqlalchemy import text
+from bot.config.settings import LOG_PARTITION_INTERVAL, LOG_PARTITION_PREMAKE
+from bot.utils.time_utils import now
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'log_entries'
+DEFAULT_PARTITION = 'log_entries_default'
+
+class LogPartitionManager:
+    """Manages the time-range partitions of the log_entries table.
+
+    Partitions are created ahead of time so inserts never hit the default partition, and
+    retention drops whole partitions instead of deleting rows.
+    """
+
+    def __init__(self, engine, interval: str = LOG_PARTITION_INTERVAL):
+        if interval not in ('day', 'week'):
+            raise ValueError(f"Invalid log partition interval: {interval}. Use 'day' or 'week'")
+        self.engine = engine
+        self.interval = interval
+
+    def is_partitioned(self) -> bool:
+        """Check if log_entries is a partitioned table."""
+        if self.engine.dialect.name != 'postgresql':
+            return False
+        with self.engine.connect() as connection:
+            return bool(connection.execute(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"
+            ), {'table': PARENT_TABLE}).scalar())
+
+    def _period_start(self, moment: datetime) -> datetime:
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.interval == 'week':
+            start -= timedelta(days=start.weekday())
+        return start
+
+    def _period_end(self, start: datetime) -> datetime:
+        # Normalise through astimezone so the boundary follows DST changes
+        days = 7 if self.interval == 'week' else 1
+        return (start.replace(tzinfo=None) + timedelta(days=days)).astimezone()
+
+    def get_partitions(self) -> List[Dict[str, Any]]:
+        """Get all partitions of log_entries with their bounds.
+
+        Returns:
+            List of partitions ordered by lower bound, the default partition has no bounds
+            and unbounded sides are None
+        """
+        with self.engine.connect() as connection:
+            rows = connection.execute(text("""
+                SELECT child.relname AS name,
+                       pg_get_expr(child.relpartbound, child.oid) AS bound,
+                       child.reltuples AS estimated_rows
+                FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = to_regclass(:table)
+            """), {'table': PARENT_TABLE}).all()
+
+            partitions = []
+            for name, bound, estimated_rows in rows:
+                partition = {
+                    'name': name,
+                    'is_default': bound == 'DEFAULT',
+                    'lower': None,
+                    'upper': None,
+                    'estimated_rows': max(int(estimated_rows), 0),
+                }
+                match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound or "")
+                if match:
+                    # Let Postgres parse its own literals rather than guessing the format
+                    for key, literal in (('lower', match.group(1)), ('upper', match.group(2))):
+                        if literal not in ('MINVALUE', 'MAXVALUE'):
+                            partition[key] = connection.execute(text(f"SELECT {literal}::timestamptz")).scalar()
+                partitions.append(partition)
+
+        partitions.sort(key=lambda partition: (partition['is_default'], partition['lower'] or datetime.min.replace(tzinfo=now().tzinfo)))
+        return partitions
+
+    def ensure_partitions(self, ahead: int = LOG_PARTITION_PREMAKE) -> List[str]:
+        """Create the default partition and partitions for the current and next periods.
+
+        Args:
+            ahead: Number of future periods to create in addition to the current one
+
+        Returns:
+            Names of the partitions that were created
+        """
+        if not self.is_partitioned():
+            return []
+
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"
+            )
+
+        created = []
+        partitions = [partition for partition in self.get_partitions() if not partition['is_default']]
+        start = self._period_start(now())
+        for _ in range(ahead + 1):
+            end = self._period_end(start)
+            name = self._create_partition(start, end, partitions)
+            if name:
+                created.append(name)
+                partitions.append({'name': name, 'lower': start, 'upper': end})
+            start = end
+
+        if created:
+            logger.info(f"Created log partitions: {', '.join(created)}")
+        return created
+
+    def _create_partition(self, start: datetime, end: datetime, partitions: List[Dict[str, Any]]) -> Optional[str]:
+        """Create a partition for [start, end), trimmed to whatever existing partitions leave uncovered."""
+        for partition in partitions:
+            lower, upper = partition['lower'], partition['upper']
+            if (lower is None or lower <= start) and (upper is None or upper > start):
+                # An existing partition (e.g. the converted legacy table) covers the start of the period
+                if upper is None or upper >= end:
+                    return None
+                start = upper
+            elif lower is not None and start < lower < end:
+                logger.warning(f"Log partition {partition['name']} overlaps period starting {start}, skipping")
+                return None
+
+        name = f"{PARENT_TABLE}_p{start.strftime('%Y%m%d')}"
+        bounds = {'start': start, 'end': end}
+        with self.engine.begin() as connection:
+            has_default_rows = connection.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end)"
+            ), bounds).scalar()
+            if has_default_rows:
+                # Rows that landed in the default partition have to move before the range can be claimed
+                connection.exec_driver_sql(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+            # DDL cannot take bind parameters, the bounds are generated here so inlining is safe
+            connection.exec_driver_sql(
+                f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+            if has_default_rows:
+                columns = ", ".join(f'"{column}"' for column in self._insertable_columns(connection))
+                connection.execute(text(
+                    f"INSERT INTO {PARENT_TABLE} ({columns}) SELECT {columns} FROM {DEFAULT_PARTITION} "
+                    f"WHERE timestamp >= :start AND timestamp < :end"
+                ), bounds)
+                connection.execute(text(
+                    f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end"
+                ), bounds)
+                connection.exec_driver_sql(f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+                logger.info(f"Moved rows from {DEFAULT_PARTITION} into {name}")
+        return name
+
+    @staticmethod
+    def _insertable_columns(connection) -> List[str]:
+        return list(connection.execute(text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = :table AND is_generated = 'NEVER'
+            ORDER BY ordinal_position
+        """), {'table': PARENT_TABLE}).scalars())
+
+    def get_partitions_before(self, cutoff: datetime) -> List[Dict[str, Any]]:
+        """Get partitions that only contain rows older than the cutoff."""
+        return [
+            partition for partition in self.get_partitions()
+            if not partition['is_default'] and partition['upper'] is not None and partition['upper'] <= cutoff
+        ]
+
+    def drop_partitions_before(self, cutoff: datetime) -> List[Dict[str, Any]]:
+        """Drop partitions that only contain rows older than the cutoff.
+
+        Rows older than the cutoff in the partition straddling it are kept until the whole
+        partition ages out.
+
+        Returns:
+            The partitions that were dropped
+        """
+        dropped = self.get_partitions_before(cutoff)
+        for partition in dropped:
+            with self.engine.begin() as connection:
+                connection.exec_driver_sql(f"DROP TABLE IF EXISTS {partition['name']}")
+            logger.info(f"Dropped log partition {partition['name']} (~{partition['estimated_rows']} rows)")
+        return dropped
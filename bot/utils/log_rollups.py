@@ -0,0 +1,139 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import Integer, String, bindparam, column, text
+from bot.config.settings import LOG_ROLLUP_RETENTION_DAYS
+from bot.utils.db_engine import is_sqlite
+from bot.utils.db_types import TZDateTime
+from bot.utils.time_utils import now
+
+logger = logging.getLogger(__name__)
+
+# Minutes before the newest rollup that are recomputed on every refresh, to pick up log rows
+# committed after their minute was first counted
+REFRESH_LOOKBACK_MINUTES = 5
+# Backfills are split into chunks so a large log table is not aggregated in one transaction
+BACKFILL_CHUNK = timedelta(days=1)
+
+RollupRow = Tuple[datetime, str, str, int]
+
+class LogRollupManager:
+    """Maintains per-minute (level, logger_name) counters in log_rollups.
+
+    The counters are refreshed incrementally from log_entries, so statistics over long
+    windows read a few thousand rollup rows instead of aggregating every log row.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        # SQLite has no date_trunc, its timestamps are UTC text that truncates the same way
+        if is_sqlite(engine):
+            self.minute_sql = "strftime('%Y-%m-%d %H:%M:00.000000', timestamp)"
+        else:
+            self.minute_sql = "date_trunc('minute', timestamp)"
+
+    def _text(self, sql: str, *datetime_params: str, rows: bool = False):
+        """Build a statement whose datetime parameters and results convert like TZDateTime columns."""
+        statement = text(sql.replace("{minute}", self.minute_sql)).bindparams(
+            *(bindparam(name, type_=TZDateTime()) for name in datetime_params)
+        )
+        if rows:
+            statement = statement.columns(column('minute', TZDateTime()), column('level', String()),
+                                          column('logger_name', String()), column('count', Integer()))
+        return statement
+
+    def _max_minute(self, connection) -> Optional[datetime]:
+        return connection.execute(
+            text("SELECT max(minute) AS minute FROM log_rollups").columns(column('minute', TZDateTime()))
+        ).scalar()
+
+    def get_watermark(self) -> Optional[datetime]:
+        """Get the newest minute in the rollups, None if nothing has been rolled up yet."""
+        with self.engine.connect() as connection:
+            return self._max_minute(connection)
+
+    def refresh(self) -> int:
+        """Recompute the rollups from the last few rolled up minutes until now.
+
+        On the first run every existing log row is rolled up.
+
+        Returns:
+            Number of rollup rows written
+        """
+        watermark = self.get_watermark()
+        if watermark is not None:
+            start = watermark - timedelta(minutes=REFRESH_LOOKBACK_MINUTES)
+        else:
+            with self.engine.connect() as connection:
+                start = connection.execute(
+                    self._text("SELECT min({minute}) AS minute FROM log_entries").columns(column('minute', TZDateTime()))
+                ).scalar()
+            if start is None:
+                return 0
+
+        written = 0
+        end = now()
+        while start <= end:
+            chunk_end = min(start + BACKFILL_CHUNK, end + timedelta(minutes=1))
+            with self.engine.begin() as connection:
+                written += connection.execute(self._text("""
+                    INSERT INTO log_rollups (minute, level, logger_name, count)
+                    SELECT {minute}, level, logger_name, count(*)
+                    FROM log_entries
+                    WHERE timestamp >= :start AND timestamp < :end
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT (minute, level, logger_name) DO UPDATE SET count = EXCLUDED.count
+                """, 'start', 'end'), {'start': start, 'end': chunk_end}).rowcount
+            start = chunk_end
+
+        logger.debug(f"Refreshed {written} log rollup rows")
+        return written
+
+    def prune(self, days: int = LOG_ROLLUP_RETENTION_DAYS) -> int:
+        """Delete rollups older than the given number of days, 0 keeps everything."""
+        if days <= 0:
+            return 0
+        with self.engine.begin() as connection:
+            return connection.execute(
+                self._text("DELETE FROM log_rollups WHERE minute < :cutoff", 'cutoff'),
+                {'cutoff': now() - timedelta(days=days)}
+            ).rowcount
+
+    def get_counts(self, since: datetime) -> List[RollupRow]:
+        """Get per-minute counts since the given time.
+
+        Minutes up to the watermark come from the rollups and everything after it is counted
+        live from log_entries, so the result is current even if the refresh job is behind.
+        The first minute is counted whole.
+
+        Returns:
+            (minute, level, logger_name, count) rows
+        """
+        since_minute = since.replace(second=0, microsecond=0)
+        with self.engine.connect() as connection:
+            watermark = self._max_minute(connection)
+            # The watermark minute may have been partial when it was rolled up, so count it live
+            tail_start = max(watermark, since_minute) if watermark is not None else since_minute
+            rows = []
+            if watermark is not None and watermark > since_minute:
+                rows.extend(connection.execute(self._text("""
+                    SELECT minute, level, logger_name, count FROM log_rollups
+                    WHERE minute >= :since AND minute < :tail_start
+                """, 'since', 'tail_start', rows=True), {'since': since_minute, 'tail_start': tail_start}).all())
+            rows.extend(connection.execute(self._text("""
+                SELECT {minute} AS minute, level, logger_name, count(*) AS count
+                FROM log_entries
+                WHERE timestamp >= :tail_start
+                GROUP BY 1, 2, 3
+            """, 'tail_start', rows=True), {'tail_start': tail_start}).all())
+        return [tuple(row) for row in rows]
+
+    def get_exact_counts(self, since: datetime) -> List[RollupRow]:
+        """Count logs per minute straight from log_entries, starting exactly at `since`."""
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(self._text("""
+                SELECT {minute} AS minute, level, logger_name, count(*) AS count
+                FROM log_entries
+                WHERE timestamp >= :since
+                GROUP BY 1, 2, 3
+            """, 'since', rows=True), {'since': since}).all()]
@@ -1,18 +1,27 @@
-import logging
 import json
+import time
+import queue
+import logging
+import threading
 from datetime import datetime
-from sqlalchemy import create_engine, Column, String, DateTime, Text, Integer
+from typing import List
+from sqlalchemy import Column, String, Text, Integer, Index, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from bot.config.settings import DB_URL
+from bot.utils.time_utils import now
+from bot.utils.log_partitions import LogPartitionManager
+from bot.utils.db_engine import get_engine, ensure_tables, is_sqlite
+from bot.utils.db_types import TZDateTime
 
 Base = declarative_base()
 
 class LogEntry(Base):
     __tablename__ = 'log_entries'
     
+    # The partition key has to be part of the primary key on a partitioned table
     id = Column(Integer, primary_key=True, autoincrement=True)
-    timestamp = Column(DateTime, default=datetime.now, nullable=False)
+    timestamp = Column(TZDateTime, primary_key=True, default=now, nullable=False)
     level = Column(String(10), nullable=False)
     logger_name = Column(String(100), nullable=False)
     message = Column(Text, nullable=False)
@@ -21,23 +30,60 @@ class LogEntry(Base):
     line_number = Column(Integer, nullable=True)
     exception_info = Column(Text, nullable=True)
     extra_data = Column(Text, nullable=True)  # JSON field for additional data
+    # message_tsv (generated tsvector) and the search indexes are added by migration 3 and
+    # deliberately left unmapped, so inserts never try to write the generated column
+
+    # Every LogManager query filters on a time window and orders by timestamp
+    __table_args__ = (
+        Index('ix_log_entries_timestamp', 'timestamp'),
+        Index('ix_log_entries_level_timestamp', 'level', 'timestamp'),
+        Index('ix_log_entries_logger_name_timestamp', 'logger_name', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+class LogRollup(Base):
+    """Per-minute log counts, maintained from log_entries by LogRollupManager."""
+    __tablename__ = 'log_rollups'
+    
+    minute = Column(TZDateTime, primary_key=True)
+    level = Column(String(10), primary_key=True)
+    logger_name = Column(String(100), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+# Queued records are written in batches of up to MAX_BATCH, at most FLUSH_INTERVAL seconds after they were logged
+FLUSH_INTERVAL = 0.5
+MAX_BATCH = 500
+_STOP = object()
 
 class PostgreSQLHandler(logging.Handler):
-    """Custom logging handler that stores logs in PostgreSQL database."""
+    """Custom logging handler that stores logs in the database.
+    
+    Emitting a record only queues it. One background thread writes the queued records in
+    batches, a transaction per batch, so logging never waits on the database and on SQLite
+    the log writes are a single writer instead of competing with the bot for the lock.
+    """
     
-    def __init__(self, level=logging.NOTSET):
+    def __init__(self, level=logging.NOTSET, engine=None):
         super().__init__(level)
-        self.engine = create_engine(DB_URL)
+        self.engine = engine if engine is not None else get_engine(DB_URL)
         self.Session = sessionmaker(bind=self.engine)
         
         # Create the log_entries table if it doesn't exist
-        Base.metadata.create_all(self.engine)
+        ensure_tables(Base.metadata, self.engine)
+        
+        # Make sure there is a partition to write into before the first record arrives
+        try:
+            LogPartitionManager(self.engine).ensure_partitions()
+        except Exception as e:
+            print(f"Failed to create log partitions: {e}")
+        
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_queued, name="log-writer", daemon=True)
+        self._writer.start()
     
     def emit(self, record):
-        """Emit a record to the database."""
+        """Queue a record to be written to the database."""
         try:
-            session = self.Session()
-            
             # Prepare extra data as JSON
             extra_data = {}
             if hasattr(record, 'extra_data'):
@@ -48,32 +94,67 @@ class PostgreSQLHandler(logging.Handler):
             if record.exc_info:
                 exception_info = self.formatException(record.exc_info)
             
-            # Create log entry
-            log_entry = LogEntry(
-                timestamp=datetime.fromtimestamp(record.created),
-                level=record.levelname,
-                logger_name=record.name,
-                message=record.getMessage(),
-                module=record.module,
-                function=record.funcName,
-                line_number=record.lineno,
-                exception_info=exception_info,
-                extra_data=json.dumps(extra_data) if extra_data else None
-            )
-            
-            session.add(log_entry)
+            self._queue.put({
+                'timestamp': datetime.fromtimestamp(record.created).astimezone(),
+                'level': record.levelname,
+                'logger_name': record.name,
+                'message': record.getMessage(),
+                'module': record.module,
+                'function': record.funcName,
+                'line_number': record.lineno,
+                'exception_info': exception_info,
+                'extra_data': json.dumps(extra_data) if extra_data else None,
+            })
+        except Exception as e:
+            print(f"Failed to queue log record: {e}")
+            print(f"Original log message: {record.getMessage()}")
+    
+    def _write_queued(self):
+        """Write queued records until the handler is closed."""
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            stopping = False
+            while len(batch) < MAX_BATCH:
+                try:
+                    entry = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._write(batch)
+            if stopping:
+                return
+    
+    def _write(self, batch: List[dict]):
+        session = self.Session()
+        try:
+            if is_sqlite(self.engine):
+                # SQLite does not generate ids for a composite primary key, so they are assigned here
+                last_id = session.query(func.max(LogEntry.id)).scalar() or 0
+                for offset, entry in enumerate(batch, start=1):
+                    entry['id'] = last_id + offset
+            session.execute(LogEntry.__table__.insert(), batch)
             session.commit()
-            
         except Exception as e:
+            session.rollback()
             # Fallback to console if database logging fails
-            print(f"Failed to log to database: {e}")
-            print(f"Original log message: {record.getMessage()}")
+            print(f"Failed to log {len(batch)} records to database: {e}")
+            for entry in batch:
+                print(f"Original log message: {entry['message']}")
         finally:
-            if 'session' in locals():
-                session.close()
+            session.close()
     
     def close(self):
-        """Close the handler and clean up resources."""
+        """Write the records still queued, then close the handler and clean up resources."""
+        if hasattr(self, '_writer') and self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join(timeout=10)
         if hasattr(self, 'engine'):
             self.engine.dispose()
-        super().close() 
\ No newline at end of file
+        super().close()
@@ -0,0 +1,37 @@
+import time
+import logging
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """Times the steps of start-up and logs them as a single report."""
+
+    def __init__(self, started: Optional[float] = None):
+        """
+        Args:
+            started: time.perf_counter() value start-up began at, now if not given
+        """
+        self.started = started if started is not None else time.perf_counter()
+        self._last = self.started
+        self.steps: List[Tuple[str, float]] = []
+
+    def mark(self, step: str):
+        """Record that a step finished, timing it from the end of the previous one."""
+        current = time.perf_counter()
+        self.steps.append((step, current - self._last))
+        self._last = current
+
+    def report(self, role: str):
+        """Log how long start-up took in total and per step."""
+        total = self._last - self.started
+        breakdown = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in self.steps)
+        logger.info(
+            f"Started {role} role in {total:.2f}s ({breakdown})",
+            extra={"extra_data": {
+                "metric": "startup_time",
+                "role": role,
+                "total_seconds": round(total, 3),
+                "steps": {step: round(seconds, 3) for step, seconds in self.steps},
+            }}
+        )
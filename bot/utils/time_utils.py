@@ -0,0 +1,31 @@
+from datetime import datetime, time, timedelta
+from typing import Optional
+
+
+def now() -> datetime:
+    """Get the current local time as a timezone-aware datetime.
+
+    All timestamps stored in the database are timezone-aware, so comparisons against
+    them must use aware datetimes as well.
+    """
+    return datetime.now().astimezone()
+
+
+def in_time_window(start: time, end: time, current: Optional[datetime] = None) -> bool:
+    """Check whether the local time of day falls between `start` and `end`.
+
+    The window may span midnight, e.g. a 23:00 start with a 07:00 end.
+    """
+    current_time = (current or now()).time()
+    if start <= end:
+        return start <= current_time < end
+    return current_time >= start or current_time < end
+
+
+def next_time_of_day(target: time, current: Optional[datetime] = None) -> datetime:
+    """Get the next local datetime at which the time of day is `target`, later than `current`."""
+    current = current or now()
+    candidate = current.replace(hour=target.hour, minute=target.minute, second=target.second, microsecond=0)
+    if candidate <= current:
+        candidate += timedelta(days=1)
+    return candidate
@@ -0,0 +1,147 @@
+import json
+import logging
+from typing import Dict, Optional, Tuple
+from google.adk.events import Event
+from google.adk.sessions import Session
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Rough average for chat text, used when the tokenizer is not available
+CHARS_PER_TOKEN = 4
+# Tokenizer used for local counts. It is not the model's own tokenizer, the difference is
+# absorbed by the calibration against the token counts the model reports
+TOKEN_ENCODING = "cl100k_base"
+# Tokens added per event for the role and message framing
+EVENT_OVERHEAD_TOKENS = 4
+# Weight of the newest sample in the running average of the prompt overhead
+CALIBRATION_WEIGHT = 0.2
+
+def estimate_tokens_from_chars(characters: int) -> int:
+    """Estimate the number of tokens in a text of the given length."""
+    return characters // CHARS_PER_TOKEN
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text."""
+    return estimate_tokens_from_chars(len(text))
+
+class TokenEstimator:
+    """Counts tokens locally and learns how far the counts are from the model's prompt size.
+
+    The prompt the model sees holds the session events plus the system instruction and tool
+    declarations. The latter are learned as a running average of the difference between the
+    reported prompt tokens and the local count of the session.
+    """
+
+    def __init__(self, encoding_name: str = TOKEN_ENCODING):
+        self.encoding_name = encoding_name
+        self.overhead: Optional[int] = None
+        self._encoding = None
+        self._encoding_failed = tiktoken is None
+
+    def _get_encoding(self):
+        if self._encoding is None and not self._encoding_failed:
+            try:
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                # The encoding is downloaded on first use, which fails without network access
+                logger.warning(f"Could not load the {self.encoding_name} tokenizer, estimating tokens from characters: {e}")
+                self._encoding_failed = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        """Count the tokens of a text."""
+        encoding = self._get_encoding()
+        if encoding is None:
+            return estimate_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_event(self, event: Event) -> int:
+        """Count the tokens an event adds to the prompt."""
+        if not event.content or not event.content.parts:
+            return 0
+        tokens = EVENT_OVERHEAD_TOKENS
+        for part in event.content.parts:
+            if part.text:
+                tokens += self.count(part.text)
+            elif part.function_call is not None:
+                tokens += self.count(f"{part.function_call.name} {json.dumps(part.function_call.args, default=str)}")
+            elif part.function_response is not None:
+                tokens += self.count(f"{part.function_response.name} {json.dumps(part.function_response.response, default=str)}")
+        return tokens
+
+    def estimate_prompt(self, session_tokens: int) -> int:
+        """Estimate the prompt tokens of a model call over a session of the given local count."""
+        return session_tokens + (self.overhead or 0)
+
+    def calibrate(self, session_tokens: int, reported_tokens: int):
+        """Learn from the prompt tokens a model reported for a session of the given local count."""
+        sample = max(0, reported_tokens - session_tokens)
+        if self.overhead is None:
+            self.overhead = sample
+        else:
+            self.overhead = round((1 - CALIBRATION_WEIGHT) * self.overhead + CALIBRATION_WEIGHT * sample)
+        logger.debug(f"Prompt overhead calibrated to {self.overhead} tokens (reported {reported_tokens}, counted {session_tokens})")
+
+class SessionTokenCounter:
+    """Running token counts of agent sessions, updated as events are appended.
+
+    A session is counted in full the first time it is needed, after that every appended
+    event is added to its count. Each count is kept with the first_seq and next_seq of the
+    session it was counted at, so a count is only used while the session is unchanged,
+    e.g. not after another process appended to it or reset it.
+    """
+
+    def __init__(self, estimator: TokenEstimator):
+        self.estimator = estimator
+        # Session id to its count, first_seq and next_seq
+        self._counts: Dict[str, Tuple[int, int, int]] = {}
+
+    def get(self, session_id: str, first_seq: Optional[int] = None, next_seq: Optional[int] = None) -> Optional[int]:
+        """Get the count of a session, None if it has not been counted yet or was counted at other sequence numbers."""
+        counted = self._counts.get(session_id)
+        if counted is None:
+            return None
+        count, counted_first_seq, counted_next_seq = counted
+        if first_seq is not None and (first_seq, next_seq) != (counted_first_seq, counted_next_seq):
+            return None
+        return count
+
+    def load(self, session: Session, first_seq: int, next_seq: int) -> int:
+        """Count a session fetched with its events from first_seq up to next_seq.
+
+        When the session was counted before and has only had events appended since, only
+        the new events are counted.
+        """
+        counted = self._counts.get(session.id)
+        if (counted is not None and counted[1] == first_seq and counted[2] <= next_seq
+                and len(session.events) == next_seq - first_seq):
+            count = counted[0] + sum(self.estimator.count_event(event) for event in session.events[counted[2] - first_seq:])
+        else:
+            count = sum(self.estimator.count_event(event) for event in session.events)
+        self._counts[session.id] = (count, first_seq, next_seq)
+        return count
+
+    def start(self, session_id: str, seq: int = 1):
+        """Start counting a session that has no events, from sequence number `seq`."""
+        self._counts[session_id] = (0, seq, seq)
+
+    def add_event(self, session_id: str, event: Event, seq: int):
+        """Add an event appended to a session as sequence number `seq`."""
+        counted = self._counts.get(session_id)
+        if counted is None:
+            # Sessions that were never counted are counted in full when they are next needed
+            return
+        count, first_seq, next_seq = counted
+        if next_seq != seq:
+            # Another process appended in between, the session is counted again when next needed
+            self.forget(session_id)
+            return
+        self._counts[session_id] = (count + self.estimator.count_event(event), first_seq, seq + 1)
+
+    def forget(self, session_id: str):
+        self._counts.pop(session_id, None)
@@ -0,0 +1,68 @@
+import re
+import json
+from typing import List, Optional
+from bot.services.database_service import USER_PROFILE_FIELDS
+
+# Handles of senders, "(@handle)", and of users mentioned in the messages
+HANDLE_PATTERN = re.compile(r"@([A-Za-z0-9_]{3,32})")
+# Field labels of the multi-line strings that used to be kept in the session state
+LEGACY_LABELS = {
+    "telegram handle": "handle",
+    "telegram name": "telegram_name",
+    "preferred name": "preferred_name",
+    "habits and style": "habits_and_style",
+    "communication preferences": "communication_preferences",
+    "special notes": "special_notes",
+}
+
+def normalise_handle(handle: Optional[str]) -> str:
+    """Lowercase a Telegram handle and drop the @."""
+    return (handle or "").strip().lstrip("@").lower()
+
+def extract_handles(messages: str) -> List[str]:
+    """Get the handles of the users who sent or are mentioned in a batch of queued messages."""
+    handles = {normalise_handle(handle) for handle in HANDLE_PATTERN.findall(messages)}
+    # Senders without a username
+    handles.discard("none")
+    handles.discard("unknown")
+    return sorted(handles)
+
+def profile_from_summary(user_information: dict) -> Optional[dict]:
+    """Turn a UserInformation from the summarising agent into a profile, None without a handle."""
+    handle = normalise_handle(user_information.get("telegram_handle"))
+    if not handle or " " in handle:
+        return None
+    return {"handle": handle, **{field: user_information.get(field) or None for field in USER_PROFILE_FIELDS}}
+
+def parse_legacy_profile(text: str) -> Optional[dict]:
+    """Parse a profile from the "Telegram Handle: ..." strings that used to be kept in the session state."""
+    profile = {}
+    for line in text.splitlines():
+        label, _, value = line.partition(":")
+        field = LEGACY_LABELS.get(label.strip().lower())
+        # Missing fields were written out as "None"
+        if field is not None and value.strip() not in ("", "None"):
+            profile[field] = value.strip()
+    handle = normalise_handle(profile.pop("handle", None))
+    if not handle or " " in handle:
+        return None
+    return {"handle": handle, **{field: profile.get(field) for field in USER_PROFILE_FIELDS}}
+
+def render_profiles_for_prompt(profiles: List[dict]) -> str:
+    """Render profiles compactly for the conversation prompt, one line per user."""
+    if not profiles:
+        return "No information about these users yet"
+    lines = []
+    for profile in profiles:
+        details = [f"{field.replace('_', ' ')}: {profile[field]}" for field in USER_PROFILE_FIELDS if profile.get(field)]
+        lines.append(f"@{profile['handle']} | " + " | ".join(details))
+    return "\n".join(lines)
+
+def render_profiles_for_summariser(profiles: List[dict]) -> str:
+    """Render profiles as one JSON object per line, sorted by handle, for the summarising agent."""
+    if not profiles:
+        return "No user information yet"
+    return "\n".join(
+        json.dumps({"telegram_handle": f"@{profile['handle']}", **{field: profile.get(field) for field in USER_PROFILE_FIELDS}}, ensure_ascii=False)
+        for profile in sorted(profiles, key=lambda profile: profile["handle"])
+    )
@@ -1,17 +1,34 @@
+import time
+# Start-up timing includes the imports below
+STARTED_AT = time.perf_counter()
+
 import asyncio
+import argparse
 import logging
 from telethon import TelegramClient, events
 from google.adk.runners import Runner
-from google.adk.sessions import DatabaseSessionService
 
 from agentConversation import get_conversation_agent
 
-from bot.config.settings import API_ID, API_HASH, BOT_TOKEN, DB_URL, DEV_MODE, DEV_CHAT_ID, LOG_LEVEL
+from bot.config.models import MODEL_WARMUP
+from bot.config.settings import API_ID, API_HASH, BOT_TOKEN, TELEGRAM_SESSION_STORE, TELEGRAM_SESSION_NAME, DB_URL, DB_BACKEND, DEV_MODE, DEV_CHAT_ID, LOG_LEVEL, LOG_RETENTION_DAYS, BOT_ROLE, SLEEP_TIME, WAKE_UP_TIME, SUMMARISATION_BATCH_INTERVAL, WAKEUP_STAGGER
 from bot.utils.bot_state import BotState
+from bot.utils.time_utils import in_time_window
 from bot.handlers.commands import CommandHandler
 from bot.handlers.message_handler import MessageHandler
 from bot.services.database_service import DatabaseService
+from bot.services.migration_service import run_migrations
+from bot.services.outbound import OutboundQueueClient, OutboundDispatcher
+from bot.services.chat_worker import ChatWorker
+from bot.services.send_scheduler import SendScheduler
+from bot.services.ingest_queue import IngestQueue
+from bot.services.session_service import TokenCountingSessionService
+from bot.services.telegram_session import DatabaseTelegramSession
+from bot.services.model_warmup import ModelWarmer
+from bot.services.wakeup_scheduler import WakeUpScheduler
 from bot.utils.postgres_logger import PostgreSQLHandler
+from bot.utils.log_manager import LogManager
+from bot.utils.startup_timer import StartupTimer
 
 # Configure logging
 logging.basicConfig(
@@ -38,13 +55,30 @@ logging.getLogger('telethon').setLevel(logging.WARNING)
 # Keep main application logging at INFO level
 logger = logging.getLogger(__name__)
 
-async def main():
-    if not all([API_ID, API_HASH, BOT_TOKEN]):
+startup_timer = StartupTimer(started=STARTED_AT)
+startup_timer.mark("imports")
+
+BOT_ROLES = ('all', 'ingest', 'worker')
+TELEGRAM_SESSION_STORES = ('database', 'file')
+
+async def main(role: str = BOT_ROLE):
+    if role not in BOT_ROLES:
+        raise ValueError(f"Invalid bot role: {role}. Use one of {', '.join(BOT_ROLES)}")
+    if TELEGRAM_SESSION_STORE not in TELEGRAM_SESSION_STORES:
+        raise ValueError(f"Invalid Telegram session store: {TELEGRAM_SESSION_STORE}. Use one of {', '.join(TELEGRAM_SESSION_STORES)}")
+    if role != 'worker' and not all([API_ID, API_HASH, BOT_TOKEN]):
         raise ValueError("TELEGRAM_API_ID, TELEGRAM_API_HASH, and TELEGRAM_BOT_TOKEN environment variables must be set")
+    if DB_BACKEND == 'sqlite' and role != 'all':
+        # Roles share work through row locks and leases that need a database server
+        raise ValueError("The sqlite database backend only supports BOT_ROLE=all, use postgresql to split roles across processes")
+    
+    # Bring the database schema up to date before anything touches it
+    run_migrations()
+    startup_timer.mark("migrations")
     
     # Initialize components
     bot_state = BotState()
-    session_service = DatabaseSessionService(db_url=DB_URL)
+    session_service = TokenCountingSessionService(db_url=DB_URL)
     runner = Runner(
         agent=get_conversation_agent(),
         app_name="dom",
@@ -52,11 +86,54 @@ async def main():
     )
     command_handler = CommandHandler(bot_state, session_service)
     message_handler = MessageHandler(bot_state, command_handler, runner, session_service)
+    startup_timer.mark("agents")
+    
+    # Summarise long sessions in bulk while the bot is asleep and the model is otherwise idle
+    async def summarise_during_sleep_hours():
+        """Periodically batch summarise oversized sessions between SLEEP_TIME and WAKE_UP_TIME."""
+        while True:
+            try:
+                if in_time_window(SLEEP_TIME, WAKE_UP_TIME):
+                    summarised = await message_handler.summariser.summarise_due_chats()
+                    if summarised > 0:
+                        logger.info(f"Batch summarised {summarised} sessions")
+                await asyncio.sleep(SUMMARISATION_BATCH_INTERVAL)
+            except Exception as e:
+                logger.error(f"Error in batch summarisation: {e}")
+                await asyncio.sleep(300)  # Wait a bit before retrying
+    
+    if role == 'worker':
+        # Workers have no Telegram connection, their replies are sent by the ingest process
+        message_handler.client = OutboundQueueClient(bot_state.db)
+        logger.info("Starting chat worker...")
+        worker_tasks = [asyncio.create_task(summarise_during_sleep_hours())]
+        if MODEL_WARMUP:
+            worker_tasks.append(asyncio.create_task(ModelWarmer(bot_state.db).run()))
+        startup_timer.report(role)
+        try:
+            await ChatWorker(bot_state, message_handler).run()
+        finally:
+            for task in worker_tasks:
+                task.cancel()
+            for task in worker_tasks:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            bot_state.close()
+            logger.info("Chat worker stopped")
+        return
+    
+    background_tasks = []
     
     # Initialize database service and start state checker
     db_service = DatabaseService()
-    db_service.message_handler = message_handler  # Add message handler to database service
-    state_checker_task = asyncio.create_task(db_service.start_state_checker())
+    if role == 'all':
+        db_service.message_handler = message_handler  # Add message handler to database service
+    background_tasks.append(asyncio.create_task(db_service.start_state_checker()))
+    if WAKEUP_STAGGER:
+        # Spread the morning return of chats so their overnight backlogs don't all hit the model at once
+        background_tasks.append(asyncio.create_task(WakeUpScheduler(db_service).run()))
     
     # Start periodic cleanup of stale summarization locks
     async def cleanup_stale_locks():
@@ -71,38 +148,138 @@ async def main():
                 logger.error(f"Error in stale lock cleanup: {e}")
                 await asyncio.sleep(60)  # Wait a bit before retrying
     
-    cleanup_task = asyncio.create_task(cleanup_stale_locks())
+    background_tasks.append(asyncio.create_task(cleanup_stale_locks()))
+    
+    async def prune_reply_graph():
+        """Periodically delete reply edges older than REPLY_GRAPH_RETENTION_DAYS."""
+        while True:
+            try:
+                pruned = message_handler.reply_graph.prune()
+                if pruned > 0:
+                    logger.info(f"Pruned {pruned} old reply edges")
+                await asyncio.sleep(3600)  # Run every hour
+            except Exception as e:
+                logger.error(f"Error pruning reply edges: {e}")
+                await asyncio.sleep(300)  # Wait a bit before retrying
+    
+    background_tasks.append(asyncio.create_task(prune_reply_graph()))
+    
+    async def purge_session_events():
+        """Periodically delete the session events that summarisation and /clear reset past."""
+        while True:
+            try:
+                purged = session_service.purge_reset_events()
+                if purged > 0:
+                    logger.info(f"Purged {purged} reset session events")
+                await asyncio.sleep(3600)  # Run every hour
+            except Exception as e:
+                logger.error(f"Error purging reset session events: {e}")
+                await asyncio.sleep(300)  # Wait a bit before retrying
+    
+    background_tasks.append(asyncio.create_task(purge_session_events()))
+    
+    # Keep log partitions created ahead of time and apply retention by dropping old ones
+    async def maintain_log_partitions():
+        """Periodically create upcoming log partitions and drop expired logs and rollups."""
+        log_manager = LogManager()
+        try:
+            while True:
+                try:
+                    log_manager.partitions.ensure_partitions()
+                    if LOG_RETENTION_DAYS > 0:
+                        log_manager.cleanup_old_logs(days=LOG_RETENTION_DAYS)
+                    log_manager.rollups.prune()
+                    await asyncio.sleep(3600)  # Run every hour
+                except Exception as e:
+                    logger.error(f"Error in log partition maintenance: {e}")
+                    await asyncio.sleep(300)  # Wait a bit before retrying
+        finally:
+            log_manager.close()
+    
+    background_tasks.append(asyncio.create_task(maintain_log_partitions()))
+    
+    async def refresh_log_rollups():
+        """Periodically fold new log rows into the per-minute rollups used by log stats."""
+        log_manager = LogManager()
+        try:
+            while True:
+                try:
+                    log_manager.rollups.refresh()
+                    await asyncio.sleep(60)  # Run every minute
+                except Exception as e:
+                    logger.error(f"Error refreshing log rollups: {e}")
+                    await asyncio.sleep(300)  # Wait a bit before retrying
+        finally:
+            log_manager.close()
+    
+    background_tasks.append(asyncio.create_task(refresh_log_rollups()))
+    
+    if role == 'all' and MODEL_WARMUP:
+        # Keep connections open and local models loaded so the first reply isn't the slowest,
+        # the start-up warm-up overlaps with the Telegram login
+        background_tasks.append(asyncio.create_task(ModelWarmer(bot_state.db).run()))
     
-    # Create the client
-    client = TelegramClient('bot_session', API_ID, API_HASH)
+    # Create the client, its session is kept in memory and saved to the database in batches
+    if TELEGRAM_SESSION_STORE == 'database':
+        telegram_session = DatabaseTelegramSession(TELEGRAM_SESSION_NAME)
+    else:
+        telegram_session = TELEGRAM_SESSION_NAME
+    client = TelegramClient(telegram_session, API_ID, API_HASH)
     
     # Add client to message handler
     message_handler.client = client
     
+    # Outgoing replies are rate limited to stay within Telegram's flood limits
+    send_scheduler = SendScheduler(client)
+    message_handler.send_scheduler = send_scheduler
+    command_handler.send_scheduler = send_scheduler
+    # The bot's own messages are recorded so replies to them can be told apart in group backlogs
+    send_scheduler.on_sent = message_handler.reply_graph.record_sent
+    background_tasks.append(asyncio.create_task(send_scheduler.run()))
+    if role == 'ingest':
+        # Replies are produced by the worker processes
+        message_handler.process_turns = False
+    
+    # Updates are handled by a fixed pool of workers, and shed when they come in faster than that
+    ingest_queue = IngestQueue()
+    background_tasks.append(asyncio.create_task(ingest_queue.run()))
+    
+    async def report_ingest_queue():
+        """Periodically log the ingest queue depth and the updates it shed."""
+        while True:
+            try:
+                await asyncio.sleep(60)  # Run every minute
+                ingest_queue.report()
+            except Exception as e:
+                logger.error(f"Error reporting ingest queue: {e}")
+                await asyncio.sleep(60)  # Wait a bit before retrying
+    
+    background_tasks.append(asyncio.create_task(report_ingest_queue()))
+    
     # Register event handlers
     @client.on(events.NewMessage(pattern='/start'))
     async def start_handler(event):
-        await command_handler.handle_start(event)
+        await ingest_queue.submit('start', event, command_handler.handle_start, coalesce=True)
     
     @client.on(events.NewMessage(pattern='/history'))
     async def history_handler(event):
-        await command_handler.handle_history(event)
+        await ingest_queue.submit('history', event, command_handler.handle_history, coalesce=True)
     
     @client.on(events.NewMessage(pattern='/clear'))
     async def clear_handler(event):
-        await command_handler.handle_clear(event)
+        await ingest_queue.submit('clear', event, command_handler.handle_clear, coalesce=True)
     
     @client.on(events.NewMessage(pattern='/urgent'))
     async def urgent_handler(event):
-        await command_handler.handle_urgent(event, message_handler=message_handler)
+        await ingest_queue.submit('urgent', event, lambda event: command_handler.handle_urgent(event, message_handler=message_handler if role == 'all' else None), coalesce=True)
     
     @client.on(events.NewMessage(pattern='/sleep'))
     async def sleep_handler(event):
-        await command_handler.handle_sleep(event)
+        await ingest_queue.submit('sleep', event, command_handler.handle_sleep, coalesce=True)
     
     @client.on(events.NewMessage(pattern='/status'))
     async def status_handler(event):
-        await command_handler.handle_status(event)
+        await ingest_queue.submit('status', event, command_handler.handle_status, coalesce=True)
     
     list_to_patterns_to_exclude = [
         '/start',
@@ -119,7 +296,9 @@ async def main():
     
     @client.on(events.NewMessage(func=filter))
     async def incoming_message_handler(event):
-        await message_handler.handle_message(event)
+        # Past INGEST_MAX_DEFERRED a message is only stored, the stranded message sweep answers it
+        await ingest_queue.submit('message', event, message_handler.handle_message,
+                                  overflow=lambda event: message_handler.handle_message(event, schedule_turn=False))
     
     # Start the bot
     logger.info("Starting the bot...")
@@ -127,28 +306,58 @@ async def main():
         logger.info(f"🚀 DEV MODE ACTIVE - Only chat {DEV_CHAT_ID} will be allowed")
         logger.info("📝 Online status checks are disabled for dev chat")
     await client.start(bot_token=BOT_TOKEN)
+    startup_timer.mark("telegram")
     logger.info("Bot is running...")
+    startup_timer.report(role)
+    
+    if role == 'all':
+        # Pick up chats whose messages were left unanswered by the previous run
+        pending_chats = bot_state.recover_after_restart()
+        if pending_chats:
+            logger.info(f"Resuming {len(pending_chats)} chats with unanswered messages")
+        background_tasks.append(asyncio.create_task(message_handler.resume_pending_chats(pending_chats)))
+        
+        # Redeliver messages whose turn failed or whose lease expired
+        async def sweep_stranded_messages():
+            """Periodically resume chats with queued messages that no turn is processing."""
+            while True:
+                try:
+                    await asyncio.sleep(60)  # Run every minute
+                    stranded_chats = bot_state.get_stranded_chats(older_than_seconds=60)
+                    if stranded_chats:
+                        logger.info(f"Found stranded queued messages in chats {stranded_chats}")
+                        await message_handler.resume_pending_chats(stranded_chats)
+                except Exception as e:
+                    logger.error(f"Error in stranded message sweep: {e}")
+                    await asyncio.sleep(60)  # Wait a bit before retrying
+        
+        background_tasks.append(asyncio.create_task(sweep_stranded_messages()))
+        background_tasks.append(asyncio.create_task(summarise_during_sleep_hours()))
+    else:
+        # Send the replies queued by the worker processes
+        background_tasks.append(asyncio.create_task(OutboundDispatcher(send_scheduler, bot_state.db).run()))
     
     try:
         # Keep the bot running
         await client.run_until_disconnected()
     finally:
         # Clean up
-        state_checker_task.cancel()
-        cleanup_task.cancel()
-        try:
-            await state_checker_task
-        except asyncio.CancelledError:
-            pass
-        try:
-            await cleanup_task
-        except asyncio.CancelledError:
-            pass
+        for task in background_tasks:
+            task.cancel()
+        for task in background_tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
         db_service.close()
         logger.info("Bot and state checker stopped")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the Telegram bot')
+    parser.add_argument('--role', choices=BOT_ROLES, default=BOT_ROLE,
+                        help='all runs everything in one process, ingest owns the Telegram connection and worker runs agent turns (default: BOT_ROLE or all)')
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.role))
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+CLI tool for managing the database schema.
+"""
+
+import argparse
+from bot.services.migration_service import MigrationService, MIGRATIONS
+
+def show_wakeup_plan(bucket_minutes: int, apply: bool):
+    """Print the planned morning wake-ups and the model load they project."""
+    from bot.services.database_service import DatabaseService
+    from bot.services.wakeup_scheduler import WakeUpScheduler
+    from bot.utils.time_utils import next_time_of_day
+    from bot.config.settings import WAKE_UP_TIME
+
+    db = DatabaseService()
+    try:
+        scheduler = WakeUpScheduler(db)
+        wake_up = next_time_of_day(WAKE_UP_TIME)
+        wake_ups = scheduler.plan(wake_up)
+        pending = [wake for wake in wake_ups if wake.pending_messages]
+        print(f"Wake-up plan for {wake_up:%Y-%m-%d %H:%M:%S} ({scheduler.concurrency} turns at once)")
+        if not pending:
+            print("No offline chats with queued messages come back after the next wake-up")
+            return
+
+        print(f"  {'chat':>16} {'messages':>8} {'tokens':>7} {'turn':>6} {'current':>9} {'planned':>9}")
+        for wake in pending:
+            print(f"  {wake.chat_id:>16} {wake.pending_messages:8} {wake.estimated_tokens:7} {wake.turn_seconds:5.0f}s "
+                  f"{wake.current_wake_at:%H:%M:%S} {wake.wake_at:%H:%M:%S}")
+
+        bucket_seconds = bucket_minutes * 60
+        for label, planned in (("Projected load without staggering", False), ("Projected load as planned", True)):
+            print(f"\n{label} ({bucket_minutes} minute buckets):")
+            for bucket in scheduler.projected_load(wake_ups, bucket_seconds=bucket_seconds, planned=planned):
+                print(f"  {bucket.start:%H:%M} {bucket.turns:4} turns {bucket.tokens:7} tokens {bucket.utilisation:6.0%} of capacity")
+
+        if apply:
+            print(f"\nRescheduled {scheduler.apply(wake_ups)} chats")
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the database schema')
+    subparsers = parser.add_subparsers(dest='command', help='Available commands')
+
+    # Upgrade command
+    subparsers.add_parser('upgrade', help='Create missing tables and apply pending migrations')
+
+    # Status command
+    subparsers.add_parser('status', help='Show applied and pending migrations')
+
+    # Offline SQL command
+    sql_parser = subparsers.add_parser('sql', help='Print the upgrade SQL without connecting to the database')
+    sql_parser.add_argument('--from-version', type=int, default=0, help='Only include migrations newer than this version (default: 0)')
+    sql_parser.add_argument('--no-tables', action='store_true', help='Skip CREATE TABLE statements for missing tables')
+
+    # Wake-up plan command
+    wakeup_parser = subparsers.add_parser('wakeup-plan', help='Show the planned morning wake-ups and the model load they project')
+    wakeup_parser.add_argument('--bucket', type=int, default=10, help='Minutes per load bucket (default: 10)')
+    wakeup_parser.add_argument('--apply', action='store_true', help='Save the planned wake-up times now')
+
+    args = parser.parse_args()
+
+    if not args.command:
+        parser.print_help()
+        return
+
+    if args.command == 'sql':
+        print(MigrationService.generate_sql(from_version=args.from_version, include_tables=not args.no_tables), end='')
+        return
+
+    if args.command == 'wakeup-plan':
+        show_wakeup_plan(args.bucket, args.apply)
+        return
+
+    service = MigrationService()
+
+    try:
+        if args.command == 'upgrade':
+            applied = service.upgrade()
+            if applied:
+                print(f"Applied migrations: {', '.join(str(version) for version in applied)}")
+            else:
+                print("Schema is up to date")
+
+        elif args.command == 'status':
+            current_version = service.get_current_version()
+            print(f"Current schema version: {current_version}")
+            for migration in MIGRATIONS:
+                status = 'applied' if migration.version <= current_version else 'pending'
+                print(f"  {migration.version:4} {status:8} {migration.description}")
+
+    finally:
+        service.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,39 @@
 CLI tool for managing and querying logs stored in PostgreSQL database.
 """
 
+import os
+import sys
+import csv
 import argparse
+import itertools
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
 from bot.utils.log_manager import LogManager
 
+EXPORT_FIELDS = ['id', 'timestamp', 'level', 'logger_name', 'message', 'module', 'function',
+                 'line_number', 'exception_info', 'extra_data']
+
 def format_log_entry(log_entry):
     """Format a log entry for display."""
     timestamp = datetime.fromisoformat(log_entry['timestamp'])
     return f"[{timestamp.strftime('%Y-%m-%d %H:%M:%S')}] {log_entry['level']:8} {log_entry['logger_name']:20} - {log_entry['message']}"
 
+def export_logs(logs, output_format, follow=False):
+    """Write logs to stdout as they arrive."""
+    writer = None
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+    for log in logs:
+        if writer:
+            writer.writerow(log)
+        elif output_format == 'ndjson':
+            sys.stdout.write(json.dumps(log) + "\n")
+        else:
+            sys.stdout.write(format_log_entry(log) + "\n")
+        if follow:
+            sys.stdout.flush()
+
 def main():
     parser = argparse.ArgumentParser(description='Manage and query logs from PostgreSQL database')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
@@ -42,18 +65,37 @@ def main():
     search_parser.add_argument('term', type=str, help='Search term')
     search_parser.add_argument('--hours', type=int, default=24, help='Hours to look back (default: 24)')
     search_parser.add_argument('--limit', type=int, default=50, help='Maximum number of results to return (default: 50)')
+    search_parser.add_argument('--mode', choices=LogManager.SEARCH_MODES, default='substring',
+                               help='substring (ILIKE), fts (ranked, supports "quoted phrases", OR and -word) or phrase (default: substring)')
     search_parser.add_argument('--json', action='store_true', help='Output in JSON format')
     
+    # Export command
+    export_parser = subparsers.add_parser('export', help='Stream logs, newest first, for piping into other tools')
+    export_parser.add_argument('--hours', type=int, default=24, help='Hours to look back (default: 24)')
+    export_parser.add_argument('--level', type=str, help='Filter by log level (DEBUG, INFO, WARNING, ERROR)')
+    export_parser.add_argument('--logger', type=str, help='Filter by logger name')
+    export_parser.add_argument('--limit', type=int, help='Maximum number of logs to export (default: no limit)')
+    export_parser.add_argument('--format', choices=['ndjson', 'csv', 'text'], default='ndjson', help='Output format (default: ndjson)')
+    export_parser.add_argument('--follow', action='store_true', help='Keep running and write new logs as they arrive')
+    export_parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls with --follow (default: 1)')
+    
     # Stats command
     stats_parser = subparsers.add_parser('stats', help='Get log statistics')
     stats_parser.add_argument('--hours', type=int, default=24, help='Hours to look back (default: 24)')
+    stats_parser.add_argument('--exact', action='store_true', help='Aggregate raw logs instead of the per-minute rollups')
     stats_parser.add_argument('--json', action='store_true', help='Output in JSON format')
     
+    # Rollup command
+    subparsers.add_parser('rollup', help='Refresh the per-minute log rollups used by stats')
+    
     # Cleanup command
     cleanup_parser = subparsers.add_parser('cleanup', help='Clean up old logs')
     cleanup_parser.add_argument('--days', type=int, default=30, help='Delete logs older than N days (default: 30)')
     cleanup_parser.add_argument('--dry-run', action='store_true', help='Show what would be deleted without actually deleting')
     
+    # Partitions command
+    subparsers.add_parser('partitions', help='List log partitions and create upcoming ones')
+    
     args = parser.parse_args()
     
     if not args.command:
@@ -96,16 +138,39 @@ def main():
                     print(format_log_entry(log))
         
         elif args.command == 'search':
-            logs = manager.search_logs(args.term, hours=args.hours, limit=args.limit)
+            logs = manager.search_logs(args.term, hours=args.hours, limit=args.limit, mode=args.mode)
             
             if args.json:
                 print(json.dumps(logs, indent=2))
             else:
                 for log in logs:
-                    print(format_log_entry(log))
+                    rank = f"({log['rank']:.3f}) " if 'rank' in log else ""
+                    print(f"{rank}{format_log_entry(log)}")
+        
+        elif args.command == 'export':
+            # Pin the start so rows written during the export are picked up by --follow instead
+            latest_id = manager.get_latest_log_id()
+            logs = manager.iter_logs(
+                hours=args.hours,
+                level=args.level,
+                logger_name=args.logger,
+                limit=args.limit,
+                before_id=latest_id + 1
+            )
+            if args.follow:
+                logs = itertools.chain(logs, manager.follow_logs(
+                    level=args.level,
+                    logger_name=args.logger,
+                    after_id=latest_id,
+                    poll_interval=args.poll_interval
+                ))
+            try:
+                export_logs(logs, args.format, follow=args.follow)
+            except KeyboardInterrupt:
+                pass
         
         elif args.command == 'stats':
-            stats = manager.get_log_statistics(hours=args.hours)
+            stats = manager.get_log_statistics(hours=args.hours, exact=args.exact)
             
             if args.json:
                 print(json.dumps(stats, indent=2))
@@ -118,25 +183,60 @@ def main():
                 print("\nTop loggers:")
                 for logger, count in stats['top_loggers'].items():
                     print(f"  {logger}: {count}")
+                percentiles = stats['per_minute_percentiles']
+                print("\nLogs per minute:")
+                print(f"  p50: {percentiles['p50']}  p95: {percentiles['p95']}  p99: {percentiles['p99']}  max: {percentiles['max']}")
+                print("\nErrors per hour:")
+                for hour, count in stats['errors_per_hour'].items():
+                    if count:
+                        print(f"  {datetime.fromisoformat(hour).strftime('%Y-%m-%d %H:00')}: {count}")
+        
+        elif args.command == 'rollup':
+            written = manager.rollups.refresh()
+            print(f"Refreshed {written} rollup rows")
         
         elif args.command == 'cleanup':
+            partitioned = manager.partitions.is_partitioned()
             if args.dry_run:
                 # For dry run, we'll count how many logs would be deleted
-                cutoff_date = datetime.now() - timedelta(days=args.days)
-                session = manager.Session()
-                try:
-                    count = session.query(manager.LogEntry).filter(
-                        manager.LogEntry.timestamp < cutoff_date
-                    ).count()
-                    print(f"Would delete {count} logs older than {args.days} days")
-                finally:
-                    session.close()
+                pending = manager.count_logs_to_cleanup(days=args.days)
+                if partitioned:
+                    print(f"Would drop {len(pending['partitions'])} partitions (~{pending['count']} logs) older than {args.days} days")
+                    for name in pending['partitions']:
+                        print(f"  {name}")
+                else:
+                    print(f"Would delete {pending['count']} logs older than {args.days} days")
             else:
                 deleted_count = manager.cleanup_old_logs(days=args.days)
-                print(f"Deleted {deleted_count} logs older than {args.days} days")
+                if partitioned:
+                    print(f"Dropped ~{deleted_count} logs older than {args.days} days")
+                else:
+                    print(f"Deleted {deleted_count} logs older than {args.days} days")
+    
+        elif args.command == 'partitions':
+            if not manager.partitions.is_partitioned():
+                print("log_entries is not partitioned, run `python manage_db.py upgrade` first")
+            else:
+                created = manager.partitions.ensure_partitions()
+                for name in created:
+                    print(f"Created {name}")
+                for partition in manager.partitions.get_partitions():
+                    if partition['is_default']:
+                        bounds = "DEFAULT"
+                    else:
+                        lower = partition['lower'].isoformat() if partition['lower'] else "MINVALUE"
+                        upper = partition['upper'].isoformat() if partition['upper'] else "MAXVALUE"
+                        bounds = f"{lower} -> {upper}"
+                    print(f"{partition['name']:32} {bounds:55} ~{partition['estimated_rows']} rows")
     
     finally:
         manager.close()
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    try:
+        main()
+    except BrokenPipeError:
+        # The reader (e.g. head) went away, silence the error Python raises when flushing stdout on exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1) 
\ No newline at end of file
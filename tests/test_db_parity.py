@@ -0,0 +1,204 @@
+"""The same database scenarios run against SQLite and Postgres, so the two backends can't drift apart.
+
+Postgres is used when TEST_POSTGRES_URL is set, or when the bot's own DB_URL points at
+Postgres, and the tests are skipped for it when it can't be reached. Every test uses its
+own chat and session ids, so an existing database can be used.
+"""
+import os
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from google.adk.events import Event, EventActions
+from google.genai import types
+from sqlalchemy.engine import make_url
+
+from bot.config.settings import DB_URL, QUEUE_MAX_DELIVERIES
+from bot.services.database_service import DatabaseService, DeadLetterMessage, QueuedMessage
+from bot.services.session_service import AgentSessionEvent, EventLogSessionService
+from bot.utils.db_engine import get_engine
+from bot.utils.log_rollups import LogRollupManager
+from bot.utils.postgres_logger import PostgreSQLHandler
+
+
+def _postgres_url():
+    url = os.getenv("TEST_POSTGRES_URL")
+    if url:
+        return url
+    if make_url(DB_URL).get_backend_name() == "postgresql":
+        return DB_URL
+    return None
+
+
+@pytest.fixture(scope="module", params=["sqlite", "postgresql"])
+def db_url(request, tmp_path_factory):
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path_factory.mktemp('db') / 'bot.sqlite3'}"
+    url = _postgres_url()
+    if url is None:
+        pytest.skip("Postgres is not configured, set TEST_POSTGRES_URL")
+    try:
+        with get_engine(url).connect():
+            pass
+    except Exception as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    return url
+
+
+@pytest.fixture
+def db(db_url):
+    return DatabaseService(get_engine(db_url))
+
+
+@pytest.fixture
+def chat_id():
+    return f"test-{uuid.uuid4().hex}"
+
+
+def _event(text, state_delta=None):
+    return Event(
+        author="user",
+        content=types.Content(role="user", parts=[types.Part(text=text)]),
+        actions=EventActions(state_delta=state_delta or {}),
+    )
+
+
+def test_queue_claim_ack_release(db, chat_id):
+    db.add_to_message_queue(chat_id, "first")
+    db.add_to_message_queue(chat_id, "second")
+
+    batch = db.claim_message_batch(chat_id)
+    assert batch["messages"] == "first\nsecond\n"
+    assert batch["number_of_messages"] == 2
+    # Claimed messages are not handed out twice
+    assert db.claim_message_batch(chat_id) is None
+
+    # An interrupted turn does not count as a delivery
+    assert db.release_message_batch(batch["token"], failed=False) == 2
+    batch = db.claim_message_batch(chat_id)
+    session = db.Session()
+    try:
+        counts = [row.delivery_count for row in session.query(QueuedMessage).filter_by(chat_id=chat_id)]
+    finally:
+        session.close()
+    assert counts == [1, 1]
+
+    # Held back messages are neither claimed nor stranded until the retry delay has passed
+    db.release_message_batch(batch["token"], failed=False, retry_after_seconds=60)
+    assert db.claim_message_batch(chat_id) is None
+    assert chat_id not in db.get_stranded_chats()
+
+    db.clear_message_queue(chat_id)
+    db.add_to_message_queue(chat_id, "third")
+    batch = db.claim_message_batch(chat_id)
+    assert db.ack_message_batch(batch["token"]) == 1
+    assert db.get_message_queue(chat_id)["number_of_messages"] == 0
+
+
+def test_queue_dead_letters(db, chat_id):
+    db.add_to_message_queue(chat_id, "poison")
+    for _ in range(QUEUE_MAX_DELIVERIES):
+        db.release_message_batch(db.claim_message_batch(chat_id)["token"])
+
+    assert db.claim_message_batch(chat_id) is None
+    session = db.Session()
+    try:
+        dead_letters = session.query(DeadLetterMessage).filter_by(chat_id=chat_id).all()
+    finally:
+        session.close()
+    assert [(row.message, row.delivery_count) for row in dead_letters] == [("poison", QUEUE_MAX_DELIVERIES)]
+
+
+def test_append_event_merges_state_with_none(db_url, chat_id):
+    service = EventLogSessionService(db_url)
+
+    async def scenario():
+        session = await service.create_session(app_name="test", user_id=chat_id, state={"a": 1, "b": 2})
+        await service.append_event(session, _event("hello", {"a": None, "c": 3}))
+        # A new service has nothing cached, so the state comes from the database
+        return await EventLogSessionService(db_url).get_session(app_name="test", user_id=chat_id, session_id=session.id)
+
+    stored = asyncio.run(scenario())
+    assert stored.state == {"a": None, "b": 2, "c": 3}
+    assert [event.content.parts[0].text for event in stored.events] == ["hello"]
+
+
+def test_reset_and_purge_events(db_url, chat_id):
+    service = EventLogSessionService(db_url)
+
+    async def scenario():
+        session = await service.create_session(app_name="test", user_id=chat_id, state={"kept": True})
+        for text in ("one", "two", "three"):
+            await service.append_event(session, _event(text))
+        await service.reset_events(app_name="test", user_id=chat_id, session_id=session.id, state={"summary": "s"})
+        reset = await EventLogSessionService(db_url).get_session(app_name="test", user_id=chat_id, session_id=session.id)
+        assert reset.events == []
+        assert reset.state == {"summary": "s"}
+
+        assert service.purge_reset_events() >= 3
+        await service.append_event(reset, _event("four"))
+        return await EventLogSessionService(db_url).get_session(app_name="test", user_id=chat_id, session_id=session.id)
+
+    stored = asyncio.run(scenario())
+    assert [event.content.parts[0].text for event in stored.events] == ["four"]
+    db_session = service.Session()
+    try:
+        seqs = [row.seq for row in db_session.query(AgentSessionEvent.seq).filter_by(user_id=chat_id)]
+    finally:
+        db_session.close()
+    # Sequence numbers carry on after a reset
+    assert seqs == [4]
+
+
+def test_upserts(db, chat_id):
+    db.save_user_profiles(chat_id, [
+        {"handle": "alice", "preferred_name": "Al"},
+        {"handle": "bob", "preferred_name": "Bob"},
+    ])
+    db.save_user_profiles(chat_id, [{"handle": "alice", "preferred_name": "Alice", "special_notes": "new"}])
+    profiles = {profile["handle"]: profile for profile in db.get_user_profiles(chat_id)}
+    assert profiles["alice"]["preferred_name"] == "Alice"
+    assert profiles["alice"]["special_notes"] == "new"
+    assert profiles["bob"]["preferred_name"] == "Bob"
+
+    assert db.acquire_chat_lease(chat_id, "worker-1")
+    assert not db.acquire_chat_lease(chat_id, "worker-2")
+    assert db.acquire_chat_lease(chat_id, "worker-1")
+    db.release_chat_lease(chat_id, "worker-1")
+    assert db.acquire_chat_lease(chat_id, "worker-2")
+    db.release_chat_lease(chat_id, "worker-2")
+
+
+def test_tzdatetime_round_trip(db, chat_id):
+    moment = datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=timezone(timedelta(hours=8)))
+    db.set_processing_delay(chat_id, moment)
+    stored = db.get_processing_delay(chat_id)
+    db.clear_processing_delay(chat_id)
+    assert stored.tzinfo is not None
+    assert stored == moment
+
+
+def test_rollup_counts(db_url):
+    logger_name = f"test.{uuid.uuid4().hex}"
+    handler = PostgreSQLHandler(engine=get_engine(db_url))
+    since = datetime.now().astimezone() - timedelta(minutes=1)
+    for level, count in ((logging.INFO, 3), (logging.WARNING, 2)):
+        for _ in range(count):
+            handler.emit(logging.LogRecord(logger_name, level, __file__, 0, "message", None, None))
+    # Closing writes the queued records
+    handler.close()
+
+    rollups = LogRollupManager(get_engine(db_url))
+    rollups.refresh()
+
+    def totals(rows):
+        counts = {}
+        for _, level, name, count in rows:
+            if name == logger_name:
+                counts[level] = counts.get(level, 0) + count
+        return counts
+
+    assert totals(rollups.get_counts(since)) == {"INFO": 3, "WARNING": 2}
+    assert totals(rollups.get_exact_counts(since)) == {"INFO": 3, "WARNING": 2}